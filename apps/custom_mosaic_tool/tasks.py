@@ -21,6 +21,8 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, ResultType, Metadata
 
@@ -39,9 +41,18 @@ from dateutil.tz import tzutc
 
 from utils.data_access_api import DataAccessApi
 from utils.dc_mosaic import create_mosaic, create_median_mosaic, create_max_ndvi_mosaic, create_min_ndvi_mosaic
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask
 
 from data_cube_ui.utils import update_model_bounds_with_dataset
+from data_cube_ui.reduction import fill_nodata, create_output_grid, fold_chunk, load_accumulated_product, get_nodata_fraction, is_tile_filled
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.histogram_median import StreamingMedian, count_cf_mask, create_cf_mask
+from data_cube_ui.tiling import plan_tiles, get_tile_size, combine_tiles
+from data_cube_ui.tile_transport import put_tile, get_tile, delete_tile, clear_tiles
+from data_cube_ui.chunk_cache import is_cache_enabled, get_chunk_key, load_chunk, store_chunk
+from data_cube_ui.block_cache import get_cached_dataset
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 """
 Class for handling loading celery workers to perform tasks asynchronously.
@@ -65,42 +76,36 @@ measurements = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'cf_mask']
 
 """
 functions used to combine time sliced data after being combined geographically.
-Fill nodata uses the first timeslice as a base, then uses subsequent slices to
+Fill nodata (shared, in data_cube_ui.reduction) uses the first timeslice as a base, then uses subsequent slices to
 fill in indices with nodata values.
 this should be used for recent/leastrecent + anything that is done in a single time chunk (median pixel?)
 things like max/min ndvi should be able to compound max/min ops between ddifferent timeslices so this will be
 different for that.
 """
-def fill_nodata(dataset, dataset_intermediate):
-    if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset_out[key].values==-9999] = dataset[key].values[dataset_out[key].values==-9999]
-    return dataset_out
-
 def max_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values > dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values > dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values > dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 def min_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values < dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values < dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values < dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 #holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
 # process disregard it.
+# nodata_threshold lets fill_nodata mosaics stop loading scenes once no more than that fraction of pixels are nodata.
+# median_radix_bits makes the chunk build an exact median from per pixel histograms - see StreamingMedian. plan_chunks
+# turns it off when holding every acquisition for processing_method takes less memory.
 #experimentally optimized geo/time/slices_per_iter
 processing_algorithms = {
     'most_recent': {
@@ -109,6 +114,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': True,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': 0.0,
+        'median_radix_bits': None,
         'processing_method': create_mosaic
     },
     'least_recent': {
@@ -117,14 +124,18 @@ processing_algorithms = {
         'time_slices_per_iteration': 1,
         'reverse_time': False,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': 0.0,
+        'median_radix_bits': None,
         'processing_method': create_mosaic
     },
     'median_pixel': {
-        'geo_chunk_size': 0.01,
+        'geo_chunk_size': 0.5,
         'time_chunks': None,
-        'time_slices_per_iteration': None,
+        'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': None,
+        'median_radix_bits': 8,
         'processing_method': create_median_mosaic
     },
     'max_ndvi': {
@@ -133,6 +144,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': max_value,
+        'nodata_threshold': None,
+        'median_radix_bits': None,
         'processing_method': create_max_ndvi_mosaic
     },
     'min_ndvi': {
@@ -141,6 +154,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': min_value,
+        'nodata_threshold': None,
+        'median_radix_bits': None,
         'processing_method': create_min_ndvi_mosaic
     }
 }
@@ -175,8 +190,6 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
 
     print("Got the query, creating metadata.")
 
-    result_type = ResultType.objects.get(satellite_id=query.platform, result_id=query.query_type)
-
     # creates the empty result.
     result = query.generate_result()
 
@@ -184,6 +197,11 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
         error_with_message(result, "Combined products are not supported for custom mosaics.")
         return
 
+    # the median is only known once every acquisition has been read, so there are no frames to animate.
+    if query.compositor == "median_pixel" and query.animated_product != "None":
+        error_with_message(result, "Animations are not supported for median pixel mosaics.")
+        return
+
     product_details = dc.dc.list_products()[dc.dc.list_products().name == query.product]
 
     # wrapping this in a try/catch, as it will throw a few different errors
@@ -197,22 +215,28 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
             error_with_message(result, "There were no acquisitions for this parameter set.")
             return
 
-        processing_options = processing_algorithms[query.compositor]
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms[query.compositor]
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(acquisitions))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
 
         #animation related checks.. kinda bad but it'll do for now.
         if query.animated_product != "None":
-            processing_options["time_slices_per_iteration"] = 1
+            overrides["time_slices_per_iteration"] = 1
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
         # Reversed time = True will make it so most recent = First, oldest = Last.
         #default is in order from oldest -> newwest.
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details))
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
         # ensures that the start and end are both valid.
@@ -222,120 +246,159 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid(s) that the chunks write their results directly into.
+        create_output_grid(base_temp_path + query.query_id, 'mosaic', latitude=(query.latitude_min, query.latitude_max),
+                           longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
         # iterate over the time chunks.
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
 
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_mosaic_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
-            time_chunk_tasks.append(geo_chunk_tasks)
+                chunk_tasks.append(generate_mosaic_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
+
+        combination_task = combine_mosaic_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                   acquisitions=acquisitions, resolution=product_details.resolution.values[0])
+        combination_task.link_error(mosaic_chunk_failure.s(query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_mosaic_chunks")
+def combine_mosaic_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, resolution=None):
+    """
+    Chord callback for create_cloudfree_mosaic. Receives the results of every generate_mosaic_chunk
+    task ordered by time chunk then geographic chunk, combines them into the final mosaic and
+    creates the png/tif/netcdf results.
+
+    Args:
+        chunk_results (list): The [path, metadata] lists returned by generate_mosaic_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+        return
 
-        # holds some acquisition based metadata. dict of objs keyed by date
-        dataset_out = None
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+    result_type = ResultType.objects.get(satellite_id=query.platform, result_id=query.query_type)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_query(query_id)
+            clear_tiles(base_temp_path + query_id)
+            return
+
+        # each chunk has already been folded into the accumulator for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is [path, metadata].
         acquisition_metadata = {}
-        time_range_index = 0
+        for tile in chunk_results:
+            if tile is None or tile[0] is None:
+                continue
+            tile_metadata = tile[1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date in acquisition_metadata:
+                    acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
+                else:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        # the last combined animation frame - the true value at the end of the previous time chunk.
+        animation_out = None
         animation_tile_count = 0
 
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                # tile is [path, metadata]. Append tiles to list of tiles for concat, compile metadata.
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
-                    return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles = []
-            for tile in tiles:
-                tile_metadata = tile[1]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
-                xr_tiles.append(xr.open_dataset(tile[0]))
-            full_dataset = xr.concat(reversed(xr_tiles), dim='latitude')
-            dataset = full_dataset.load()
-
-            # combine all the intermediate products for the animation creation.
-            if query.animated_product != "None":
-                  print("Num of slices in this chunk: " +
-                        str(len(time_ranges[time_range_index])))
-                  for timeslice in range(len(time_ranges[time_range_index])):
-                      result = Result.objects.get(query_id=query.query_id)
-                      if result.status == "CANCEL":
-                          print("Cancelled task.")
-                          shutil.rmtree(base_temp_path + query.query_id)
-                          query.delete()
-                          result.delete()
-                          return
-                      animation_tiles = []
-                      nc_paths = []
-                      for geoslice in range(len(lat_ranges)):
-                          nc_path = base_temp_path + query.query_id + '/' + \
-                              str(time_range_index) + '/' + \
-                              str(geoslice) + str(timeslice) + ".nc"
-                          nc_paths.append(nc_path)
-                          animation_tiles.append(xr.open_dataset(nc_path))
-
-                      animated_data = xr.concat(
-                          reversed(animation_tiles), dim='latitude').load()
-                      #combine the timeslice vals with the intermediate for the true value @ that timeslice
-                      if time_range_index > 0 and query.animated_product != "scene":
-                          animated_data = processing_options[
-                              'chunk_combination_method'](animated_data, dataset_out)
-
-                      tif_path = base_temp_path + query.query_id + '/' + \
-                          str(time_range_index) + '/' + \
-                          str(animation_tile_count) + '.tif'
-                      png_path = base_temp_path + query.query_id + \
-                          '/' + str(animation_tile_count) + '.png'
-                      animation_tile_count += 1
-
-                      # get metadata needed for tif creation.
-                      geotransform = [dataset.longitude.values[0], product_details.resolution.values[0][1],
-                                      0.0, dataset.latitude.values[0], 0.0, product_details.resolution.values[0][0]]
-                      crs = str("EPSG:4326")
-
-                      save_to_geotiff(tif_path, gdal.GDT_Float64, animated_data, geotransform, crs,
-                                      x_pixels=animated_data.dims['longitude'], y_pixels=animated_data.dims['latitude'], band_order=['blue', 'green', 'red', 'nir', 'swir1', 'swir2'])
-                      animated_data = None
-
-                      bands = [measurements.index(result_type.red)+1, measurements.index(result_type.green)+1, measurements.index(result_type.blue)+1]
-                      create_rgb_png_from_tiff(tif_path, png_path, bands=bands, scale=(0, 4096))
-
-                      # remove all the intermediates for this timeslice
-                      for path in nc_paths:
-                          os.remove(path)
-                      os.remove(tif_path)
-                  # remove the tiff.. some of these can be >1gb, so having one
-                  # per scene is too much.
-                  shutil.rmtree(base_temp_path + query.query_id +
-                                '/' + str(time_range_index))
-
-            time_range_index += 1
-            dataset_out = processing_options['chunk_combination_method'](dataset, dataset_out)
+        # combine all the intermediate products for the animation creation.
+        if query.animated_product != "None":
+            for time_range_index in range(len(time_ranges)):
+                print("Num of slices in this chunk: " +
+                      str(len(time_ranges[time_range_index])))
+                previous_frame = animation_out
+                for timeslice in range(len(time_ranges[time_range_index])):
+                    animation_tiles = []
+                    tile_directory = base_temp_path + query.query_id + '/' + str(time_range_index)
+                    tile_names = [str(geoslice) + "_" + str(timeslice) for geoslice in range(geo_chunk_count)]
+                    for tile_name in tile_names:
+                        animation_tiles.append(get_tile(tile_directory, tile_name))
+
+                    animated_data = combine_tiles(animation_tiles).load()
+                    #combine the timeslice vals with the intermediate for the true value @ that timeslice
+                    if time_range_index > 0 and query.animated_product != "scene":
+                        animated_data = processing_options[
+                            'chunk_combination_method'](animated_data, previous_frame)
+                    animation_out = animated_data
+
+                    tif_path = base_temp_path + query.query_id + '/' + \
+                        str(time_range_index) + '/' + \
+                        str(animation_tile_count) + '.tif'
+                    png_path = base_temp_path + query.query_id + \
+                        '/' + str(animation_tile_count) + '.png'
+                    animation_tile_count += 1
+
+                    # get metadata needed for tif creation.
+                    geotransform = [animated_data.longitude.values[0], resolution[1],
+                                    0.0, animated_data.latitude.values[0], 0.0, resolution[0]]
+                    crs = str("EPSG:4326")
+
+                    save_to_geotiff(tif_path, gdal.GDT_Float64, animated_data, geotransform, crs,
+                                    x_pixels=animated_data.dims['longitude'], y_pixels=animated_data.dims['latitude'], band_order=['blue', 'green', 'red', 'nir', 'swir1', 'swir2'])
+                    animated_data = None
+
+                    bands = [measurements.index(result_type.red)+1, measurements.index(result_type.green)+1, measurements.index(result_type.blue)+1]
+                    create_rgb_png_from_tiff(tif_path, png_path, bands=bands, scale=(0, 4096))
+
+                    # remove all the intermediates for this timeslice
+                    for tile_name in tile_names:
+                        delete_tile(tile_directory, tile_name)
+                    os.remove(tif_path)
+                # remove the tiff.. some of these can be >1gb, so having one
+                # per scene is too much.
+                shutil.rmtree(base_temp_path + query.query_id +
+                              '/' + str(time_range_index))
+        animation_out = None
+
+        dataset_out = load_accumulated_product(base_temp_path + query.query_id, 'mosaic')
 
         latitude = dataset_out.latitude
         longitude = dataset_out.longitude
 
         # grabs the resolution.
-        geotransform = [longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, latitude.values[0], 0.0, product_details.resolution.values[0][0]]
+        geotransform = [longitude.values[0], resolution[1],
+                        0.0, latitude.values[0], 0.0, resolution[0]]
         #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
         crs = str("EPSG:4326")
 
@@ -404,6 +467,8 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
         query.complete = True
         query.query_end = datetime.datetime.now()
         query.save()
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
     except:
         error_with_message(
             result, "There was an exception when handling this query.")
@@ -419,20 +484,39 @@ def generate_mosaic_chunk(time_num, chunk_num, processing_options=None, query=No
     saves the result to disk using time/chunk num, and returns the path and the acquisition date keyed metadata.
     """
     time_index = 0
+    # most/least recent mosaics can't change once every pixel is filled, so they stop loading scenes early.
+    early_termination = processing_options['nodata_threshold'] is not None and query.animated_product == "None"
     iteration_data = None
+    # median_pixel builds the median from histograms, reading the acquisitions once per pass.
+    median = StreamingMedian(processing_options['median_radix_bits'], qa_band='cf_mask') if processing_options['median_radix_bits'] is not None else None
     acquisition_metadata = {}
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    # animations need every frame so they can't be served from the chunk cache.
+    cache_key = None
+    if query.animated_product == "None" and is_cache_enabled():
+        cache_key = get_chunk_key(query.product, "custom_mosaic_tool." + query.compositor, lat_range, lon_range, acquisition_list, measurements=measurements, qa_band='cf_mask')
+        cached = load_chunk(cache_key)
+        if cached is not None:
+            print("Using cached chunk: " + str(time_num) + " " + str(chunk_num))
+            cached_products, acquisition_metadata = cached
+            geo_path = fold_chunk(cached_products['mosaic'], base_temp_path + query.query_id, 'mosaic', chunk_num, time_num, processing_options['chunk_combination_method'],
+                                  nodata_threshold=processing_options['nodata_threshold'])
+            increment_progress(query.query_id)
+            return [geo_path, acquisition_metadata]
     # holds some acquisition based metadata.
-    while time_index < len(acquisition_list):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return [None]
-        if result.status == "CANCEL":
+    while time_index < len(acquisition_list) or (median is not None and median.next_pass()):
+        if time_index >= len(acquisition_list):
+            time_index = 0
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
+        # lower time chunks have already filled this tile, so nothing loaded here would be used.
+        if early_termination and is_tile_filled(base_temp_path + query.query_id, 'mosaic', chunk_num, time_num):
+            print("Tile filled by earlier time chunks, stopping.")
+            # the result is incomplete so it can't be cached.
+            cache_key = None
+            break
 
         # time ranges set based on if the acquisition_list has been reversed or not. If it has, then the 'start' index is the later date, and must be handled appropriately.
         start = acquisition_list[time_index] + datetime.timedelta(seconds=1) if processing_options['reverse_time'] else acquisition_list[time_index]
@@ -442,20 +526,28 @@ def generate_mosaic_chunk(time_num, chunk_num, processing_options=None, query=No
             end = acquisition_list[-1] if processing_options['reverse_time'] else acquisition_list[-1] + datetime.timedelta(seconds=1)
         time_range = (end, start) if processing_options['reverse_time'] else (start, end)
 
-        raw_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
+        raw_data = get_cached_dataset(dc, query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
 
         if "cf_mask" not in raw_data:
             time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
             continue
         clear_mask = create_cfmask_clean_mask(raw_data.cf_mask)
 
-        # Removes the cf mask variable from the dataset after the clear mask has been created.
-        # prevents the cf mask from being put through the mosaicing function as it doesn't fit
-        # the correct format w/ nodata values for mosaicing.
-        raw_data = raw_data.drop('cf_mask')
-
-        iteration_data = processing_options['processing_method'](
-            raw_data, clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
+        # the cf mask is kept in the mosaic, as for fractional cover, so fractional cover can classify the
+        # mosaic from its NetCDF. Medians summarize it instead.
+        if median is not None:
+            median.add(raw_data, clear_mask)
+            # the metadata is only collected on the first pass.
+            if median.pass_index > 0:
+                time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
+                continue
+        elif query.compositor == "median_pixel":
+            iteration_data = processing_options['processing_method'](
+                raw_data.drop('cf_mask'), clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
+            iteration_data['cf_mask'] = (('latitude', 'longitude'), create_cf_mask(*count_cf_mask(raw_data.cf_mask.values, clear_mask)))
+        else:
+            iteration_data = processing_options['processing_method'](
+                raw_data, clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
 
         # update metadata. # here the clear mask has all the clean
         # pixels for each acquisition.
@@ -479,21 +571,54 @@ def generate_mosaic_chunk(time_num, chunk_num, processing_options=None, query=No
                 if not os.path.exists(base_temp_path + query.query_id + '/' + str(time_num)):
                     os.mkdir(base_temp_path + query.query_id +
                              '/' + str(time_num))
-                animated_data.to_netcdf(base_temp_path + query.query_id + '/' + str(
-                    time_num) + '/' + str(chunk_num) + str(time_index + timeslice) + ".nc")
+                put_tile(animated_data, base_temp_path + query.query_id + '/' + str(time_num),
+                         str(chunk_num) + "_" + str(time_index + timeslice))
+
+        if early_termination and get_nodata_fraction(iteration_data[measurements[0]]) <= processing_options['nodata_threshold']:
+            print("Mosaic filled, stopping.")
+            break
 
         time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
 
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
+    if median is not None:
+        iteration_data = median.get_result()
     # if this is an empty chunk, just return an empty dataset.
     if iteration_data is None:
+        increment_progress(query.query_id)
         return [None, None]
-    iteration_data.to_netcdf(geo_path)
+    if cache_key is not None:
+        store_chunk(cache_key, {'mosaic': iteration_data}, acquisition_metadata)
+    # fold this geographic chunk into the accumulated product as soon as it's done.
+    geo_path = fold_chunk(iteration_data, base_temp_path + query.query_id, 'mosaic', chunk_num, time_num, processing_options['chunk_combination_method'],
+                          nodata_threshold=processing_options['nodata_threshold'])
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
+    increment_progress(query.query_id)
     return [geo_path, acquisition_metadata]
 
+@task(name="mosaic_chunk_failure")
+def mosaic_chunk_failure(task_id, query_id):
+    """
+    Error callback for the combine_mosaic_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_mosaic_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+    elif result is not None:
+        error_with_message(result, "There was an exception when handling this query.")
+
 def error_with_message(result, message):
     """
     Errors out under specific circumstances, used to pass error msgs to user. Uses the result path as
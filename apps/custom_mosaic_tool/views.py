@@ -34,6 +34,7 @@ from data_cube_ui.models import Satellite, Area, Application
 from data_cube_ui.forms import GeospatialForm
 from .forms import DataSelectForm
 from .tasks import create_cloudfree_mosaic
+from data_cube_ui.task_control import cancel_query, get_progress
 
 from .utils import create_query_from_post
 
@@ -183,6 +184,8 @@ def cancel_request(request):
             if result.status == "WAIT" and query.complete == False:
                 result.status = "CANCEL"
                 result.save()
+                # signals the chunks to stop and revokes any that haven't started.
+                cancel_query(result.query_id)
         except:
             response['msg'] = "ERROR"
         return JsonResponse(response)
@@ -227,7 +230,7 @@ def get_result(request):
             else:
                 response['msg'] = "WAIT"
                 response['result'] = {
-                    'total_scenes': result.total_scenes, 'scenes_processed': result.scenes_processed}
+                    'total_scenes': result.total_scenes, 'scenes_processed': get_progress(result.query_id)}
         return JsonResponse(response)
     return JsonResponse({'msg': "ERROR"})
 
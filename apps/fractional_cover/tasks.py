@@ -21,8 +21,11 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, Metadata
+from apps.custom_mosaic_tool.models import Query as cm_query, Result as cm_result, Metadata as cm_metadata
 
 import numpy as np
 import math
@@ -39,10 +42,18 @@ from dateutil.tz import tzutc
 
 from utils.data_access_api import DataAccessApi
 from utils.dc_mosaic import create_mosaic, create_median_mosaic, create_max_ndvi_mosaic, create_min_ndvi_mosaic
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask
 from utils.dc_fractional_coverage_classifier import frac_coverage_classify
 
 from data_cube_ui.utils import update_model_bounds_with_dataset, map_ranges
+from data_cube_ui.reduction import fill_nodata, create_output_grid, fold_chunk, load_accumulated_product, get_nodata_fraction, is_tile_filled
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.histogram_median import StreamingMedian, count_cf_mask, create_cf_mask
+from data_cube_ui.tiling import plan_tiles, get_tile_size
+from data_cube_ui.chunk_cache import is_cache_enabled, get_chunk_key, load_chunk, store_chunk
+from data_cube_ui.block_cache import get_cached_dataset
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 """
 Class for handling loading celery workers to perform tasks asynchronously.
@@ -63,45 +74,41 @@ dc = None
 
 #default measurements. leaves out all qa bands.
 measurements = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'cf_mask']
+# bands produced by frac_coverage_classify.
+fractional_cover_bands = ['bs', 'pv', 'npv']
 
 """
 functions used to combine time sliced data after being combined geographically.
-Fill nodata uses the first timeslice as a base, then uses subsequent slices to
+Fill nodata (shared, in data_cube_ui.reduction) uses the first timeslice as a base, then uses subsequent slices to
 fill in indices with nodata values.
 this should be used for recent/leastrecent + anything that is done in a single time chunk (median pixel?)
 things like max/min ndvi should be able to compound max/min ops between ddifferent timeslices so this will be
 different for that.
 """
-def fill_nodata(dataset, dataset_intermediate):
-    if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset_out[key].values==-9999] = dataset[key].values[dataset_out[key].values==-9999]
-    return dataset_out
-
 def max_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values > dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values > dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values > dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 def min_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values < dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values < dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values < dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 #holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
 # process disregard it.
+# nodata_threshold lets fill_nodata mosaics stop loading scenes once no more than that fraction of pixels are nodata.
+# median_radix_bits makes the chunk build an exact median from per pixel histograms - see StreamingMedian. plan_chunks
+# turns it off when holding every acquisition for processing_method takes less memory.
 #experimentally optimized geo/time/slices_per_iter
 processing_algorithms = {
     'most_recent': {
@@ -110,6 +117,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': True,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': 0.0,
+        'median_radix_bits': None,
         'processing_method': create_mosaic
     },
     'least_recent': {
@@ -118,6 +127,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 1,
         'reverse_time': False,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': 0.0,
+        'median_radix_bits': None,
         'processing_method': create_mosaic
     },
     'max_ndvi': {
@@ -126,6 +137,8 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': max_value,
+        'nodata_threshold': None,
+        'median_radix_bits': None,
         'processing_method': create_max_ndvi_mosaic
     },
     'min_ndvi': {
@@ -134,14 +147,18 @@ processing_algorithms = {
         'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': min_value,
+        'nodata_threshold': None,
+        'median_radix_bits': None,
         'processing_method': create_min_ndvi_mosaic
     },
     'median_pixel': {
-        'geo_chunk_size': 0.01,
+        'geo_chunk_size': 0.5,
         'time_chunks': None,
-        'time_slices_per_iteration': None,
+        'time_slices_per_iteration': 5,
         'reverse_time': False,
         'chunk_combination_method': fill_nodata,
+        'nodata_threshold': None,
+        'median_radix_bits': 8,
         'processing_method': create_median_mosaic
     },
 }
@@ -187,6 +204,15 @@ def create_fractional_cover(query_id, user_id, single=False):
     # wrapping this in a try/catch, as it will throw a few different errors
     # having to do with memory etc.
     try:
+        # an identical custom mosaic already has everything but the classification, so skip the data load.
+        custom_mosaic = load_custom_mosaic(query)
+        if custom_mosaic is not None:
+            print("Using custom mosaic result.")
+            dataset_out_mosaic, acquisition_metadata, total_scenes = custom_mosaic
+            dataset_out_fractional_cover = classify_mosaic(dataset_out_mosaic)
+            create_fractional_cover_results(query, result, dataset_out_mosaic, dataset_out_fractional_cover, acquisition_metadata, total_scenes, product_details.resolution.values[0])
+            return
+
         # lists all acquisition dates for use in single tmeslice queries.
         acquisitions = dc.list_acquisition_dates(query.platform, query.product, time=(query.time_start, query.time_end), longitude=(
             query.longitude_min, query.longitude_max), latitude=(query.latitude_min, query.latitude_max))
@@ -195,18 +221,24 @@ def create_fractional_cover(query_id, user_id, single=False):
             error_with_message(result, "There were no acquisitions for this parameter set.")
             return
 
-        processing_options = processing_algorithms[query.compositor]
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms[query.compositor]
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(acquisitions))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
         # Reversed time = True will make it so most recent = First, oldest = Last.
         #default is in order from oldest -> newwest.
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details))
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
         # ensures that the start and end are both valid.
@@ -216,129 +248,105 @@ def create_fractional_cover(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid that the chunks write their results directly into. The fractional cover
+        # bands are folded in with the mosaic so each pixel's cover comes from the same mosaic pixel.
+        create_output_grid(base_temp_path + query.query_id, 'mosaic', latitude=(query.latitude_min, query.latitude_max),
+                           longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
-        # iterate over the time chunks.
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
+
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
+        # iterate over the time chunks.
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_fractional_cover_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
-            time_chunk_tasks.append(geo_chunk_tasks)
+                chunk_tasks.append(generate_fractional_cover_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
+
+        combination_task = combine_fractional_cover_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                             acquisitions=acquisitions, resolution=product_details.resolution.values[0])
+        combination_task.link_error(fractional_cover_chunk_failure.s(query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_fractional_cover_chunks")
+def combine_fractional_cover_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, resolution=None):
+    """
+    Chord callback for create_fractional_cover. Receives the results of every generate_fractional_cover_chunk task
+    ordered by time chunk then geographic chunk, combines them into the final fractional cover product and
+    creates the result files.
 
-        # holds some acquisition based metadata. dict of objs keyed by date
-        dataset_out_mosaic = None
-        dataset_out_fractional_cover = None
+    Args:
+        chunk_results (list): The lists of paths and metadata returned by generate_fractional_cover_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_query(query_id)
+        return
+
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_query(query_id)
+            return
+
+        # each chunk has already been folded into the accumulators for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is a list of paths followed by the metadata.
         acquisition_metadata = {}
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                # tile is [path, metadata]. Append tiles to list of tiles for concat, compile metadata.
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
-                    return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles_mosaic = []
-            xr_tiles_fractional_cover = []
-            for tile in tiles:
-                tile_metadata = tile[2]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
-                xr_tiles_mosaic.append(xr.open_dataset(tile[0]))
-                xr_tiles_fractional_cover.append(xr.open_dataset(tile[1]))
-            #create cf mosaic
-            full_dataset_mosaic = xr.concat(reversed(xr_tiles_mosaic), dim='latitude')
-            dataset_mosaic = full_dataset_mosaic.load()
-            dataset_out_mosaic = processing_options['chunk_combination_method'](dataset_mosaic, dataset_out_mosaic)
-            #now frac.
-            full_dataset_fractional_cover = xr.concat(reversed(xr_tiles_fractional_cover), dim='latitude')
-            dataset_fractional_cover = full_dataset_fractional_cover.load()
-            dataset_out_fractional_cover = processing_options['chunk_combination_method'](dataset_fractional_cover, dataset_out_fractional_cover)
-
-        latitude = dataset_out_mosaic.latitude
-        longitude = dataset_out_mosaic.longitude
-
-        # grabs the resolution.
-        geotransform = [longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, latitude.values[0], 0.0, product_details.resolution.values[0][0]]
-        #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
-        crs = str("EPSG:4326")
+        for tile in chunk_results:
+            if tile is None or tile[0] is None:
+                continue
+            tile_metadata = tile[-1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date in acquisition_metadata:
+                    acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
+                else:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        dataset_out = load_accumulated_product(base_temp_path + query.query_id, 'mosaic')
+        dataset_out_mosaic = dataset_out.drop(fractional_cover_bands)
+        dataset_out_fractional_cover = dataset_out.drop([key for key in dataset_out.data_vars if key not in fractional_cover_bands])
 
         # remove intermediates
         shutil.rmtree(base_temp_path + query.query_id)
 
-        # populate metadata values.
-        dates = list(acquisition_metadata.keys())
-        dates.sort()
-
-        meta = query.generate_metadata(
-            scene_count=len(dates), pixel_count=len(latitude)*len(longitude))
-
-        for date in reversed(dates):
-            meta.acquisition_list += date.strftime("%m/%d/%Y") + ","
-            meta.clean_pixels_per_acquisition += str(
-                acquisition_metadata[date]['clean_pixels']) + ","
-            meta.clean_pixel_percentages_per_acquisition += str(
-                acquisition_metadata[date]['clean_pixels'] * 100 / meta.pixel_count) + ","
-
-        # Count clean pixels and correct for the number of measurements.
-        clean_pixels = np.sum(dataset_out_mosaic[measurements[0]].values != -9999)
-        meta.clean_pixel_count = clean_pixels
-        meta.percentage_clean_pixels = (meta.clean_pixel_count / meta.pixel_count) * 100
-        meta.save()
-
-        # generate all the results
-        file_path = base_result_path + query_id
-        tif_path = file_path + '.tif'
-        netcdf_path = file_path + '.nc'
-        mosaic_png_path = file_path + '_mosaic.png'
-        fractional_cover_png_path = file_path + "_fractional_cover.png"
-
-        print("Creating query results.")
-        #Mosaic
-        save_to_geotiff(tif_path, gdal.GDT_Int16, dataset_out_mosaic, geotransform, get_spatial_ref(crs),
-                        x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
-                        band_order=['blue', 'green', 'red', 'nir', 'swir1', 'swir2'])
-        # we've got the tif, now do the png. -> RGB
-        bands = [3, 2, 1]
-        create_rgb_png_from_tiff(tif_path, mosaic_png_path, png_filled_path=None, fill_color=None, bands=bands, scale=(0, 4096))
-
-        #fractional_cover
-        dataset_out_fractional_cover.to_netcdf(netcdf_path)
-        save_to_geotiff(tif_path, gdal.GDT_Int32, dataset_out_fractional_cover, geotransform, get_spatial_ref(crs),
-                        x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
-                        band_order=['bs', 'pv', 'npv'])
-        create_rgb_png_from_tiff(tif_path, fractional_cover_png_path, png_filled_path=None, fill_color=None, scale=None, bands=[1,2,3])
-
-        # update the results and finish up.
-        update_model_bounds_with_dataset([result, meta, query], dataset_out_mosaic)
-        result.result_mosaic_path = mosaic_png_path
-        result.result_path = fractional_cover_png_path
-        result.data_path = tif_path
-        result.data_netcdf_path = netcdf_path
-        result.status = "OK"
-        result.total_scenes = len(acquisitions)
-        result.save()
-        print("Finished processing results")
-        # all data has been processed, create results and finish up.
-        query.complete = True
-        query.query_end = datetime.datetime.now()
-        query.save()
+        create_fractional_cover_results(query, result, dataset_out_mosaic, dataset_out_fractional_cover, acquisition_metadata, len(acquisitions), resolution)
+        clear_query(query_id)
     except:
         error_with_message(
             result, "There was an exception when handling this query.")
@@ -346,6 +354,136 @@ def create_fractional_cover(query_id, user_id, single=False):
     # end error wrapping.
     return
 
+def create_fractional_cover_results(query, result, dataset_out_mosaic, dataset_out_fractional_cover, acquisition_metadata, total_scenes, resolution):
+    """
+    Creates the metadata and result files for a fractional cover query and marks it complete. Used
+    for both chunked queries and queries classified from an existing custom mosaic.
+
+    Args:
+        query (Query): The fractional cover query.
+        result (Result): The result for the query.
+        dataset_out_mosaic (Dataset): The combined mosaic.
+        dataset_out_fractional_cover (Dataset): The fractional cover classification of the mosaic.
+        acquisition_metadata (dict): acquisition date keyed clean_pixels.
+        total_scenes (int): The number of acquisitions used for the mosaic.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+    """
+    latitude = dataset_out_mosaic.latitude
+    longitude = dataset_out_mosaic.longitude
+
+    # grabs the resolution.
+    geotransform = [longitude.values[0], resolution[1],
+                    0.0, latitude.values[0], 0.0, resolution[0]]
+    #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
+    crs = str("EPSG:4326")
+
+    # populate metadata values.
+    dates = list(acquisition_metadata.keys())
+    dates.sort()
+
+    meta = query.generate_metadata(
+        scene_count=len(dates), pixel_count=len(latitude)*len(longitude))
+
+    for date in reversed(dates):
+        meta.acquisition_list += date.strftime("%m/%d/%Y") + ","
+        meta.clean_pixels_per_acquisition += str(
+            acquisition_metadata[date]['clean_pixels']) + ","
+        meta.clean_pixel_percentages_per_acquisition += str(
+            acquisition_metadata[date]['clean_pixels'] * 100 / meta.pixel_count) + ","
+
+    # Count clean pixels and correct for the number of measurements.
+    clean_pixels = np.sum(dataset_out_mosaic[measurements[0]].values != -9999)
+    meta.clean_pixel_count = clean_pixels
+    meta.percentage_clean_pixels = (meta.clean_pixel_count / meta.pixel_count) * 100
+    meta.save()
+
+    # generate all the results
+    file_path = base_result_path + query.query_id
+    tif_path = file_path + '.tif'
+    netcdf_path = file_path + '.nc'
+    mosaic_png_path = file_path + '_mosaic.png'
+    fractional_cover_png_path = file_path + "_fractional_cover.png"
+
+    print("Creating query results.")
+    #Mosaic
+    save_to_geotiff(tif_path, gdal.GDT_Int16, dataset_out_mosaic, geotransform, get_spatial_ref(crs),
+                    x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
+                    band_order=['blue', 'green', 'red', 'nir', 'swir1', 'swir2'])
+    # we've got the tif, now do the png. -> RGB
+    bands = [3, 2, 1]
+    create_rgb_png_from_tiff(tif_path, mosaic_png_path, png_filled_path=None, fill_color=None, bands=bands, scale=(0, 4096))
+
+    #fractional_cover
+    dataset_out_fractional_cover.to_netcdf(netcdf_path)
+    save_to_geotiff(tif_path, gdal.GDT_Int32, dataset_out_fractional_cover, geotransform, get_spatial_ref(crs),
+                    x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
+                    band_order=fractional_cover_bands)
+    create_rgb_png_from_tiff(tif_path, fractional_cover_png_path, png_filled_path=None, fill_color=None, scale=None, bands=[1,2,3])
+
+    # update the results and finish up.
+    update_model_bounds_with_dataset([result, meta, query], dataset_out_mosaic)
+    result.result_mosaic_path = mosaic_png_path
+    result.result_path = fractional_cover_png_path
+    result.data_path = tif_path
+    result.data_netcdf_path = netcdf_path
+    result.status = "OK"
+    result.total_scenes = total_scenes
+    result.save()
+    print("Finished processing results")
+    # all data has been processed, create results and finish up.
+    query.complete = True
+    query.query_end = datetime.datetime.now()
+    query.save()
+
+def classify_mosaic(mosaic):
+    """
+    Computes fractional cover for a mosaic, masking out clouds and water as the classifier requires.
+
+    Args:
+        mosaic (Dataset): A mosaic including the cf_mask band.
+
+    Returns:
+        Dataset: bs, pv, and npv bands for the mosaic.
+    """
+    clear_mask = create_cfmask_clean_mask(mosaic.cf_mask)
+    # mask out water manually. Necessary for frac. cover.
+    clear_mask[mosaic.cf_mask.values==1] = False
+    return frac_coverage_classify(mosaic, clean_mask=clear_mask)
+
+def load_custom_mosaic(query):
+    """
+    Finds a completed custom mosaic with the same area, time, product, and compositor as a fractional
+    cover query and loads its mosaic. The mosaic tool's query type and animation only change its
+    images, so any of them will do.
+
+    Args:
+        query (Query): The fractional cover query.
+
+    Returns:
+        (mosaic, acquisition_metadata, total_scenes) for the custom mosaic, or None if there isn't one
+        on disk.
+    """
+    mosaic_queries = cm_query.objects.filter(time_start=query.time_start, time_end=query.time_end, latitude_max=query.latitude_max, latitude_min=query.latitude_min,
+                                             longitude_max=query.longitude_max, longitude_min=query.longitude_min, platform=query.platform, product=query.product,
+                                             compositor=query.compositor, complete=True)
+    for mosaic_query in mosaic_queries:
+        mosaic_result = cm_result.objects.filter(query_id=mosaic_query.query_id, status="OK").first()
+        mosaic_meta = cm_metadata.objects.filter(query_id=mosaic_query.query_id).first()
+        if mosaic_result is None or mosaic_meta is None or not os.path.exists(mosaic_result.data_netcdf_path):
+            continue
+        with xr.open_dataset(mosaic_result.data_netcdf_path) as mosaic:
+            mosaic.load()
+        if "cf_mask" not in mosaic:
+            continue
+        # the mosaic tool stores its acquisition metadata as comma separated strings.
+        acquisition_metadata = {}
+        for date, clean_pixels in zip(mosaic_meta.acquisition_list_as_list(), mosaic_meta.clean_pixels_list_as_list()):
+            if date == "":
+                continue
+            acquisition_metadata[datetime.datetime.strptime(date, "%m/%d/%Y")] = {'clean_pixels': int(clean_pixels)}
+        return mosaic, acquisition_metadata, mosaic_result.total_scenes
+    return None
+
 @task(name="generate_fractional_cover_chunk")
 def generate_fractional_cover_chunk(time_num, chunk_num, processing_options=None, query=None, acquisition_list=None, lat_range=None, lon_range=None, measurements=None):
     """
@@ -354,20 +492,38 @@ def generate_fractional_cover_chunk(time_num, chunk_num, processing_options=None
     saves the result to disk using time/chunk num, and returns the path and the acquisition date keyed metadata.
     """
     time_index = 0
+    # most/least recent mosaics can't change once every pixel is filled, so they stop loading scenes early.
+    early_termination = processing_options['nodata_threshold'] is not None
     iteration_data = None
+    # median_pixel builds the median from histograms, reading the acquisitions once per pass.
+    median = StreamingMedian(processing_options['median_radix_bits'], qa_band='cf_mask') if processing_options['median_radix_bits'] is not None else None
     acquisition_metadata = {}
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    cache_key = None
+    if is_cache_enabled():
+        cache_key = get_chunk_key(query.product, "fractional_cover." + query.compositor, lat_range, lon_range, acquisition_list, measurements=measurements)
+        cached = load_chunk(cache_key)
+        if cached is not None:
+            print("Using cached chunk: " + str(time_num) + " " + str(chunk_num))
+            cached_products, acquisition_metadata = cached
+            geo_path = fold_chunk(cached_products['mosaic'].merge(cached_products['fractional_cover']), base_temp_path + query.query_id, 'mosaic', chunk_num, time_num,
+                                  processing_options['chunk_combination_method'], nodata_threshold=processing_options['nodata_threshold'])
+            increment_progress(query.query_id)
+            return [geo_path, acquisition_metadata]
     # holds some acquisition based metadata.
-    while time_index < len(acquisition_list):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return
-        if result.status == "CANCEL":
+    while time_index < len(acquisition_list) or (median is not None and median.next_pass()):
+        if time_index >= len(acquisition_list):
+            time_index = 0
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
+        # lower time chunks have already filled this tile, so nothing loaded here would be used.
+        if early_termination and is_tile_filled(base_temp_path + query.query_id, 'mosaic', chunk_num, time_num):
+            print("Tile filled by earlier time chunks, stopping.")
+            # the result is incomplete so it can't be cached.
+            cache_key = None
+            break
 
         # time ranges set based on if the acquisition_list has been reversed or not. If it has, then the 'start' index is the later date, and must be handled appropriately.
         start = acquisition_list[time_index] + datetime.timedelta(seconds=1) if processing_options['reverse_time'] else acquisition_list[time_index]
@@ -377,13 +533,28 @@ def generate_fractional_cover_chunk(time_num, chunk_num, processing_options=None
             end = acquisition_list[-1] if processing_options['reverse_time'] else acquisition_list[-1] + datetime.timedelta(seconds=1)
         time_range = (end, start) if processing_options['reverse_time'] else (start, end)
 
-        raw_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
+        raw_data = get_cached_dataset(dc, query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
 
         if "cf_mask" not in raw_data:
             time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
             continue
         clear_mask = create_cfmask_clean_mask(raw_data.cf_mask)
 
+        if median is not None:
+            median.add(raw_data, clear_mask)
+            # the metadata is only collected on the first pass.
+            if median.pass_index > 0:
+                time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
+                continue
+        elif query.compositor == "median_pixel":
+            # a median of the cf_mask is meaningless, so it's summarized for the classifier instead.
+            iteration_data = processing_options['processing_method'](
+                raw_data.drop('cf_mask'), clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
+            iteration_data['cf_mask'] = (('latitude', 'longitude'), create_cf_mask(*count_cf_mask(raw_data.cf_mask.values, clear_mask)))
+        else:
+            iteration_data = processing_options['processing_method'](
+                raw_data, clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
+
         # update metadata. # here the clear mask has all the clean
         # pixels for each acquisition.
         for timeslice in range(clear_mask.shape[0]):
@@ -401,29 +572,51 @@ def generate_fractional_cover_chunk(time_num, chunk_num, processing_options=None
         # the correct format w/ nodata values for mosaicing.
         # raw_data = raw_data.drop('cf_mask')
 
-        iteration_data = processing_options['processing_method'](
-            raw_data, clean_mask=clear_mask, intermediate_product=iteration_data, reverse_time=processing_options['reverse_time'])
+        if early_termination and get_nodata_fraction(iteration_data[measurements[0]]) <= processing_options['nodata_threshold']:
+            print("Mosaic filled, stopping.")
+            break
+
         time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
 
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
-    fractional_cover_path = base_temp_path + query.query_id + "/geo_chunk_fractional_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
+    if median is not None:
+        iteration_data = median.get_result()
     # if this is an empty chunk, just return an empty dataset.
     if iteration_data is None:
-        return [None, None, None]
-    iteration_data.to_netcdf(geo_path)
-    ##################################################################
-    # Compute fractional cover here.
-    clear_mask = create_cfmask_clean_mask(iteration_data.cf_mask)
-    # mask out water manually. Necessary for frac. cover.
-    clear_mask[iteration_data.cf_mask.values==1] = False
-    fractional_cover = frac_coverage_classify(iteration_data, clean_mask=clear_mask)
-    ##################################################################
-    fractional_cover.to_netcdf(fractional_cover_path)
+        increment_progress(query.query_id)
+        return [None, None]
+    fractional_cover = classify_mosaic(iteration_data)
+    # fold this geographic chunk into the accumulated product as soon as it's done. The combination methods pick
+    # pixels by the mosaic bands (e.g. ndvi), so the cover bands go along with the mosaic pixel they came from.
+    geo_path = fold_chunk(iteration_data.merge(fractional_cover), base_temp_path + query.query_id, 'mosaic', chunk_num, time_num, processing_options['chunk_combination_method'],
+                          nodata_threshold=processing_options['nodata_threshold'])
+    if cache_key is not None:
+        store_chunk(cache_key, {'mosaic': iteration_data, 'fractional_cover': fractional_cover}, acquisition_metadata)
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
-    return [geo_path, fractional_cover_path, acquisition_metadata]
+    increment_progress(query.query_id)
+    return [geo_path, acquisition_metadata]
+
+@task(name="fractional_cover_chunk_failure")
+def fractional_cover_chunk_failure(task_id, query_id):
+    """
+    Error callback for the combine_fractional_cover_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_fractional_cover_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_query(query_id)
+    elif result is not None:
+        error_with_message(result, "There was an exception when handling this query.")
 
 def error_with_message(result, message):
     """
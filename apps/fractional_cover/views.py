@@ -33,6 +33,7 @@ from .models import Result, Query, Metadata
 from .forms import DataSelectForm
 from data_cube_ui.forms import GeospatialForm
 from .tasks import create_fractional_cover
+from data_cube_ui.task_control import cancel_query, get_progress
 from data_cube_ui.models import Satellite, Area, Application
 
 from .utils import create_query_from_post
@@ -182,6 +183,8 @@ def cancel_request(request):
             if result.status == "WAIT" and query.complete == False:
                 result.status = "CANCEL"
                 result.save()
+                # signals the chunks to stop and revokes any that haven't started.
+                cancel_query(result.query_id)
         except:
             response['msg'] = "ERROR"
         return JsonResponse(response)
@@ -226,7 +229,7 @@ def get_result(request):
             else:
                 response['msg'] = "WAIT"
                 response['result'] = {
-                    'total_scenes': result.total_scenes, 'scenes_processed': result.scenes_processed}
+                    'total_scenes': result.total_scenes, 'scenes_processed': get_progress(result.query_id)}
         return JsonResponse(response)
     return JsonResponse({'msg': "ERROR"})
 
@@ -46,6 +46,7 @@ class DataSelectForm(forms.Form):
         band_selection
         title
         description
+        baseline_method
     """
 
     title = forms.CharField(widget=forms.HiddenInput())
@@ -55,6 +56,9 @@ class DataSelectForm(forms.Form):
     #index+1 so jan==1
     months_sel = [(index+1, month) for index, month in enumerate(months)]
     baseline_selection = forms.MultipleChoiceField(help_text='Select the month(s) that will be used to create the baseline. Scenes from the selected months that occur before the selected scene will be used to form a baseline.', label="Baseline Period:", choices=months_sel, widget=forms.SelectMultiple(attrs={'class': 'field-long tooltipped'}))
+    #keys of processing_algorithms in tasks.py
+    baseline_method_sel = [('median', "Median"), ('mean', "Mean")]
+    baseline_method = forms.ChoiceField(help_text='Select the method by which the baseline will be created. The mean can be built from stored monthly summaries and is faster for long baselines.', label="Baseline Method:", choices=baseline_method_sel, widget=forms.Select(attrs={'class': 'field-long tooltipped'}))
 
 class GeospatialForm(GeospatialFormBase):
     def __init__(self, acquisition_list=None, *args, **kwargs):
@@ -62,4 +66,4 @@ class GeospatialForm(GeospatialFormBase):
         self.fields.pop('time_start')
         self.fields.pop('time_end')
         scene_sel = [(str(index)+"-"+date.strftime("%Y/%m/%d %H:%M UTC"), date.strftime("%Y/%m/%d %H:%M UTC")) for index, date in enumerate(acquisition_list)]
-        self.fields['scene_selection'] = forms.ChoiceField(help_text='Select a scene to perform NDVI differencing on.', label="Scene Selection:", choices=scene_sel, widget=forms.Select(attrs={'class': 'field-long tooltipped'}))
+        self.fields['scene_selection'] = forms.MultipleChoiceField(help_text='Select the scene(s) to perform NDVI differencing on. Every scene is compared against the baseline formed before it.', label="Scene Selection:", choices=scene_sel, widget=forms.SelectMultiple(attrs={'class': 'field-long tooltipped'}))
@@ -41,8 +41,9 @@ class Query(BaseQuery):
     submitted.
     """
 
-    #baseline is a comma seperated list of months, indexed starting from 1.
+    #baseline_method is a key of processing_algorithms in tasks.py.
     baseline_method = models.CharField(max_length=50, default="median")
+    #baseline is a comma seperated list of months, indexed starting from 1.
     baseline = models.CharField(max_length=50, default="1,2,3,4,5,6,7,8,9,10,11,12")
     #comma seperated index values for scene dates.
     #overriding the base class start/end times. Only start time is used,
@@ -66,7 +67,7 @@ class Query(BaseQuery):
             query_id (string): The ID of the query built up by object attributes.
         """
         query_id = self.time_start + '-' + str(self.latitude_max) + '-' + str(
-            self.latitude_min) + '-' + str(self.longitude_max) + '-' + str(self.longitude_min) + '-' + self.baseline + '-' + self.platform + '-' + self.product
+            self.latitude_min) + '-' + str(self.longitude_max) + '-' + str(self.longitude_min) + '-' + self.baseline + '-' + self.baseline_method + '-' + self.platform + '-' + self.product
         return query_id
 
     def generate_metadata(self, scene_count=0, pixel_count=0):
@@ -75,6 +76,16 @@ class Query(BaseQuery):
         meta.save()
         return meta
 
+    def get_scene_results(self):
+        """
+        Gets the results of every selected scene from the query's result.
+
+        Returns:
+            list: see Result.get_scene_results, empty if there is no result yet.
+        """
+        result = Result.objects.filter(query_id=self.query_id).first()
+        return result.get_scene_results() if result is not None else []
+
     def generate_result(self):
         result = Result(query_id=self.query_id, result_path="", data_path="", latitude_min=self.latitude_min,
                         latitude_max=self.latitude_max, longitude_min=self.longitude_min, longitude_max=self.longitude_max, total_scenes=0, scenes_processed=0, status="WAIT")
@@ -111,3 +122,33 @@ class Result(BaseResult):
     result_mosaic_path = models.CharField(max_length=250, default="")
     data_netcdf_path = models.CharField(max_length=250, default="")
     data_path = models.CharField(max_length=250, default="")
+
+    # every selected scene has its own results, the paths above are the first scene's.
+    # comma seperated lists with an entry per scene, oldest first.
+    scene_list = models.CharField(max_length=100000, default="")
+    result_path_list = models.CharField(max_length=100000, default="")
+    scene_ndvi_path_list = models.CharField(max_length=100000, default="")
+    baseline_ndvi_path_list = models.CharField(max_length=100000, default="")
+    ndvi_percentage_change_path_list = models.CharField(max_length=100000, default="")
+    result_mosaic_path_list = models.CharField(max_length=100000, default="")
+    data_netcdf_path_list = models.CharField(max_length=100000, default="")
+    data_path_list = models.CharField(max_length=100000, default="")
+
+    def get_scene_results(self):
+        """
+        Gets the results of every selected scene.
+
+        Returns:
+            list: a dict per scene with the scene date and the result_path, scene_ndvi_path, baseline_ndvi_path,
+                ndvi_percentage_change_path, result_mosaic_path, data_netcdf_path and data_path of that scene.
+        """
+        if self.scene_list == "":
+            return []
+        fields = ['result_path', 'scene_ndvi_path', 'baseline_ndvi_path', 'ndvi_percentage_change_path', 'result_mosaic_path', 'data_netcdf_path', 'data_path']
+        paths = [getattr(self, field + '_list').rstrip(',').split(',') for field in fields]
+        scene_results = []
+        for index, scene in enumerate(self.scene_list.rstrip(',').split(',')):
+            scene_result = {field: paths[field_index][index] for field_index, field in enumerate(fields)}
+            scene_result['scene'] = scene
+            scene_results.append(scene_result)
+        return scene_results
@@ -21,8 +21,11 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, Metadata
+from data_cube_ui.models import Application
 
 import numpy as np
 import math
@@ -39,11 +42,18 @@ from dateutil.tz import tzutc
 
 from utils.data_access_api import DataAccessApi
 from utils.dc_mosaic import create_mosaic
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask
 from utils.dc_baseline import generate_baseline
 from utils.dc_demutils import create_slope_mask
 from utils.dc_water_classifier import wofs_classify
 from data_cube_ui.utils import update_model_bounds_with_dataset, map_ranges
+from data_cube_ui.reduction import fill_nodata, create_output_grid, fold_chunk, load_accumulated_product
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.tiling import plan_tiles, get_tile_size
+from data_cube_ui.streaming_stats import get_moments, merge_moments, get_mean
+from data_cube_ui.summary_store import get_summary_key, load_summary, save_summary
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 """
 Class for handling loading celery workers to perform tasks asynchronously.
@@ -68,26 +78,18 @@ dc = None
 #default measurements. leaves out all qa bands.
 measurements = ['red', 'nir', 'cf_mask']
 
-"""
-functions used to combine time sliced data after being combined geographically.
-Fill nodata uses the first timeslice as a base, then uses subsequent slices to
-fill in indices with nodata values.
-this should be used for recent/leastrecent + anything that is done in a single time chunk (median pixel?)
-things like max/min ndvi should be able to compound max/min ops between ddifferent timeslices so this will be
-different for that.
-"""
-def fill_nodata(dataset, dataset_intermediate):
-    if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset_out[key].values==-9999] = dataset[key].values[dataset_out[key].values==-9999]
-    return dataset_out
-
-#holds the different compositing algorithms. median, mean, mosaic?
+# acquisitions closer together than this are loaded with a single request.
+load_window_gap = datetime.timedelta(days=32)
+
+#holds the different baseline algorithms, keyed by the query's baseline_method.
 # all options are required. setting None to a option will have the algo/task splitting
 # process disregard it.
+# baseline_combination_method folds the baseline of each time chunk together - the mean is built
+# from mergeable moments so it can be split over time chunks, the median needs every scene at once.
+# climatology is the size in square degrees of the tiles that the moments of every month are kept
+# for in the summary store, so they only have to be computed once - only the mean can be built from
+# them. The geographic chunks are those tiles and the time chunks are a year each, so chunks line up
+# with the summaries that update_ndvi_climatology maintains in the background.
 #experimentally optimized geo/time/slices_per_iter
 processing_algorithms = {
     'median': {
@@ -96,8 +98,20 @@ processing_algorithms = {
         'time_slices_per_iteration': None,
         'reverse_time': True,
         'chunk_combination_method': fill_nodata,
+        'baseline_combination_method': fill_nodata,
+        'climatology': None,
         'processing_method': 'median'
     },
+    'mean': {
+        'geo_chunk_size': 0.5,
+        'time_chunks': 5,
+        'time_slices_per_iteration': 5,
+        'reverse_time': True,
+        'chunk_combination_method': fill_nodata,
+        'baseline_combination_method': merge_moments,
+        'climatology': 0.5,
+        'processing_method': 'mean'
+    },
 }
 
 @task(name="ndvi_anomaly_task")
@@ -142,35 +156,47 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
     # having to do with memory etc.
     try:
         #selected scenes are indices in acquisitions, baseline months are 1-12 jan-dec.
-        selected_scenes = [int(val) for val in query.time_start.split(',')]
+        selected_scenes = sorted(set([int(val) for val in query.time_start.split(',')]))
         baseline_months = [int(val) for val in query.baseline.split(',')]
         # lists all acquisition dates for use in single tmeslice queries.
         acquisitions = dc.list_acquisition_dates(query.platform, query.product)
 
-        # we will later iterate through chosen scenes.
-        #for scene in selected_scene:
-        scene = selected_scenes[0]
-        baseline_scenes_base = acquisitions[0:scene]
+        # every selected scene is computed against the same baseline load - the baseline acquisitions
+        # are everything before the latest scene, and each scene only uses the ones that precede it.
+        baseline_scenes_base = acquisitions[0:selected_scenes[-1]]
         #can I use pandas/dfs to do a 'groupby' on month?
         baseline_scenes = [baseline_scene for baseline_scene in baseline_scenes_base if baseline_scene.month in baseline_months]
-        if len(baseline_scenes_base) < 1:
+        if len(acquisitions[0:selected_scenes[0]]) < 1:
             error_with_message(result, "Insufficient scene count for baseline length.")
             return
-        #scene of interest being appended before processing: this is the MOST RECENT scene, e.g. index 0 after processing.
-        baseline_scenes.append(acquisitions[scene])
+        # no baseline means no chunks run at all, which would otherwise be reported as no overlap.
+        if len(baseline_scenes) < 1:
+            error_with_message(result, "There are no scenes in the selected baseline months before the selected scenes.")
+            return
+        # the scenes of interest are passed to the chunks seperately - the baseline can be split over time chunks.
+        selected_scenes = [acquisitions[scene] for scene in selected_scenes]
 
-        processing_options = processing_algorithms['median']
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms[query.baseline_method]
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(baseline_scenes))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        # the climatology is stored per tile, so chunks have to be the same tiles to read it.
+        if algorithm['climatology'] is not None:
+            overrides['geo_chunk_size'] = algorithm['climatology']
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
         # Reversed time = True will make it so most recent = First, oldest = Last.
         #default is in order from oldest -> newwest.
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=baseline_scenes, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=baseline_scenes, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details), group_by_year=processing_options['climatology'] is not None)
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
         # ensures that the start and end are both valid.
@@ -180,70 +206,175 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid(s) that the chunks write their results directly into, one set per selected scene.
+        for scene_index in range(len(selected_scenes)):
+            for product in ['mosaic', 'scene_ndvi', 'baseline']:
+                create_output_grid(base_temp_path + query.query_id, product + "_" + str(scene_index), latitude=(query.latitude_min, query.latitude_max),
+                                   longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
-        # iterate over the time chunks.
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
+
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
+        # iterate over the time chunks.
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_ndvi_anomaly_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
-            time_chunk_tasks.append(geo_chunk_tasks)
+                chunk_tasks.append(generate_ndvi_anomaly_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], selected_scenes=selected_scenes, lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
+
+        combination_task = combine_ndvi_anomaly_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                         acquisitions=acquisitions, selected_scenes=selected_scenes, resolution=product_details.resolution.values[0])
+        combination_task.link_error(ndvi_anomaly_chunk_failure.s(query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_ndvi_anomaly_chunks")
+def combine_ndvi_anomaly_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, selected_scenes=None, resolution=None):
+    """
+    Chord callback for create_ndvi_anomaly. Receives the results of every generate_ndvi_anomaly_chunk task
+    ordered by time chunk then geographic chunk, combines them into the final NDVI anomaly product and
+    creates the result files.
+
+    Args:
+        chunk_results (list): The lists of paths and metadata returned by generate_ndvi_anomaly_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        selected_scenes (list): The acquisition dates of the scenes to compute the anomaly for, oldest first.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_query(query_id)
+        return
+
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_query(query_id)
+            return
 
-        dataset_out_mosaic = None
-        dataset_out_ndvi = None
+        # each chunk has already been folded into the accumulators for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is a list of paths followed by the metadata.
         acquisition_metadata = {}
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
+        for tile in chunk_results:
+            if tile is None:
+                continue
+            tile_metadata = tile[-1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date in acquisition_metadata:
+                    acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
+                else:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        # every selected scene gets its own set of result files from the baseline it shares with the others.
+        # the first scene's files are the ones in the result model's paths, every scene is in its path lists.
+        scene_results = []
+        for scene_index in range(len(selected_scenes)):
+            dataset_out_mosaic = load_accumulated_product(base_temp_path + query.query_id, 'mosaic_' + str(scene_index))
+            dataset_out_scene = load_accumulated_product(base_temp_path + query.query_id, 'scene_ndvi_' + str(scene_index))
+            dataset_out_baseline = load_accumulated_product(base_temp_path + query.query_id, 'baseline_' + str(scene_index))
+            if dataset_out_mosaic is None or dataset_out_scene is None or dataset_out_baseline is None:
+                if scene_index == 0:
+                    error_with_message(result, "There is no overlap between the selected scene and your area.")
                     return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles_mosaic = []
-            xr_tiles_ndvi = []
-            for tile in tiles:
-                tile_metadata = tile[2]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels']}
-                xr_tiles_mosaic.append(xr.open_dataset(tile[0]))
-                xr_tiles_ndvi.append(xr.open_dataset(tile[1]))
-            if len(xr_tiles_mosaic) < 1:
-                error_with_message(result, "There is no overlap between the selected scene and your area.")
-                return
-            #create cf mosaic
-            full_dataset_mosaic = xr.concat(reversed(xr_tiles_mosaic), dim='latitude')
-            dataset_mosaic = full_dataset_mosaic.load()
-            dataset_out_mosaic = processing_options['chunk_combination_method'](dataset_mosaic, dataset_out_mosaic)
-
-            #now ndvi_anomaly.
-            full_dataset_ndvi = xr.concat(reversed(xr_tiles_ndvi), dim='latitude')
-            dataset_ndvi = full_dataset_ndvi.load()
-            dataset_out_ndvi = processing_options['chunk_combination_method'](dataset_ndvi, dataset_out_ndvi)
-
-        latitude = dataset_out_mosaic.latitude
-        longitude = dataset_out_mosaic.longitude
-
-        # grabs the resolution.
-        geotransform = [longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, latitude.values[0], 0.0, product_details.resolution.values[0][0]]
-        #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
-        crs = str("EPSG:4326")
+                print("No overlap for scene " + str(selected_scenes[scene_index]) + ", skipping.")
+                continue
+
+            # the baselines of every time chunk have been merged, so the anomaly can be computed.
+            dataset_out_scene, dataset_out_baseline = xr.align(dataset_out_scene, dataset_out_baseline, join='inner')
+            scene_ndvi = dataset_out_scene.scene_ndvi.where(dataset_out_scene.scene_ndvi != -9999)
+            if processing_options['processing_method'] == 'mean':
+                baseline_ndvi = get_mean(dataset_out_baseline)
+            else:
+                baseline_ndvi = dataset_out_baseline.baseline_ndvi.where(dataset_out_baseline.baseline_ndvi != -9999)
+            dataset_out_ndvi = xr.Dataset(OrderedDict([('scene_ndvi', scene_ndvi),
+                                                       ('baseline_ndvi', baseline_ndvi),
+                                                       ('ndvi_difference', scene_ndvi - baseline_ndvi),
+                                                       ('ndvi_percentage_change', (scene_ndvi - baseline_ndvi) / baseline_ndvi)]))
+            #convert to conventional nodata vals.
+            for key in list(dataset_out_ndvi.data_vars):
+                dataset_out_ndvi[key].values[~np.isfinite(dataset_out_ndvi[key].values)] = -9999
+
+            latitude = dataset_out_mosaic.latitude
+            longitude = dataset_out_mosaic.longitude
+
+            # grabs the resolution.
+            geotransform = [longitude.values[0], resolution[1],
+                            0.0, latitude.values[0], 0.0, resolution[0]]
+            #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
+            crs = str("EPSG:4326")
+
+            # generate all the results
+            file_path = base_result_path + query_id + ("" if scene_index == 0 else "_" + str(scene_index))
+            tif_path = file_path + '.tif'
+            netcdf_path = file_path + '.nc'
+            mosaic_png_path = file_path + '_mosaic.png'
+            result_paths = [file_path + '_ndvi.png', file_path + '_baseline_ndvi.png', file_path + "_ndvi_difference.png", file_path + "_ndvi_percentage_change.png"]
+
+            print("Creating query results for scene " + str(selected_scenes[scene_index]))
+            #Mosaic
+            save_to_geotiff(tif_path, gdal.GDT_Int16, dataset_out_mosaic, geotransform, get_spatial_ref(crs),
+                            x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
+                            band_order=['red', 'green', 'blue'])
+            # we've got the tif, now do the png. -> RGB
+            create_rgb_png_from_tiff(tif_path, mosaic_png_path, png_filled_path=None, fill_color=None, bands=[1,2,3], scale=(0, 4096))
+
+            #ndvi_anomaly
+            dataset_out_ndvi.to_netcdf(netcdf_path)
+            save_to_geotiff(tif_path, gdal.GDT_Float64, dataset_out_ndvi, geotransform, get_spatial_ref(crs),
+                            x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
+                            band_order=['scene_ndvi', 'baseline_ndvi', 'ndvi_difference', 'ndvi_percentage_change'])
+            # we've got the tif, now do the png set..
+            # uses gdal dem with custom color maps..
+            for index in range(len(color_paths)):
+                cmd = "gdaldem color-relief -of PNG -b " + \
+                    str(index + 1) + " " + tif_path + " " + \
+                    color_paths[index] + " " + result_paths[index]
+                os.system(cmd)
+            scene_results.append([dataset_out_mosaic, tif_path, netcdf_path, mosaic_png_path, result_paths])
+            result.scene_list += selected_scenes[scene_index].strftime("%m/%d/%Y") + ","
+            result.result_path_list += result_paths[2] + ","
+            result.scene_ndvi_path_list += result_paths[0] + ","
+            result.baseline_ndvi_path_list += result_paths[1] + ","
+            result.ndvi_percentage_change_path_list += result_paths[3] + ","
+            result.result_mosaic_path_list += mosaic_png_path + ","
+            result.data_netcdf_path_list += netcdf_path + ","
+            result.data_path_list += tif_path + ","
+
+        # the query's metadata and result model describe the first selected scene.
+        dataset_out_mosaic, tif_path, netcdf_path, mosaic_png_path, result_paths = scene_results[0]
 
         # remove intermediates
         shutil.rmtree(base_temp_path + query.query_id)
@@ -253,7 +384,7 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
         dates.sort()
 
         meta = query.generate_metadata(
-            scene_count=len(dates), pixel_count=len(latitude)*len(longitude))
+            scene_count=len(dates), pixel_count=len(dataset_out_mosaic.latitude)*len(dataset_out_mosaic.longitude))
 
         for date in reversed(dates):
             meta.acquisition_list += date.strftime("%m/%d/%Y") + ","
@@ -268,34 +399,6 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
         meta.percentage_clean_pixels = (meta.clean_pixel_count / meta.pixel_count) * 100
         meta.save()
 
-        # generate all the results
-        file_path = base_result_path + query_id
-        tif_path = file_path + '.tif'
-        netcdf_path = file_path + '.nc'
-        mosaic_png_path = file_path + '_mosaic.png'
-        result_paths = [file_path + '_ndvi.png', file_path + '_baseline_ndvi.png', file_path + "_ndvi_difference.png", file_path + "_ndvi_percentage_change.png"]
-
-        print("Creating query results.")
-        #Mosaic
-        save_to_geotiff(tif_path, gdal.GDT_Int16, dataset_out_mosaic, geotransform, get_spatial_ref(crs),
-                        x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
-                        band_order=['red', 'green', 'blue'])
-        # we've got the tif, now do the png. -> RGB
-        create_rgb_png_from_tiff(tif_path, mosaic_png_path, png_filled_path=None, fill_color=None, bands=[1,2,3], scale=(0, 4096))
-
-        #ndvi_anomaly
-        dataset_out_ndvi.to_netcdf(netcdf_path)
-        save_to_geotiff(tif_path, gdal.GDT_Float64, dataset_out_ndvi, geotransform, get_spatial_ref(crs),
-                        x_pixels=dataset_out_mosaic.dims['longitude'], y_pixels=dataset_out_mosaic.dims['latitude'],
-                        band_order=['scene_ndvi', 'baseline_ndvi', 'ndvi_difference', 'ndvi_percentage_change'])
-        # we've got the tif, now do the png set..
-        # uses gdal dem with custom color maps..
-        for index in range(len(color_paths)):
-            cmd = "gdaldem color-relief -of PNG -b " + \
-                str(index + 1) + " " + tif_path + " " + \
-                color_paths[index] + " " + result_paths[index]
-            os.system(cmd)
-
         # update the results and finish up.
         update_model_bounds_with_dataset([result, meta, query], dataset_out_mosaic)
         result.result_mosaic_path = mosaic_png_path
@@ -313,6 +416,7 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
         query.complete = True
         query.query_end = datetime.datetime.now()
         query.save()
+        clear_query(query_id)
     except:
         error_with_message(
             result, "There was an exception when handling this query.")
@@ -321,117 +425,262 @@ def create_ndvi_anomaly(query_id, user_id, single=False):
     return
 
 @task(name="generate_ndvi_anomaly_chunk")
-def generate_ndvi_anomaly_chunk(time_num, chunk_num, processing_options=None, query=None, acquisition_list=None, lat_range=None, lon_range=None, measurements=None):
+def generate_ndvi_anomaly_chunk(time_num, chunk_num, processing_options=None, query=None, acquisition_list=None, selected_scenes=None, lat_range=None, lon_range=None, measurements=None):
     """
     responsible for generating a piece of a ndvi_anomaly product. This grabs the x/y area specified in the lat/lon ranges, gets all data
-    from acquisition_list, which is a list of acquisition dates, and creates the ndvi_anomaly using the function named in processing_options.
-    saves the result to disk using time/chunk num, and returns the path and the acquisition date keyed metadata.
+    from acquisition_list, which is a list of baseline acquisition dates, and creates the baseline using the function named in processing_options.
+    The baseline data is loaded once and a baseline is built from it for every one of selected_scenes, using the acquisitions before that scene.
+    The first time chunk also processes the selected scenes. The baselines and scenes are folded into the output grids and the
+    anomaly is computed once every time chunk's baseline has been merged. returns the paths and the acquisition date keyed metadata.
     """
-    selected_scene = acquisition_list[0]
-    baseline_scenes = acquisition_list[1:]
+    baseline_scenes = acquisition_list
     time_index = 0
-    iteration_data = None
+    iteration_data = [None] * len(selected_scenes)
     acquisition_metadata = {}
 
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    # whole months of the baseline are read from the climatology store rather than reloaded - only the
+    # acquisitions that update_ndvi_climatology hasn't added to it yet are processed here, and then added to it.
+    if processing_options['climatology'] is not None:
+        months = OrderedDict()
+        for acquisition in baseline_scenes:
+            months.setdefault((acquisition.year, acquisition.month), []).append(acquisition)
+        baseline_scenes = []
+        for year, month in months:
+            month_scenes = months[(year, month)]
+            # a month with a selected scene in it is only partly in that scene's baseline, so it's processed from the raw data.
+            if any(min(month_scenes) < selected_scene <= max(month_scenes) for selected_scene in selected_scenes):
+                baseline_scenes.extend(month_scenes)
+                continue
+            if is_cancelled(query.query_id):
+                print("Cancelling...")
+                return "CANCEL"
+            month_moments, month_metadata = _update_climatology_month(query.product, query.platform, query.area_id, lat_range, lon_range, year, month, month_scenes)
+            if month_moments is None:
+                continue
+            acquisition_metadata.update(month_metadata)
+            for scene_index in range(len(selected_scenes)):
+                if max(month_scenes) < selected_scenes[scene_index]:
+                    iteration_data[scene_index] = merge_moments(month_moments.copy(deep=True), iteration_data[scene_index])
+
     while time_index < len(baseline_scenes):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return
-        if result.status == "CANCEL":
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
         baseline_data = None
-        scene_data = None
         # if everything needs to be loaded at once...
         if processing_options['time_chunks'] is None and processing_options['time_slices_per_iteration'] == None:
-            datasets_in = []
-            for acquisition in baseline_scenes:
-                dataset = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=(acquisition, acquisition + datetime.timedelta(seconds=1)), longitude=lon_range, latitude=lat_range, measurements=measurements)
-                if 'time' in dataset:
-                    datasets_in.append(dataset.copy(deep=True))
-                dataset = None
-            if len(datasets_in) > 0:
-                baseline_data = xr.concat(datasets_in, 'time')
+            baseline_data = _load_acquisitions(query.product, query.platform, baseline_scenes, lat_range, lon_range, measurements)
         else:
-            # time ranges set based on if the baseline_scenes has been reversed or not. If it has, then the 'start' index is the later date, and must be handled appropriately.
-            start = baseline_scenes[time_index] + datetime.timedelta(seconds=1) if processing_options['reverse_time'] else baseline_scenes[time_index]
-            if processing_options['time_slices_per_iteration'] is not None and (time_index + processing_options['time_slices_per_iteration'] - 1) < len(baseline_scenes):
-                end = baseline_scenes[time_index + processing_options['time_slices_per_iteration'] - 1]
-            else:
-                end = baseline_scenes[-1] if processing_options['reverse_time'] else baseline_scenes[-1] + datetime.timedelta(seconds=1)
-            time_range = (end, start) if processing_options['reverse_time'] else (start, end)
-
-            baseline_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
+            # only the acquisitions in the baseline are loaded - the ones from other months are skipped
+            # and the months in between may come from the climatology.
+            slice_count = processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else len(baseline_scenes)
+            baseline_data = _load_acquisitions(query.product, query.platform, baseline_scenes[time_index:time_index + slice_count], lat_range, lon_range, measurements)
 
         # if baseline or scene data isn't there, continue.
-        if 'cf_mask' not in baseline_data:
+        if baseline_data is None or 'cf_mask' not in baseline_data:
             time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
             continue
 
-        clear_mask = create_cfmask_clean_mask(baseline_data.cf_mask)
-
-        # update metadata. # here the clear mask has all the clean
-        # pixels for each acquisition.
-        for timeslice in range(clear_mask.shape[0]):
-            time = raw_data.time.values[timeslice] if type(raw_data.time.values[timeslice]) == datetime.datetime else datetime.datetime.utcfromtimestamp(raw_data.time.values[timeslice].astype(int) * 1e-9)
-            clean_pixels = np.sum(
-                clear_mask[timeslice, :, :] == True)
-            if time not in acquisition_metadata:
-                acquisition_metadata[time] = {}
-                acquisition_metadata[time]['clean_pixels'] = 0
-            acquisition_metadata[time][
-                'clean_pixels'] += clean_pixels
-
-        for key in list(baseline_data.data_vars):
-            baseline_data[key].values[np.invert(clear_mask)] = -9999
-        #cloud filter + nan out all nodata.
-        baseline_data = baseline_data.where(baseline_data != -9999)
-
-        ndvi_baseline = (baseline_data.nir - baseline_data.red) / (baseline_data.nir + baseline_data.red)
-        iteration_data = ndvi_baseline.mean('time') if processing_options['processing_method'] == 'mean' else ndvi_baseline.median('time') if processing_options['processing_method'] == 'median' else create_mosaic(ndvi_baseline, clean_mask=clear_mask, reverse_time=True, intermediate_product=None)
+        ndvi_baseline, times = _get_clean_ndvi(baseline_data, acquisition_metadata)
+        # the load is shared by every selected scene, each one's baseline only uses the acquisitions before it.
+        for scene_index in range(len(selected_scenes)):
+            preceding = [timeslice for timeslice in range(len(times)) if times[timeslice] < selected_scenes[scene_index]]
+            if len(preceding) == 0:
+                continue
+            scene_baseline = ndvi_baseline if len(preceding) == len(times) else ndvi_baseline.isel(time=preceding)
+            if processing_options['processing_method'] == 'mean':
+                # moments merge exactly, so the mean can be built up a few slices at a time.
+                iteration_data[scene_index] = merge_moments(get_moments(scene_baseline), iteration_data[scene_index])
+            else:
+                baseline_median = scene_baseline.median('time')
+                baseline_median.values[~np.isfinite(baseline_median.values)] = -9999
+                iteration_data[scene_index] = xr.Dataset({'baseline_ndvi': baseline_median})
         time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
 
-    #load and clean up the selected scene. Just mosaicked as it does the cfmask corrections
-    scene_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=(selected_scene - datetime.timedelta(hours=1), selected_scene + datetime.timedelta(hours=1)), longitude=lon_range, latitude=lat_range)
-    if 'cf_mask' not in scene_data or iteration_data is None:
-        return [None, None, None]
-    scene_cleaned = create_mosaic(scene_data, reverse_time=True, intermediate_product=None)
-
-    #masks out nodata and water.
-    water_class = wofs_classify(scene_cleaned, mosaic=True).wofs
-    scene_cleaned_nan = scene_cleaned.copy(deep=True).where((scene_cleaned.red != -9999) & (water_class == 0))
-
-    scene_ndvi = (scene_cleaned_nan.nir - scene_cleaned_nan.red) / (scene_cleaned_nan.nir + scene_cleaned_nan.red)
-    ndvi_difference = scene_ndvi - iteration_data
-    ndvi_percentage_change = (scene_ndvi - iteration_data) / iteration_data
-
-    #convert to conventional nodata vals.
-    scene_ndvi.values[~np.isfinite(scene_ndvi.values)] = -9999
-    ndvi_difference.values[~np.isfinite(ndvi_difference.values)] = -9999
-    ndvi_percentage_change.values[~np.isfinite(ndvi_percentage_change.values)] = -9999
-
-    scene_ndvi_dataset = xr.Dataset({'scene_ndvi': scene_ndvi,
-                                     'baseline_ndvi': iteration_data,
-                                     'ndvi_difference': ndvi_difference,
-                                     'ndvi_percentage_change': ndvi_percentage_change},
-                                     coords={'latitude': scene_data.latitude,
-                                             'longitude': scene_data.longitude})
-
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
-    geo_path_ndvi = base_temp_path + query.query_id + "/geo_chunk_ndvi_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
-
-    scene_cleaned.to_netcdf(geo_path)
-    scene_ndvi_dataset.to_netcdf(geo_path_ndvi)
+    # fold this chunk's baselines into the baselines accumulated over every time chunk.
+    baseline_paths = []
+    for scene_index in range(len(selected_scenes)):
+        if iteration_data[scene_index] is not None:
+            baseline_paths.append(fold_chunk(iteration_data[scene_index], base_temp_path + query.query_id, 'baseline_' + str(scene_index), chunk_num, time_num, processing_options['baseline_combination_method']))
+
+    #load and clean up the selected scenes. Just mosaicked as it does the cfmask corrections
+    # the scenes only need to be processed once for each geographic chunk.
+    geo_paths = []
+    for scene_index in range(len(selected_scenes)):
+        if time_num != 0:
+            break
+        if is_cancelled(query.query_id):
+            print("Cancelling...")
+            return "CANCEL"
+        selected_scene = selected_scenes[scene_index]
+        scene_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=(selected_scene - datetime.timedelta(hours=1), selected_scene + datetime.timedelta(hours=1)), longitude=lon_range, latitude=lat_range)
+        if scene_data is None or 'cf_mask' not in scene_data:
+            continue
+        scene_cleaned = create_mosaic(scene_data, reverse_time=True, intermediate_product=None)
+
+        #masks out nodata and water.
+        water_class = wofs_classify(scene_cleaned, mosaic=True).wofs
+        scene_cleaned_nan = scene_cleaned.copy(deep=True).where((scene_cleaned.red != -9999) & (water_class == 0))
+
+        scene_ndvi = (scene_cleaned_nan.nir - scene_cleaned_nan.red) / (scene_cleaned_nan.nir + scene_cleaned_nan.red)
+        #convert to conventional nodata vals.
+        scene_ndvi.values[~np.isfinite(scene_ndvi.values)] = -9999
+        scene_ndvi_dataset = xr.Dataset({'scene_ndvi': scene_ndvi},
+                                         coords={'latitude': scene_data.latitude,
+                                                 'longitude': scene_data.longitude})
+
+        # fold this geographic chunk into the accumulated products as soon as it's done.
+        geo_paths.append(fold_chunk(scene_cleaned, base_temp_path + query.query_id, 'mosaic_' + str(scene_index), chunk_num, time_num, processing_options['chunk_combination_method']))
+        geo_paths.append(fold_chunk(scene_ndvi_dataset, base_temp_path + query.query_id, 'scene_ndvi_' + str(scene_index), chunk_num, time_num, processing_options['chunk_combination_method']))
 
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
-    return [geo_path, geo_path_ndvi, acquisition_metadata]
+    increment_progress(query.query_id)
+    return [baseline_paths, geo_paths, acquisition_metadata]
+@task(name="ndvi_anomaly_chunk_failure")
+def ndvi_anomaly_chunk_failure(task_id, query_id):
+    """
+    Error callback for the combine_ndvi_anomaly_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_ndvi_anomaly_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_query(query_id)
+    elif result is not None:
+        error_with_message(result, "There was an exception when handling this query.")
+
+def _get_datetime(time):
+    """
+    Converts a time coordinate value from the datacube to a datetime.
+    """
+    return time if type(time) == datetime.datetime else datetime.datetime.utcfromtimestamp(time.astype(int) * 1e-9)
+
+def _load_acquisitions(product, platform, acquisitions, lat_range, lon_range, measurements):
+    """
+    Loads a set of acquisitions for a geographic chunk. Acquisitions that are close together are coalesced
+    into a single request, and the requested time slices are copied straight into a preallocated stack
+    rather than copying and concatenating a dataset per acquisition.
+
+    Args:
+        product (string): The datacube product to load.
+        platform (string): The platform of the product.
+        acquisitions (list): The acquisition dates to load.
+        lat_range, lon_range (tuple): The bounds of the chunk.
+        measurements (list): The measurements to load.
+
+    Returns:
+        Dataset: the acquisitions stacked along time oldest first, or None if none of them have data.
+    """
+    acquisitions = sorted(acquisitions)
+    # a gap longer than this starts a new request so unselected months aren't loaded.
+    windows = []
+    for acquisition in acquisitions:
+        if len(windows) > 0 and acquisition - windows[-1][-1] <= load_window_gap:
+            windows[-1].append(acquisition)
+        else:
+            windows.append([acquisition])
+
+    template = None
+    stack = None
+    times = []
+    for window in windows:
+        dataset = dc.get_dataset_by_extent(product, product_type=None, platform=platform, time=(window[0], window[-1] + datetime.timedelta(seconds=1)), longitude=lon_range, latitude=lat_range, measurements=measurements)
+        if dataset is None or 'time' not in dataset:
+            continue
+        dataset_times = [_get_datetime(time) for time in dataset.time.values]
+        if stack is None:
+            template = dataset
+            stack = OrderedDict((key, np.empty((len(acquisitions),) + dataset[key].shape[1:], dtype=dataset[key].dtype)) for key in dataset.data_vars)
+        # the window can contain acquisitions that weren't requested, only the first slice within a second of each requested one is kept.
+        for acquisition in window:
+            timeslice = next((index for index in range(len(dataset_times)) if acquisition <= dataset_times[index] < acquisition + datetime.timedelta(seconds=1)), None)
+            if timeslice is None:
+                continue
+            for key in stack:
+                stack[key][len(times)] = dataset[key].values[timeslice]
+            times.append(dataset.time.values[timeslice])
+        dataset = None
+    if len(times) == 0:
+        return None
+    data_vars = OrderedDict((key, (template[key].dims, stack[key][:len(times)], template[key].attrs)) for key in stack)
+    return xr.Dataset(data_vars, coords={'time': times, 'latitude': template.latitude, 'longitude': template.longitude}, attrs=template.attrs)
+
+def _update_climatology_month(product, platform, area_id, lat_range, lon_range, year, month, month_scenes):
+    """
+    Gets the ndvi moments of a month of a tile from the climatology store. Any of month_scenes that
+    aren't in the store yet are loaded and merged in, and the store is updated with the result.
+
+    Args:
+        product (string): The datacube product.
+        platform (string): The platform of the product.
+        area_id (string): The area the product belongs to.
+        lat_range, lon_range (tuple): The bounds of the tile.
+        year, month (int): The month.
+        month_scenes (list): Every acquisition of the month that should be in the moments.
+
+    Returns:
+        month_moments (Dataset): the moments of the month, None if there is no clean data.
+        month_metadata (dict): acquisition date keyed metadata for the month.
+    """
+    summary_key = get_summary_key(product, "ndvi_anomaly.climatology", lat_range, lon_range, platform=platform, area_id=area_id, year=year, month=month)
+    summary = load_summary(summary_key, month_scenes)
+    month_moments, month_metadata, summarized = (summary[0]['baseline'], summary[1], summary[2]) if summary is not None else (None, {}, set())
+    missing_scenes = [acquisition for acquisition in month_scenes if acquisition not in summarized]
+    if len(missing_scenes) > 0:
+        month_data = _load_acquisitions(product, platform, missing_scenes, lat_range, lon_range, measurements)
+        if month_data is not None and 'cf_mask' in month_data:
+            ndvi_month, times = _get_clean_ndvi(month_data, month_metadata)
+            month_moments = merge_moments(get_moments(ndvi_month), month_moments)
+        if month_moments is not None:
+            save_summary(summary_key, {'baseline': month_moments}, month_metadata, month_scenes)
+    return month_moments, month_metadata
+
+def _get_clean_ndvi(baseline_data, acquisition_metadata):
+    """
+    Cloud masks baseline data and computes its ndvi, counting the clean pixels of every acquisition.
+
+    Args:
+        baseline_data (Dataset): The raw data, with red, nir and cf_mask.
+        acquisition_metadata (dict): acquisition date keyed metadata, updated with the clean pixel counts.
+
+    Returns:
+        ndvi (DataArray): the ndvi of every time slice, NaN where it isn't clean.
+        times (list): the datetime of every time slice.
+    """
+    clear_mask = create_cfmask_clean_mask(baseline_data.cf_mask)
+
+    # update metadata. # here the clear mask has all the clean
+    # pixels for each acquisition.
+    times = []
+    for timeslice in range(clear_mask.shape[0]):
+        time = _get_datetime(baseline_data.time.values[timeslice])
+        times.append(time)
+        clean_pixels = np.sum(
+            clear_mask[timeslice, :, :] == True)
+        if time not in acquisition_metadata:
+            acquisition_metadata[time] = {}
+            acquisition_metadata[time]['clean_pixels'] = 0
+        acquisition_metadata[time][
+            'clean_pixels'] += clean_pixels
+
+    for key in list(baseline_data.data_vars):
+        baseline_data[key].values[np.invert(clear_mask)] = -9999
+    #cloud filter + nan out all nodata.
+    baseline_data = baseline_data.where(baseline_data != -9999)
+
+    return (baseline_data.nir - baseline_data.red) / (baseline_data.nir + baseline_data.red), times
 
 def error_with_message(result, message):
     """
@@ -477,6 +726,45 @@ def shutdown_worker(**kwargs):
     global dc
     dc = None
 
+@task(name="update_ndvi_climatology")
+def update_ndvi_climatology():
+    """
+    Brings the climatology store up to date for every area and satellite the ndvi anomaly tool is
+    available for. Run by celery beat (CELERYBEAT_SCHEDULE in settings) so newly ingested acquisitions
+    are summarized before they are queried - mean baseline queries then only read the stored moments.
+    Every tile and year is submitted as a seperate update_ndvi_climatology_chunk task.
+    """
+    app = Application.objects.get(application_id="ndvi_anomaly")
+    algorithm = processing_algorithms['mean']
+    for area in app.areas.all():
+        for satellite in area.satellites.all() & app.satellites.all():
+            if satellite.satellite_id == "LANDSAT_ALL":
+                continue
+            product = satellite.product_prefix + area.area_id
+            product_details = dc.dc.list_products()[dc.dc.list_products().name == product]
+            if len(product_details) == 0:
+                continue
+            acquisitions = dc.list_acquisition_dates(satellite.satellite_id, product)
+            # the tiles are planned the same way as the chunks of a query covering the whole area.
+            lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(area.latitude_min, area.latitude_max), longitude=(
+                area.longitude_min, area.longitude_max), acquisitions=acquisitions, geo_chunk_size=algorithm['climatology'], reverse_time=algorithm['reverse_time'],
+                tile_size=get_tile_size(product_details), group_by_year=True)
+            for time_range in time_ranges:
+                for geographic_chunk_index in range(len(lat_ranges)):
+                    update_ndvi_climatology_chunk.delay(product, satellite.satellite_id, area.area_id, lat_ranges[geographic_chunk_index], lon_ranges[geographic_chunk_index], time_range)
+
+@task(name="update_ndvi_climatology_chunk")
+def update_ndvi_climatology_chunk(product, platform, area_id, lat_range, lon_range, acquisition_list):
+    """
+    Adds the acquisitions in acquisition_list that aren't in the climatology store yet to the moments
+    of their month for a single tile.
+    """
+    months = OrderedDict()
+    for acquisition in acquisition_list:
+        months.setdefault((acquisition.year, acquisition.month), []).append(acquisition)
+    for year, month in months:
+        _update_climatology_month(product, platform, area_id, lat_range, lon_range, year, month, months[(year, month)])
+
 @task(name="get_acquisition_list")
 def get_acquisition_list(area, satellite):
     # lists all acquisition dates for use in single tmeslice queries.
@@ -61,7 +61,7 @@ def create_query_from_post(user_id, post):
                   longitude_max=post['longitude_max'], longitude_min=post['longitude_min'],
                   time_start=",".join(scene_index_sel), time_end=",".join(scene_string_sel),
                   platform=post['platform'], baseline=",".join(post.getlist('baseline_selection')),
-                  area_id=post['area_id'])
+                  baseline_method=post['baseline_method'] if 'baseline_method' in post else "median", area_id=post['area_id'])
 
     query.title = "NDVI Anomaly Task" if 'title' not in post or post['title'] == '' else post['title']
     query.description = "None" if 'description' not in post or post['description'] == '' else post['description']
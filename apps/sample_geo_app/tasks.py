@@ -42,6 +42,8 @@ from utils.dc_mosaic import create_mosaic, create_median_mosaic, create_max_ndvi
 from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask, split_task
 
 from .utils import update_model_bounds_with_dataset
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.reduction import fill_nodata
 
 """
 Class for handling loading celery workers to perform tasks asynchronously.
@@ -65,38 +67,29 @@ measurements = ['blue', 'green', 'red', 'nir', 'swir1', 'swir2', 'cf_mask']
 
 """
 functions used to combine time sliced data after being combined geographically.
-Fill nodata uses the first timeslice as a base, then uses subsequent slices to
+Fill nodata (shared, in data_cube_ui.reduction) uses the first timeslice as a base, then uses subsequent slices to
 fill in indices with nodata values.
 this should be used for recent/leastrecent + anything that is done in a single time chunk (median pixel?)
 things like max/min ndvi should be able to compound max/min ops between ddifferent timeslices so this will be
 different for that.
 """
-def fill_nodata(dataset, dataset_intermediate):
-    if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset_out[key].values==-9999] = dataset[key].values[dataset_out[key].values==-9999]
-    return dataset_out
-
 def max_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values > dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values > dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values > dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 def min_value(dataset, dataset_intermediate):
     if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset.ndvi.values < dataset_out.ndvi.values] = dataset[key].values[dataset.ndvi.values < dataset_out.ndvi.values]
-    return dataset_out
+        return dataset
+    # the comparison is done once and applied to every band, updating the new dataset in place.
+    keep = ~(dataset.ndvi.values < dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
 
 #holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
@@ -204,11 +197,13 @@ def create_cloudfree_mosaic(query_id, user_id, single=False):
             error_with_message(result, "There were no acquisitions for this parameter set.")
             return
 
-        processing_options = processing_algorithms[query.compositor]
+        # query specific overrides go into this query's execution plan rather than the shared profile.
+        overrides = {}
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        processing_options = ExecutionPlan(processing_algorithms[query.compositor], **overrides)
 
         # Reversed time = True will make it so most recent = First, oldest = Last.
         #default is in order from oldest -> newwest.
@@ -21,6 +21,8 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, Metadata
 
@@ -39,11 +41,18 @@ from dateutil.tz import tzutc
 
 from utils.data_access_api import DataAccessApi
 from utils.dc_mosaic import create_mosaic
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_rgb_png_from_tiff, create_cfmask_clean_mask
 from utils.dc_baseline import generate_baseline
 from utils.dc_demutils import create_slope_mask
 
 from data_cube_ui.utils import update_model_bounds_with_dataset, map_ranges
+from data_cube_ui.reduction import fill_nodata, create_output_grid, fold_chunk, load_accumulated_product
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.tiling import plan_tiles, get_tile_size
+from data_cube_ui.summary_store import get_summary_key, load_summary, save_summary
+from data_cube_ui.block_cache import get_cached_dataset
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 """
 Class for handling loading celery workers to perform tasks asynchronously.
@@ -65,22 +74,9 @@ dc = None
 #default measurements. leaves out all qa bands.
 measurements = ['blue', 'green', 'red', 'nir', 'swir1', 'cf_mask']
 
-"""
-functions used to combine time sliced data after being combined geographically.
-Fill nodata uses the first timeslice as a base, then uses subsequent slices to
-fill in indices with nodata values.
-this should be used for recent/leastrecent + anything that is done in a single time chunk (median pixel?)
-things like max/min ndvi should be able to compound max/min ops between ddifferent timeslices so this will be
-different for that.
-"""
-def fill_nodata(dataset, dataset_intermediate):
-    if dataset_intermediate is None:
-        return dataset.copy(deep=True)
-    dataset_out = dataset_intermediate.copy(deep=True)
-    for key in list(dataset_out.data_vars):
-        # Get raw data for current variable and mask the data
-        dataset_out[key].values[dataset_out[key].values==-9999] = dataset[key].values[dataset_out[key].values==-9999]
-    return dataset_out
+# slopes steeper than this (in degrees) can have landslides. the resolution is the ASTER DEM's, in meters.
+slope_degree_threshold = 15
+dem_resolution = 30
 
 #holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
@@ -168,18 +164,24 @@ def create_slip(query_id, user_id, single=False):
             error_with_message(result, "There are only " + str(len(acquisitions)) + " acquisitions for your parameter set. The acquisition count must be at least one greater than the baseline length.")
             return
 
-        processing_options = processing_algorithms[query.baseline]
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms[query.baseline]
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(acquisitions))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
         # Reversed time = True will make it so most recent = First, oldest = Last.
         #default is in order from oldest -> newwest.
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details))
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
         # ensures that the start and end are both valid.
@@ -189,77 +191,111 @@ def create_slip(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid(s) that the chunks write their results directly into.
+        for product in ['mosaic']:
+            create_output_grid(base_temp_path + query.query_id, product, latitude=(query.latitude_min, query.latitude_max),
+                               longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
-        # iterate over the time chunks.
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
+
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
+        # iterate over the time chunks.
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_slip_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
-            time_chunk_tasks.append(geo_chunk_tasks)
-
-        # holds some acquisition based metadata. dict of objs keyed by date
-        dataset_out_mosaic = None
-        dataset_out_baseline_mosaic = None
-        dataset_out_slip = None
+                chunk_tasks.append(generate_slip_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index], measurements=measurements))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
+
+        combination_task = combine_slip_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                 acquisitions=acquisitions, resolution=product_details.resolution.values[0])
+        combination_task.link_error(slip_chunk_failure.s(query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_slip_chunks")
+def combine_slip_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, resolution=None):
+    """
+    Chord callback for create_slip. Receives the results of every generate_slip_chunk task
+    ordered by time chunk then geographic chunk, combines them into the final SLIP product and
+    creates the result files.
+
+    Args:
+        chunk_results (list): The mosaic paths, slip pixels and metadata returned by generate_slip_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_query(query_id)
+        return
+
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_query(query_id)
+            return
+
+        # each chunk has already been folded into the accumulators for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is the mosaic path, the slip pixels and the metadata.
         acquisition_metadata = {}
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                # tile is [path, metadata]. Append tiles to list of tiles for concat, compile metadata.
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
-                    return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles_mosaic = []
-            xr_tiles_slip = []
-            xr_tiles_baseline_mosaic = []
-            for tile in tiles:
-                tile_metadata = tile[3]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                        acquisition_metadata[acquisition_date]['slip_pixels'] += tile_metadata[acquisition_date]['slip_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels'],
-                                                                  'slip_pixels': tile_metadata[acquisition_date]['slip_pixels']}
-                xr_tiles_mosaic.append(xr.open_dataset(tile[0]))
-                xr_tiles_slip.append(xr.open_dataset(tile[1]))
-                xr_tiles_baseline_mosaic.append(xr.open_dataset(tile[2]))
-            #create cf mosaic
-            full_dataset_mosaic = xr.concat(reversed(xr_tiles_mosaic), dim='latitude')
-            dataset_mosaic = full_dataset_mosaic.load()
-            dataset_out_mosaic = processing_options['chunk_combination_method'](dataset_mosaic, dataset_out_mosaic)
-
-            #create baseline mosaic
-            full_dataset_baseline_mosaic = xr.concat(reversed(xr_tiles_baseline_mosaic), dim='latitude')
-            dataset_baseline_mosaic = full_dataset_baseline_mosaic.load()
-            dataset_out_baseline_mosaic = processing_options['chunk_combination_method'](dataset_baseline_mosaic, dataset_out_baseline_mosaic)
-
-            #now slip.
-            full_dataset_slip = xr.concat(reversed(xr_tiles_slip), dim='latitude')
-            dataset_slip = full_dataset_slip.load()
-            dataset_out_slip = processing_options['chunk_combination_method'](dataset_slip, dataset_out_slip)
+        for tile in chunk_results:
+            if tile is None or tile[0] is None:
+                continue
+            tile_metadata = tile[-1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date in acquisition_metadata:
+                    acquisition_metadata[acquisition_date]['clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
+                    acquisition_metadata[acquisition_date]['slip_pixels'] += tile_metadata[acquisition_date]['slip_pixels']
+                else:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date]['clean_pixels'],
+                                                              'slip_pixels': tile_metadata[acquisition_date]['slip_pixels']}
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        # the chunks only fold the mosaic - the landslides are drawn onto it from their slip pixels.
+        dataset_out_baseline_mosaic = load_accumulated_product(base_temp_path + query.query_id, 'mosaic')
+        if dataset_out_baseline_mosaic is None:
+            error_with_message(result, "There is no data in your selected area.")
+            return
+        dataset_out_mosaic, dataset_out_slip = compose_slip_products(dataset_out_baseline_mosaic, [tile[1] for tile in chunk_results if tile is not None and tile[1] is not None], resolution)
 
         latitude = dataset_out_mosaic.latitude
         longitude = dataset_out_mosaic.longitude
 
         # grabs the resolution.
-        geotransform = [longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, latitude.values[0], 0.0, product_details.resolution.values[0][0]]
+        geotransform = [longitude.values[0], resolution[1],
+                        0.0, latitude.values[0], 0.0, resolution[0]]
         #hardcoded crs for now. This is not ideal. Should maybe store this in the db with product type?
         crs = str("EPSG:4326")
 
@@ -335,6 +371,7 @@ def create_slip(query_id, user_id, single=False):
         query.complete = True
         query.query_end = datetime.datetime.now()
         query.save()
+        clear_query(query_id)
     except:
         error_with_message(
             result, "There was an exception when handling this query.")
@@ -347,21 +384,20 @@ def generate_slip_chunk(time_num, chunk_num, processing_options=None, query=None
     """
     responsible for generating a piece of a slip product. This grabs the x/y area specified in the lat/lon ranges, gets all data
     from acquisition_list, which is a list of acquisition dates, and creates the slip using the function named in processing_options.
-    saves the result to disk using time/chunk num, and returns the path and the acquisition date keyed metadata.
+    The mosaic is folded into the output grid, and the landslide pixels are returned as a sparse list of coordinates, dates
+    and band values. returns the path, the slip pixels and the acquisition date keyed metadata.
     """
     time_index = 0
     iteration_data = None
+    slip_pixels = []
     acquisition_metadata = {}
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    # the terrain doesn't change, so the slope mask is the same for every iteration. without a DEM nothing is loaded.
+    is_above_slope_threshold = get_slope_mask(query, lat_range, lon_range)
     # holds some acquisition based metadata.
-    while time_index < len(acquisition_list):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return
-        if result.status == "CANCEL":
+    while is_above_slope_threshold is not None and time_index < len(acquisition_list):
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
 
@@ -373,13 +409,9 @@ def generate_slip_chunk(time_num, chunk_num, processing_options=None, query=None
             end = acquisition_list[-1] if processing_options['reverse_time'] else acquisition_list[-1] + datetime.timedelta(seconds=1)
         time_range = (end, start) if processing_options['reverse_time'] else (start, end)
 
-        raw_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
-        aster = dc.get_dataset_by_extent('terra_aster_gdm_'+query.area_id,
-                    	latitude=lat_range,
-                    	longitude=lon_range,
-                    	measurements=['dem'])
+        raw_data = get_cached_dataset(dc, query.product, product_type=None, platform=query.platform, time=time_range, longitude=lon_range, latitude=lat_range, measurements=measurements)
         #Pretty much for metadata only.. Not all that useful, only kept for consistency.
-        if "cf_mask" not in raw_data or "dem" not in aster:
+        if "cf_mask" not in raw_data:
             time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
             continue
         clear_mask = create_cfmask_clean_mask(raw_data.cf_mask)
@@ -392,63 +424,145 @@ def generate_slip_chunk(time_num, chunk_num, processing_options=None, query=None
         #mode is either average or composite
         baseline = generate_baseline(comparison, composite_size=query.baseline_length, mode=query.baseline)
 
-        ndwi_comparison = (comparison.nir - comparison.swir1)/(comparison.nir + comparison.swir1)
-        ndwi_baseline = (baseline.nir - baseline.swir1)/(baseline.nir + baseline.swir1)
-        ndwi_change = ndwi_comparison - ndwi_baseline
-
-        comparison_ndwi_filtered = comparison.where(abs(ndwi_change) > 0.20)
-        red_change = (comparison.red - baseline.red)/(baseline.red)
-        comparison_red_filtered = comparison_ndwi_filtered.where(red_change > 0.40)
-        is_above_slope_threshold = create_slope_mask(aster, degree_threshold = 15, resolution = 30)
-        comparison_red_slope_filtered = comparison_red_filtered.where(is_above_slope_threshold)
+        # a single pass builds the per pixel slip mask from the ndwi change, red change and slope rather than
+        # filtering full copies of the data for each test. comparisons with nodata are False.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ndwi_comparison = (comparison.nir.values - comparison.swir1.values) / (comparison.nir.values + comparison.swir1.values)
+            ndwi_baseline = (baseline.nir.values - baseline.swir1.values) / (baseline.nir.values + baseline.swir1.values)
+            is_slip = np.abs(ndwi_comparison - ndwi_baseline) > 0.20
+            ndwi_comparison = ndwi_baseline = None
+            is_slip &= (comparison.red.values - baseline.red.values) / baseline.red.values > 0.40
+        is_slip &= is_above_slope_threshold
 
-        #gather all relevant values from the baseline mosaics, average them, and insert them into the mosaic for the baseline mosaic.
-        baseline_mosaic_data = iteration_data.where(comparison_red_slope_filtered > 0).mean('time')
-        baseline_mosaic = iteration_data.copy(deep=True)
         # update metadata. # here the clear mask has all the clean
         # pixels for each acquisition.
-        for timeslice in range(len(comparison_red_slope_filtered.time)):
-            slip_slice = comparison_red_slope_filtered.isel(time=timeslice).red.values
-            baseline_slice = baseline.isel(time=timeslice).red.values
-            if len(slip_slice[slip_slice > 0]) > 0:
+        time_axis = comparison.red.get_axis_num('time')
+        for timeslice in range(is_slip.shape[time_axis]):
+            slip_pixel_count = np.sum(is_slip.take(timeslice, axis=time_axis) & (comparison.red.values.take(timeslice, axis=time_axis) > 0))
+            if slip_pixel_count > 0:
                 time = raw_data.time.values[timeslice] if type(raw_data.time.values[timeslice]) == datetime.datetime else datetime.datetime.utcfromtimestamp(raw_data.time.values[timeslice].astype(int) * 1e-9)
                 if time not in acquisition_metadata:
                     acquisition_metadata[time] = {}
                     acquisition_metadata[time]['clean_pixels'] = 0
                     acquisition_metadata[time]['slip_pixels'] = 0
-                acquisition_metadata[time]['clean_pixels'] += len(baseline_slice[baseline_slice > 0])
-                acquisition_metadata[time]['slip_pixels'] += len(slip_slice[slip_slice > 0])
+                acquisition_metadata[time]['clean_pixels'] += np.sum(baseline.red.values.take(timeslice, axis=time_axis) > 0)
+                acquisition_metadata[time]['slip_pixels'] += slip_pixel_count
 
-        comparison_red_slope_filtered = comparison_red_slope_filtered.mean('time')
-
-        #replace the pixels in the mosaic with the landslide pixels in slip.
-        #Turn pixels red and fill in the rest from the mosaic.
-        slip = comparison_red_slope_filtered.copy(deep=True)
-        slip.red.values[~comparison_red_slope_filtered.isnull().red.values] = 4096
-        slip.green.values[~comparison_red_slope_filtered.isnull().green.values] = 0
-        slip.blue.values[~comparison_red_slope_filtered.isnull().red.values] = 0
+        # the landslides are only kept as a sparse list of pixels - the mosaic is left as it is and the
+        # slip and baseline products are composed from the two when the results are created.
+        slip_means = OrderedDict()
         for band in iteration_data.data_vars:
-            slip[band].values[comparison_red_slope_filtered.isnull()[band].values] = iteration_data[band].values[comparison_red_slope_filtered.isnull()[band].values]
-            iteration_data[band].values[~comparison_red_slope_filtered.isnull()[band].values] = comparison_red_slope_filtered[band].values[~comparison_red_slope_filtered.isnull()[band].values]
-            baseline_mosaic[band].values[~baseline_mosaic_data.isnull()[band].values] = baseline_mosaic_data[band].values[~baseline_mosaic_data.isnull()[band].values]
+            band_slip = is_slip & np.isfinite(comparison[band].values)
+            slip_count = band_slip.sum(axis=time_axis)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                slip_means[band] = np.where(slip_count > 0, np.where(band_slip, comparison[band].values, 0).sum(axis=time_axis) / slip_count, np.nan)
+        lat_index, lon_index = np.nonzero(np.any([np.isfinite(slip_means[band]) for band in slip_means], axis=0))
+        if len(lat_index) > 0:
+            # the most recent acquisition each pixel had a landslide in.
+            time_count = is_slip.shape[time_axis]
+            last_slip = time_count - 1 - np.argmax(is_slip.take(np.arange(time_count)[::-1], axis=time_axis), axis=time_axis)
+            pixels = OrderedDict([('latitude', iteration_data.latitude.values[lat_index]),
+                                  ('longitude', iteration_data.longitude.values[lon_index]),
+                                  ('time', raw_data.time.values[last_slip[lat_index, lon_index]])])
+            for band in slip_means:
+                pixels[band] = slip_means[band][lat_index, lon_index]
+            slip_pixels.append(pixels)
+        comparison = baseline = is_slip = None
 
         time_index = time_index + (processing_options['time_slices_per_iteration'] if processing_options['time_slices_per_iteration'] is not None else 10000)
 
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
-    geo_path_baseline = base_temp_path + query.query_id + "/geo_chunk_baseline" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
-    slip_path = base_temp_path + query.query_id + "/geo_chunk_slip_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
     # if this is an empty chunk, just return an empty dataset.
     if iteration_data is None:
-        return [None, None, None, None]
-    iteration_data.to_netcdf(geo_path)
-    slip.to_netcdf(slip_path)
-    baseline_mosaic.to_netcdf(geo_path_baseline)
+        increment_progress(query.query_id)
+        return [None, None, None]
+    # fold this geographic chunk into the accumulated products as soon as it's done.
+    geo_path = fold_chunk(iteration_data, base_temp_path + query.query_id, 'mosaic', chunk_num, time_num, processing_options['chunk_combination_method'])
+    slip_pixels = OrderedDict((key, np.concatenate([pixels[key] for pixels in slip_pixels])) for key in slip_pixels[0]) if len(slip_pixels) > 0 else None
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
-    return [geo_path, slip_path, geo_path_baseline, acquisition_metadata]
+    increment_progress(query.query_id)
+    return [geo_path, slip_pixels, acquisition_metadata]
+
+@task(name="slip_chunk_failure")
+def slip_chunk_failure(task_id, query_id):
+    """
+    Error callback for the combine_slip_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_slip_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_query(query_id)
+    elif result is not None:
+        error_with_message(result, "There was an exception when handling this query.")
+
+def compose_slip_products(dataset_mosaic, slip_pixels, resolution):
+    """
+    Draws the sparse slip pixels returned by the chunks onto the mosaic. Pixels later in slip_pixels
+    replace earlier ones.
+
+    Args:
+        dataset_mosaic (Dataset): The mosaic without any landslides, also used as the baseline mosaic.
+        slip_pixels (list): dicts of latitude, longitude, time and band value arrays from generate_slip_chunk.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        mosaic (Dataset): the mosaic with the landslide pixels averaged in.
+        slip (Dataset): the mosaic with the landslide pixels in red.
+    """
+    mosaic = dataset_mosaic.copy(deep=True)
+    slip = xr.Dataset(OrderedDict((band, (mosaic[band].dims, mosaic[band].values.astype(np.float64))) for band in mosaic.data_vars),
+                      coords={'latitude': mosaic.latitude, 'longitude': mosaic.longitude})
+    for pixels in slip_pixels:
+        lat_index = np.round((pixels['latitude'] - mosaic.latitude.values[0]) / resolution[0]).astype(int)
+        lon_index = np.round((pixels['longitude'] - mosaic.longitude.values[0]) / resolution[1]).astype(int)
+        in_grid = (lat_index >= 0) & (lat_index < len(mosaic.latitude)) & (lon_index >= 0) & (lon_index < len(mosaic.longitude))
+        has_slip = {}
+        for band in mosaic.data_vars:
+            has_slip[band] = in_grid & np.isfinite(pixels[band])
+            mosaic[band].values[lat_index[has_slip[band]], lon_index[has_slip[band]]] = pixels[band][has_slip[band]]
+            slip[band].values[lat_index[has_slip[band]], lon_index[has_slip[band]]] = pixels[band][has_slip[band]]
+        #Turn pixels red and leave the rest as the mosaic.
+        slip.red.values[lat_index[has_slip['red']], lon_index[has_slip['red']]] = 4096
+        slip.green.values[lat_index[has_slip['green']], lon_index[has_slip['green']]] = 0
+        blue_slip = has_slip['red'] & has_slip['blue']
+        slip.blue.values[lat_index[blue_slip], lon_index[blue_slip]] = 0
+    return mosaic, slip
+
+def get_slope_mask(query, lat_range, lon_range):
+    """
+    Gets the ASTER DEM slope mask for a geographic chunk. The terrain never changes, so the mask is kept
+    in the summary store keyed by the tile and threshold and only computed the first time a tile is used.
+
+    Args:
+        query (Query): The query the mask is for, used for the area.
+        lat_range, lon_range (tuple): The bounds of the chunk.
+
+    Returns:
+        ndarray: True where the slope is above slope_degree_threshold, or None if there is no DEM for the chunk.
+    """
+    summary_key = get_summary_key('terra_aster_gdm_' + query.area_id, "slip.slope_mask", lat_range, lon_range,
+                                  degree_threshold=slope_degree_threshold, resolution=dem_resolution)
+    # there are no acquisitions for the terrain, so any stored mask can be used.
+    summary = load_summary(summary_key, [])
+    if summary is not None:
+        return summary[0]['slope_mask'].slope_mask.values
+    aster = dc.get_dataset_by_extent('terra_aster_gdm_' + query.area_id, latitude=lat_range, longitude=lon_range, measurements=['dem'])
+    if "dem" not in aster:
+        return None
+    slope_mask = np.asarray(create_slope_mask(aster, degree_threshold=slope_degree_threshold, resolution=dem_resolution))
+    save_summary(summary_key, {'slope_mask': xr.Dataset({'slope_mask': (('latitude', 'longitude'), slope_mask)},
+                                                         coords={'latitude': aster.latitude, 'longitude': aster.longitude})}, None, [])
+    return slope_mask
 
 def error_with_message(result, message):
     """
@@ -44,6 +44,7 @@ class DataSelectForm(forms.Form):
     Django form to be created for selecting information and validating input for:
         result_type
         animated_product
+        include_water
         title
         description
     """
@@ -52,6 +53,9 @@ class DataSelectForm(forms.Form):
     result_type = forms.ChoiceField(
         label='Image Background Color:', widget=forms.Select(attrs={'class': 'field-long'}))
 
+    include_water = forms.BooleanField(required=False, label='Include Water Detection:', widget=forms.CheckboxInput(attrs={'class': 'tooltipped'}),
+                                       help_text='Also create the water detection results from the same data. They are listed in the water detection tool.')
+
     title = forms.CharField(widget=forms.HiddenInput())
     description = forms.CharField(widget=forms.HiddenInput())
 
@@ -41,6 +41,8 @@ class Query(BaseQuery):
     """
     query_type = models.CharField(max_length=25, default="")
     animated_product = models.CharField(max_length=25, default="None")
+    # also fills in the water detection results from the same data.
+    include_water = models.BooleanField(default=False)
 
     # functs.
     def get_type_name(self):
@@ -71,6 +73,8 @@ class Query(BaseQuery):
         """
         query_id = self.time_start.strftime("%Y-%m-%d") + '-' + self.time_end.strftime("%Y-%m-%d") + '-' + str(self.latitude_max) + '-' + str(
             self.latitude_min) + '-' + str(self.longitude_max) + '-' + str(self.longitude_min) + '-' + self.platform + '-' + self.product + '-' + self.query_type + '-' + self.animated_product
+        if self.include_water:
+            query_id += '-water'
         return query_id
 
     def generate_metadata(self, scene_count=0, pixel_count=0):
@@ -21,9 +21,14 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, ResultType, Metadata
 from data_cube_ui.models import AnimationType
+from apps.water_detection.models import Query as wd_query, Result as wd_result
+from apps.water_detection.utils import create_query_from_tsm_query
+from apps.water_detection.tasks import create_water_results, error_with_message as wd_error_with_message
 
 import numpy as np
 import xarray as xr
@@ -31,6 +36,7 @@ import collections
 import gdal
 import sys
 import shutil
+import traceback
 import osr
 import os
 import datetime
@@ -39,11 +45,21 @@ from dateutil.tz import tzutc
 import imageio
 
 from utils.data_access_api import DataAccessApi
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_cfmask_clean_mask, perform_timeseries_analysis_iterative, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_cfmask_clean_mask
 from utils.dc_water_classifier import wofs_classify
-from utils.dc_tsm import tsm, mask_tsm
+from utils.dc_tsm import mask_tsm
 
 from data_cube_ui.utils import update_model_bounds_with_dataset
+from data_cube_ui.reduction import create_output_grid, fold_chunk, load_accumulated_product
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.tiling import plan_tiles, get_tile_size, combine_tiles
+from data_cube_ui.tile_transport import put_tile, get_tile, delete_tile, clear_tiles
+from data_cube_ui.chunk_cache import is_cache_enabled, get_chunk_key, load_chunk, store_chunk
+from data_cube_ui.block_cache import get_cached_dataset
+from data_cube_ui.summary_store import get_summary_key, load_summary, save_summary
+from data_cube_ui.water_tsm import classify_water_tsm, water_product_name, tsm_product_name, split_tsm_metadata, combine_tsm_metadata
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 # Author: AHDS
 # Creation date: 2016-06-23
@@ -81,6 +97,7 @@ def addition(dataset, dataset_intermediate):
 # holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
 # process disregard it.
+# incremental splits time chunks by year and keeps per tile totals so only new scenes are processed.
 processing_algorithms = {
     'tsm': {
         'geo_chunk_size': 0.5,
@@ -88,7 +105,8 @@ processing_algorithms = {
         'reverse_time': False,
         'time_slices_per_iteration': 1,
         'chunk_combination_method': addition,
-        'processing_method': wofs_classify
+        'processing_method': wofs_classify,
+        'incremental': True
     }
 }
 
@@ -116,9 +134,6 @@ def perform_tsm_analysis(query_id, user_id, single=False):
 
     print("Got the query, creating metadata.")
 
-    result_type = ResultType.objects.get(
-        satellite_id=query.platform, result_id=query.query_type)
-
     # creates the empty result.
     result = query.generate_result()
 
@@ -147,16 +162,22 @@ def perform_tsm_analysis(query_id, user_id, single=False):
             error_with_message(result, "There were no acquisitions for this parameter set.")
             return
 
-        processing_options = processing_algorithms['tsm']
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms['tsm']
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(acquisitions))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details), group_by_year=processing_options['incremental'])
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
 
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
@@ -167,107 +188,141 @@ def perform_tsm_analysis(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid(s) that the chunks write their results directly into.
+        for product in ['water', 'tsm']:
+            create_output_grid(base_temp_path + query.query_id, product, latitude=(query.latitude_min, query.latitude_max),
+                               longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
+
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
         # iterate over the time chunks.
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_tsm_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index]))
-            time_chunk_tasks.append(geo_chunk_tasks)
+                chunk_tasks.append(generate_tsm_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index]))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
 
-        dataset_out_water = None
-        dataset_out_tsm = None
+        # the chunks classify water anyway, so the water detection results can come from the same data.
+        water_query_id = create_query_from_tsm_query(query) if query.include_water else None
+
+        combination_task = combine_tsm_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                acquisitions=acquisitions, resolution=product_details.resolution.values[0], water_query_id=water_query_id)
+        combination_task.link_error(tsm_chunk_failure.s(query_id, water_query_id=water_query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_tsm_chunks")
+def combine_tsm_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, resolution=None, water_query_id=None):
+    """
+    Chord callback for perform_tsm_analysis. Receives the results of every generate_tsm_chunk task
+    ordered by time chunk then geographic chunk, combines them into the final TSM analysis and
+    creates the result files.
+
+    Args:
+        chunk_results (list): The lists of paths and metadata returned by generate_tsm_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+        water_query_id (string): The ID of the water detection query to fill in as well, or None.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_water_query(water_query_id, user_id)
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+        return
+
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+    result_type = ResultType.objects.get(satellite_id=query.platform, result_id=query.query_type)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_water_query(water_query_id, user_id)
+            clear_query(query_id)
+            clear_tiles(base_temp_path + query_id)
+            return
+
+        # each chunk has already been folded into the accumulators for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is a list of paths followed by the metadata.
         acquisition_metadata = {}
+        for tile in chunk_results:
+            if tile is None or tile[0] is None:
+                continue
+            tile_metadata = tile[-1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date not in acquisition_metadata:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': 0, 'water_clean_pixels': 0, 'water_pixels': 0}
+                for key in acquisition_metadata[acquisition_date]:
+                    acquisition_metadata[acquisition_date][key] += tile_metadata[acquisition_date][key]
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        # the last combined animation frame - the true value at the end of the previous time chunk.
+        animation_out = None
         animation_tile_count = 0
-        time_range_index = 0
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                # tile is [path, metadata]. Append tiles to list of tiles for
-                # concat, compile metadata.
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
-                    return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles_water = []
-            xr_tiles_tsm = []
-            for tile in tiles:
-                tile_metadata = tile[2]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date][
-                            'clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date][
-                            'clean_pixels']}
-                xr_tiles_water.append(xr.open_dataset(tile[0]))
-                xr_tiles_tsm.append(xr.open_dataset(tile[1]))
-
-            #combine tiles
-            full_dataset_water = xr.concat(reversed(xr_tiles_water), dim='latitude')
-            dataset_water = full_dataset_water.load()
-
-            full_dataset_tsm = xr.concat(reversed(xr_tiles_tsm), dim='latitude')
-            dataset_tsm = full_dataset_tsm.load()
-
-            # combine all the intermediate products for the animation creation.
-            if query.animated_product != "None":
+
+        # combine all the intermediate products for the animation creation.
+        if query.animated_product != "None":
+            for time_range_index in range(len(time_ranges)):
                 print("Num of slices in this chunk: " +
-                    str(len(time_ranges[time_range_index])))
+                      str(len(time_ranges[time_range_index])))
+                previous_frame = animation_out
                 for timeslice in range(len(time_ranges[time_range_index])):
-                  result = Result.objects.get(query_id=query.query_id)
-                  if result.status == "CANCEL":
-                      print("Cancelled task.")
-                      shutil.rmtree(base_temp_path + query.query_id)
-                      query.delete()
-                      result.delete()
-                      return
-                  animation_tiles = []
-                  nc_paths = []
-                  for geoslice in range(len(lat_ranges)):
-                      nc_path = base_temp_path + query.query_id + '/' + \
-                          str(time_range_index) + '/' + \
-                          str(geoslice) + str(timeslice) + ".nc"
-                      nc_paths.append(nc_path)
-                      animation_tiles.append(xr.open_dataset(nc_path))
-                  animated_data = xr.concat(
-                      reversed(animation_tiles), dim='latitude').load()
-                  #combine the timeslice vals with the intermediate for the true value @ that timeslice
-                  if time_range_index > 0 and query.animated_product != "scene":
-                      animated_data = processing_options['chunk_combination_method'](animated_data, dataset_out_tsm)
-
-                  # save to .nc for later tiff + png conversion after masking with final wofs
-                  animated_data.to_netcdf(base_temp_path + query.query_id +
-                              '/' + str(animation_tile_count) + ".nc")
-                  # remove all the intermediates for this timeslice
-                  for path in nc_paths:
-                      os.remove(path)
-                  animated_data = None
-                  animation_tile_count += 1
-
-            #shutil.rmtree(base_temp_path + query.query_id +
-            #          '/' + str(time_range_index))
-
-            #add this intermediate product to the total.
-            dataset_out_water = processing_options[
-                'chunk_combination_method'](dataset_water, dataset_out_water)
-            dataset_out_tsm = processing_options[
-                'chunk_combination_method'](dataset_tsm, dataset_out_tsm)
-            time_range_index += 1
+                    animation_tiles = []
+                    tile_directory = base_temp_path + query.query_id + '/' + str(time_range_index)
+                    tile_names = [str(geoslice) + "_" + str(timeslice) for geoslice in range(geo_chunk_count)]
+                    for tile_name in tile_names:
+                        animation_tiles.append(get_tile(tile_directory, tile_name))
+                    animated_data = combine_tiles(animation_tiles).load()
+                    #combine the timeslice vals with the intermediate for the true value @ that timeslice
+                    if time_range_index > 0 and query.animated_product != "scene":
+                        animated_data = processing_options['chunk_combination_method'](animated_data, previous_frame)
+                    animation_out = animated_data
+
+                    # save for later tiff + png conversion after masking with final wofs
+                    put_tile(animated_data, base_temp_path + query.query_id, str(animation_tile_count))
+                    # remove all the intermediates for this timeslice
+                    for tile_name in tile_names:
+                        delete_tile(tile_directory, tile_name)
+                    animated_data = None
+                    animation_tile_count += 1
+
+                #shutil.rmtree(base_temp_path + query.query_id +
+                #          '/' + str(time_range_index))
+        animation_out = None
+
+        dataset_out_water = load_accumulated_product(base_temp_path + query.query_id, 'water')
+        dataset_out_tsm = load_accumulated_product(base_temp_path + query.query_id, 'tsm')
 
         latitude = dataset_out_water.latitude
         longitude = dataset_out_water.longitude
@@ -275,8 +330,8 @@ def perform_tsm_analysis(query_id, user_id, single=False):
         #filter for wofs>0.8
         dataset_out = mask_tsm(dataset_out_tsm.drop('total_data'), dataset_out_water)
 
-        geotransform = [dataset_out.longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, dataset_out.latitude.values[0], 0.0, product_details.resolution.values[0][0]]
+        geotransform = [dataset_out.longitude.values[0], resolution[1],
+                        0.0, dataset_out.latitude.values[0], 0.0, resolution[0]]
         crs = str("EPSG:4326")
 
         # populate metadata values.
@@ -306,20 +361,18 @@ def perform_tsm_analysis(query_id, user_id, single=False):
             # the data.
             # dataset_out_tsm.variable.values[dataset_out_water.normalized_data.values < 0.8] = 0
             for index in range(len(acquisitions)):
-                 nc_path = base_temp_path + query.query_id + \
-                             '/' + str(index) + ".nc"
                  geotiff_path = base_temp_path + query.query_id + '/' + \
                      str(index) + '.tif'
                  png_path = base_temp_path + query.query_id + \
                      '/' + str(index) + '.png'
-                 animated_data = xr.open_dataset(nc_path).load()
+                 animated_data = get_tile(base_temp_path + query.query_id, str(index))
                  if query.animated_product != "scene":
                      animated_data = mask_tsm(animated_data.drop('total_data'), dataset_out_water)
                  else:
                      animated_data.tsm.values[dataset_out_water.normalized_data.values < 0.8] = 0
                  # get metadata needed for tif creation.
-                 geotransform = [dataset_out.longitude.values[0], product_details.resolution.values[0][1],
-                                 0.0, dataset_out.latitude.values[0], 0.0, product_details.resolution.values[0][0]]
+                 geotransform = [dataset_out.longitude.values[0], resolution[1],
+                                 0.0, dataset_out.latitude.values[0], 0.0, resolution[0]]
                  crs = str("EPSG:4326")
 
                  save_to_geotiff(geotiff_path, gdal.GDT_Float64, animated_data, geotransform, crs,
@@ -380,15 +433,22 @@ def perform_tsm_analysis(query_id, user_id, single=False):
         result.status = "OK"
         result.total_scenes = len(acquisitions)
         result.save()
+
+        # the water totals are the water detection product for the same query.
+        if water_query_id is not None:
+            create_water_query_results(water_query_id, dataset_out_water, acquisition_metadata, acquisitions, resolution)
         print("Finished processing results")
         # all data has been processed, create results and finish up.
         query.complete = True
         query.query_end = datetime.datetime.now()
         query.save()
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
 
     except:
         error_with_message(
             result, "There was an exception when handling this query.")
+        fail_water_query(water_query_id)
         raise
     # end error wrapping.
 
@@ -409,15 +469,46 @@ def generate_tsm_chunk(time_num, chunk_num, processing_options=None, query=None,
     tsm_analysis = None
     acquisition_metadata = {}
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    # animations need every frame so they can't be served from the chunk cache.
+    # the water totals are stored under the same name as water_detection's so either app can reuse them,
+    # tsm is stored separately and both are needed to skip the chunk.
+    water_cache_key = None
+    tsm_cache_key = None
+    if query.animated_product == "None" and is_cache_enabled():
+        water_cache_key = get_chunk_key(query.product, water_product_name, lat_range, lon_range, acquisition_list, platform=query.platform, area_id=query.area_id)
+        tsm_cache_key = get_chunk_key(query.product, tsm_product_name, lat_range, lon_range, acquisition_list, platform=query.platform, area_id=query.area_id)
+        water_cached = load_chunk(water_cache_key)
+        tsm_cached = load_chunk(tsm_cache_key) if water_cached is not None else None
+        if tsm_cached is not None and set(water_cached[1].keys()) == set(tsm_cached[1].keys()):
+            print("Using cached chunk: " + str(time_num) + " " + str(chunk_num))
+            acquisition_metadata = combine_tsm_metadata(water_cached[1], tsm_cached[1])
+            water_path = fold_chunk(water_cached[0]['water'], base_temp_path + query.query_id, 'water', chunk_num, time_num, processing_options['chunk_combination_method'])
+            tsm_path = fold_chunk(tsm_cached[0]['tsm'], base_temp_path + query.query_id, 'tsm', chunk_num, time_num, processing_options['chunk_combination_method'])
+            increment_progress(query.query_id)
+            return [water_path, tsm_path, acquisition_metadata]
+    # only scenes that aren't in the stored totals for this tile and year need to be processed.
+    # the stored water and tsm totals can only be continued together if they cover the same scenes.
+    water_summary_key = None
+    tsm_summary_key = None
+    summarized_times = set()
+    chunk_acquisitions = acquisition_list
+    if processing_options['incremental'] and query.animated_product == "None":
+        water_summary_key = get_summary_key(query.product, water_product_name, lat_range, lon_range, platform=query.platform, area_id=query.area_id, year=acquisition_list[0].year)
+        tsm_summary_key = get_summary_key(query.product, tsm_product_name, lat_range, lon_range, platform=query.platform, area_id=query.area_id, year=acquisition_list[0].year)
+        water_summary = load_summary(water_summary_key, chunk_acquisitions)
+        tsm_summary = load_summary(tsm_summary_key, chunk_acquisitions) if water_summary is not None else None
+        if tsm_summary is not None and water_summary[2] == tsm_summary[2]:
+            summarized = water_summary[2]
+            water_analysis = water_summary[0]['water']
+            tsm_analysis = tsm_summary[0]['tsm']
+            acquisition_metadata = combine_tsm_metadata(water_summary[1], tsm_summary[1])
+            acquisition_list = [acquisition for acquisition in chunk_acquisitions if acquisition not in summarized]
+            summarized_times = set(acquisition_metadata.keys())
+            print("Using stored summary, " + str(len(acquisition_list)) + " new acquisitions.")
     # holds some acquisition based metadata.
     while time_index < len(acquisition_list):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return
-        if result.status == "CANCEL":
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
 
@@ -434,39 +525,45 @@ def generate_tsm_chunk(time_num, chunk_num, processing_options=None, query=None,
         if query.platform == "LANDSAT_ALL":
             datasets_in = []
             for index in range(len(products)):
-                dataset = dc.get_dataset_by_extent(products[index]+query.area_id, product_type=None, platform=platforms[index], time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
+                dataset = get_cached_dataset(dc, products[index]+query.area_id, product_type=None, platform=platforms[index], time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
                 if 'time' in dataset:
                     datasets_in.append(dataset.copy(deep=True))
                 dataset = None
             if len(datasets_in) > 0:
                 raw_data = xr.concat(datasets_in, 'time')
         else:
-            raw_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
+            raw_data = get_cached_dataset(dc, query.product, product_type=None, platform=query.platform, time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
 
         # get the actual data and perform analysis.
         if raw_data is None or "cf_mask" not in raw_data:
             time_index = time_index + processing_options['time_slices_per_iteration']
             continue
+        # a window between new acquisitions can take in scenes that are already in the stored summary,
+        # so those are dropped rather than counted twice.
+        if len(summarized_times) > 0:
+            times = [time if type(time) == datetime.datetime else datetime.datetime.utcfromtimestamp(time.astype(int) * 1e-9) for time in raw_data.time.values]
+            raw_data = raw_data.isel(time=[index for index in range(len(times)) if times[index] not in summarized_times])
+            if len(raw_data.time) == 0:
+                time_index = time_index + processing_options['time_slices_per_iteration']
+                continue
         clean_mask = create_cfmask_clean_mask(raw_data.cf_mask)
 
-        wofs_data = processing_options['processing_method'](raw_data, clean_mask=clean_mask, enforce_float64=True)
-        water_analysis = perform_timeseries_analysis_iterative(wofs_data, intermediate_product=water_analysis)
-        #filter for swir2<1%, where valid range=[0,10000] so 1%=100.* scale of 0.0001
-        clean_mask[raw_data.swir2.values > 100] = False
-        #manually set all non-water pixels to nodata.
-        clean_mask[wofs_data.wofs.values == 0] = False
-        tsm_data = tsm(raw_data, clean_mask=clean_mask, no_data=-1)
-        tsm_analysis = perform_timeseries_analysis_iterative(tsm_data, intermediate_product=tsm_analysis, no_data=-1)
+        # water and tsm come out of the same pass, along with the counts for both apps' metadata.
+        wofs_data, tsm_data, water_analysis, tsm_analysis, pixel_counts = classify_water_tsm(raw_data, clean_mask, processing_options['processing_method'],
+                                                                                              water_analysis=water_analysis, tsm_analysis=tsm_analysis)
 
-        # here the clear mask has all the clean pixels for each acquisition.
+        # clean pixels are the ones tsm was computed for, water clean pixels are the ones water was classified for.
         # add to the comma seperated list of data.
         for timeslice in range(clean_mask.shape[0]):
             time = raw_data.time.values[timeslice] if type(raw_data.time.values[timeslice]) == datetime.datetime else datetime.datetime.utcfromtimestamp(raw_data.time.values[timeslice].astype(int) * 1e-9)
-            clean_pixels = np.sum(clean_mask[timeslice, :, :] == True)
             if time not in acquisition_metadata:
                 acquisition_metadata[time] = {}
                 acquisition_metadata[time]['clean_pixels'] = 0
-            acquisition_metadata[time]['clean_pixels'] += clean_pixels
+                acquisition_metadata[time]['water_clean_pixels'] = 0
+                acquisition_metadata[time]['water_pixels'] = 0
+            acquisition_metadata[time]['clean_pixels'] += pixel_counts['tsm_pixels'][timeslice]
+            acquisition_metadata[time]['water_clean_pixels'] += pixel_counts['clean_pixels'][timeslice]
+            acquisition_metadata[time]['water_pixels'] += pixel_counts['water_pixels'][timeslice]
 
             # create the files requied for animation..
             # if the dir doesn't exist, create it, then fill with a .png/.tif
@@ -479,19 +576,108 @@ def generate_tsm_chunk(time_num, chunk_num, processing_options=None, query=None,
                 if not os.path.exists(base_temp_path + query.query_id + '/' + str(time_num)):
                     os.mkdir(base_temp_path + query.query_id +
                              '/' + str(time_num))
-                animated_data.to_netcdf(base_temp_path + query.query_id + '/' + str(
-                    time_num) + '/' + str(chunk_num) + str(time_index + timeslice) + ".nc")
+                put_tile(animated_data, base_temp_path + query.query_id + '/' + str(time_num),
+                         str(chunk_num) + "_" + str(time_index + timeslice))
         time_index = time_index + processing_options['time_slices_per_iteration']
 
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num)
     if water_analysis is None:
+        increment_progress(query.query_id)
         return [None, None, None]
-    water_analysis.to_netcdf(geo_path + "_water.nc")
-    tsm_analysis.to_netcdf(geo_path + "_tsm.nc")
+    # fold this geographic chunk into the accumulated products as soon as it's done.
+    water_path = fold_chunk(water_analysis, base_temp_path + query.query_id, 'water', chunk_num, time_num, processing_options['chunk_combination_method'])
+    tsm_path = fold_chunk(tsm_analysis, base_temp_path + query.query_id, 'tsm', chunk_num, time_num, processing_options['chunk_combination_method'])
+    water_metadata, tsm_metadata = split_tsm_metadata(acquisition_metadata)
+    if water_cache_key is not None:
+        store_chunk(water_cache_key, {'water': water_analysis}, water_metadata)
+        store_chunk(tsm_cache_key, {'tsm': tsm_analysis}, tsm_metadata)
+    if water_summary_key is not None and len(acquisition_list) > 0:
+        save_summary(water_summary_key, {'water': water_analysis}, water_metadata, chunk_acquisitions)
+        save_summary(tsm_summary_key, {'tsm': tsm_analysis}, tsm_metadata, chunk_acquisitions)
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
-    return [geo_path + "_water.nc", geo_path + "_tsm.nc", acquisition_metadata]
+    increment_progress(query.query_id)
+    return [water_path, tsm_path, acquisition_metadata]
+
+@task(name="tsm_chunk_failure")
+def tsm_chunk_failure(task_id, query_id, water_query_id=None):
+    """
+    Error callback for the combine_tsm_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_tsm_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+        water_query_id (string): The ID of the water detection query filled in by the tsm query, or None.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_water_query(water_query_id, user_id=None)
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+    else:
+        if result is not None:
+            error_with_message(result, "There was an exception when handling this query.")
+        fail_water_query(water_query_id)
+
+def create_water_query_results(water_query_id, dataset_out_water, acquisition_metadata, acquisitions, resolution):
+    """
+    Fills in the water detection results from the water totals of a tsm query. The water query may
+    have been submitted by any user, so it's found by query id like the rest of the water detection app.
+    Errors only fail the water detection result - the tsm result is already complete.
+
+    Args:
+        water_query_id (string): The ID of the water detection query.
+        dataset_out_water (Dataset): The combined water totals.
+        acquisition_metadata (dict): acquisition date keyed tsm metadata, including the water counts.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+    """
+    try:
+        water_query = wd_query.objects.filter(query_id=water_query_id).first()
+        water_result = wd_result.objects.filter(query_id=water_query_id).first()
+        if water_query is None or water_result is None:
+            print("Water detection query was removed, nothing to fill in.")
+            return
+        water_metadata = {date: {'clean_pixels': acquisition_metadata[date]['water_clean_pixels'], 'water_pixels': acquisition_metadata[date]['water_pixels']} for date in acquisition_metadata}
+        create_water_results(water_query, water_result, dataset_out_water, water_metadata, acquisitions, resolution)
+        wd_query.objects.filter(query_id=water_query_id).update(complete=True, query_end=datetime.datetime.now())
+    except:
+        fail_water_query(water_query_id)
+        print("There was an exception when creating the water detection results.")
+        traceback.print_exc()
+
+def clear_water_query(water_query_id, user_id):
+    """
+    Removes the water detection query that a cancelled tsm query was filling in.
+
+    Args:
+        water_query_id (string): The ID of the water detection query, or None.
+        user_id (string): The ID of the user that requested the query, or None for any user.
+    """
+    if water_query_id is None:
+        return
+    water_queries = wd_query.objects.filter(query_id=water_query_id, complete=False)
+    if user_id is not None:
+        water_queries = water_queries.filter(user_id=user_id)
+    water_queries.delete()
+    wd_result.objects.filter(query_id=water_query_id, status="WAIT").delete()
+
+def fail_water_query(water_query_id):
+    """
+    Errors out the water detection query that a failed tsm query was filling in.
+
+    Args:
+        water_query_id (string): The ID of the water detection query, or None.
+    """
+    water_result = wd_result.objects.filter(query_id=water_query_id, status="WAIT").first() if water_query_id is not None else None
+    if water_result is not None:
+        wd_error_with_message(water_result, "There was an exception when handling the tsm query for this result.")
 
 # Errors out under specific circumstances, used to pass error msgs to user.
 # uses the result path as a message container: TODO? Change this.
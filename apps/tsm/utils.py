@@ -57,7 +57,7 @@ def create_query_from_post(user_id, post):
                   longitude_max=post['longitude_max'], longitude_min=post['longitude_min'],
                   time_start=start, time_end=end,
                   platform=post['platform'], animated_product=post['animated_product'],
-                  area_id=post['area_id'])
+                  area_id=post['area_id'], include_water=post.get('include_water', 'False') in ['on', 'true', 'True'])
 
     query.title = query.get_type_name() + " Background TSM" if 'title' not in post or post['title'] == '' else post['title']
     query.description = "None" if 'description' not in post or post['description'] == '' else post['description']
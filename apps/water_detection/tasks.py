@@ -21,11 +21,12 @@
 
 # Django specific
 from celery.decorators import task
+from celery import chord
+from celery.utils import uuid
 from celery.signals import worker_process_init, worker_process_shutdown
 from .models import Query, Result, ResultType, Metadata
 from data_cube_ui.models import AnimationType
 
-import numpy as np
 import xarray as xr
 import collections
 import gdal
@@ -38,10 +39,20 @@ from collections import OrderedDict
 from dateutil.tz import tzutc
 
 from utils.data_access_api import DataAccessApi
-from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_cfmask_clean_mask, perform_timeseries_analysis_iterative, split_task
+from utils.dc_utilities import get_spatial_ref, save_to_geotiff, create_cfmask_clean_mask
 from utils.dc_water_classifier import wofs_classify
 
 from data_cube_ui.utils import update_model_bounds_with_dataset
+from data_cube_ui.reduction import create_output_grid, fold_chunk, load_accumulated_product
+from data_cube_ui.execution_plan import ExecutionPlan
+from data_cube_ui.chunk_planner import plan_chunks
+from data_cube_ui.tiling import plan_tiles, get_tile_size, combine_tiles
+from data_cube_ui.tile_transport import put_tile, get_tile, delete_tile, clear_tiles
+from data_cube_ui.chunk_cache import is_cache_enabled, get_chunk_key, load_chunk, store_chunk
+from data_cube_ui.block_cache import get_cached_dataset
+from data_cube_ui.summary_store import get_summary_key, load_summary, save_summary
+from data_cube_ui.water_tsm import classify_water_tsm, water_product_name
+from data_cube_ui.task_control import register_chunk_tasks, is_cancelled, increment_progress, clear_query
 
 # Author: AHDS
 # Creation date: 2016-06-23
@@ -83,6 +94,7 @@ def addition(dataset, dataset_intermediate):
 # holds the different compositing algorithms. Most/least recent, max/min ndvi, median, etc.
 # all options are required. setting None to a option will have the algo/task splitting
 # process disregard it.
+# incremental splits time chunks by year and keeps per tile totals so only new scenes are processed.
 processing_algorithms = {
     'wofs': {
         'geo_chunk_size': 0.5,
@@ -90,7 +102,8 @@ processing_algorithms = {
         'reverse_time': False,
         'time_slices_per_iteration': 1,
         'chunk_combination_method': addition,
-        'processing_method': wofs_classify
+        'processing_method': wofs_classify,
+        'incremental': True
     }
 }
 
@@ -118,9 +131,6 @@ def perform_water_analysis(query_id, user_id, single=False):
 
     print("Got the query, creating metadata.")
 
-    result_type = ResultType.objects.get(
-        satellite_id=query.platform, result_id=query.query_type)
-
     # creates the empty result.
     result = query.generate_result()
 
@@ -151,16 +161,22 @@ def perform_water_analysis(query_id, user_id, single=False):
             error_with_message(result, "There were no acquisitions for this parameter set.")
             return
 
-        processing_options = processing_algorithms['wofs']
+        # chunk sizes are planned from the worker memory budget, with query specific overrides on top.
+        # these go into this query's execution plan rather than the shared profile.
+        algorithm = processing_algorithms['wofs']
+        overrides = plan_chunks(algorithm, product_details.resolution.values[0], measurements, len(acquisitions))
         #if its a single scene, load it all at once to prevent errors.
         if single:
-            processing_options['time_chunks'] = None
-            processing_options['time_slices_per_iteration'] = None
+            overrides['time_chunks'] = None
+            overrides['time_slices_per_iteration'] = None
+        processing_options = ExecutionPlan(algorithm, **overrides)
 
-        lat_ranges, lon_ranges, time_ranges = split_task(resolution=product_details.resolution.values[0][1], latitude=(query.latitude_min, query.latitude_max), longitude=(
-            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'])
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=product_details.resolution.values[0], latitude=(query.latitude_min, query.latitude_max), longitude=(
+            query.longitude_min, query.longitude_max), acquisitions=acquisitions, geo_chunk_size=processing_options['geo_chunk_size'], time_chunks=processing_options['time_chunks'], reverse_time=processing_options['reverse_time'],
+            tile_size=get_tile_size(product_details), group_by_year=processing_options['incremental'])
 
         result.total_scenes = len(time_ranges) * len(lat_ranges)
+        result.save()
 
         # Iterates through the acquisition dates with the step in acquisitions_per_iteration.
         # Uses a time range computed with the index and index+acquisitions_per_iteration.
@@ -171,212 +187,192 @@ def perform_water_analysis(query_id, user_id, single=False):
         if not os.path.exists(base_temp_path + query.query_id):
             os.mkdir(base_temp_path + query.query_id)
             os.chmod(base_temp_path + query.query_id, 0o777)
+        # preallocate the output grid(s) that the chunks write their results directly into.
+        create_output_grid(base_temp_path + query.query_id, 'water', latitude=(query.latitude_min, query.latitude_max),
+                           longitude=(query.longitude_min, query.longitude_max), resolution=product_details.resolution.values[0])
 
-        time_chunk_tasks = []
         print("Time chunks: " + str(len(time_ranges)))
         print("Geo chunks: " + str(len(lat_ranges)))
+
+        # every time/geographic chunk is submitted at once as the header of a chord. The chord
+        # callback does the combination, so this task never blocks a worker waiting on chunks.
+        chunk_tasks = []
         # iterate over the time chunks.
         for time_range_index in range(len(time_ranges)):
             # iterate over the geographic chunks.
-            geo_chunk_tasks = []
             for geographic_chunk_index in range(len(lat_ranges)):
-                geo_chunk_tasks.append(generate_water_chunk.delay(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
-                                       time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index]))
-            time_chunk_tasks.append(geo_chunk_tasks)
+                chunk_tasks.append(generate_water_chunk.s(time_range_index, geographic_chunk_index, processing_options=processing_options, query=query, acquisition_list=time_ranges[
+                                   time_range_index], lat_range=lat_ranges[geographic_chunk_index], lon_range=lon_ranges[geographic_chunk_index]))
+
+        # chunk task ids are assigned up front so queued chunks can be revoked if the query is cancelled.
+        for chunk_task in chunk_tasks:
+            chunk_task.set(task_id=uuid())
+        register_chunk_tasks(query_id, [chunk_task.id for chunk_task in chunk_tasks])
+
+        combination_task = combine_water_chunks.s(query_id, user_id, processing_options=processing_options, time_ranges=time_ranges, geo_chunk_count=len(lat_ranges),
+                                                  acquisitions=acquisitions, resolution=product_details.resolution.values[0])
+        combination_task.link_error(water_chunk_failure.s(query_id))
+        chord(chunk_tasks)(combination_task)
+    except:
+        error_with_message(
+            result, "There was an exception when handling this query.")
+        raise
+    # end error wrapping.
+    return
+
+@task(name="combine_water_chunks")
+def combine_water_chunks(chunk_results, query_id, user_id, processing_options=None, time_ranges=None, geo_chunk_count=None, acquisitions=None, resolution=None):
+    """
+    Chord callback for perform_water_analysis. Receives the results of every generate_water_chunk task
+    ordered by time chunk then geographic chunk, combines them into the final water analysis and
+    creates the result files.
+
+    Args:
+        chunk_results (list): The lists of paths and metadata returned by generate_water_chunk.
+        query_id (string): The ID of the query being processed.
+        user_id (string): The ID of the user that requested the query be made.
+        processing_options (dict): The processing algorithm the chunks were created with.
+        time_ranges (list): The acquisition lists used for each time chunk.
+        geo_chunk_count (int): The number of geographic chunks per time chunk.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        Returns nothing
+    """
+
+    # the result won't exist if the query was removed while the chunks were running.
+    if not Result.objects.filter(query_id=query_id).exists():
+        print("Result does not exist, nothing to combine.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+        return
+
+    query = Query.objects.get(query_id=query_id, user_id=user_id)
+    result = Result.objects.get(query_id=query_id)
+    result_type = ResultType.objects.get(satellite_id=query.platform, result_id=query.query_type)
+
+    try:
+        if "CANCEL" in chunk_results:
+            print("Cancelled task.")
+            shutil.rmtree(base_temp_path + query.query_id)
+            query.delete()
+            result.delete()
+            clear_query(query_id)
+            clear_tiles(base_temp_path + query_id)
+            return
 
-        dataset_out = None
+        # each chunk has already been folded into the accumulator for its geographic chunk,
+        # so only the metadata needs to be compiled here. tile is a list of paths followed by the metadata.
         acquisition_metadata = {}
+        for tile in chunk_results:
+            if tile is None or tile[0] is None:
+                continue
+            tile_metadata = tile[-1]
+            for acquisition_date in tile_metadata:
+                if acquisition_date in acquisition_metadata:
+                    acquisition_metadata[acquisition_date][
+                        'clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
+                    acquisition_metadata[acquisition_date][
+                        'water_pixels'] += tile_metadata[acquisition_date]['water_pixels']
+                else:
+                    acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date][
+                        'clean_pixels'], 'water_pixels': tile_metadata[acquisition_date]['water_pixels']}
+        result.scenes_processed = len(chunk_results)
+        result.save()
+
+        # the last combined animation frame - the true value at the end of the previous time chunk.
+        animation_out = None
         animation_tile_count = 0
-        time_range_index = 0
-        for geographic_group in time_chunk_tasks:
-            full_dataset = None
-            tiles = []
-            for t in geographic_group:
-                tile = t.get()
-                # tile is [path, metadata]. Append tiles to list of tiles for
-                # concat, compile metadata.
-                if tile == "CANCEL":
-                    print("Cancelled task.")
-                    shutil.rmtree(base_temp_path + query.query_id)
-                    query.delete()
-                    result.delete()
-                    return
-                if tile[0] is not None:
-                    tiles.append(tile)
-                result.scenes_processed += 1
-                result.save()
-            print("Got results for a time slice, computing intermediate product..")
-            xr_tiles = []
-            for tile in tiles:
-                tile_metadata = tile[1]
-                for acquisition_date in tile_metadata:
-                    if acquisition_date in acquisition_metadata:
-                        acquisition_metadata[acquisition_date][
-                            'clean_pixels'] += tile_metadata[acquisition_date]['clean_pixels']
-                        acquisition_metadata[acquisition_date][
-                            'water_pixels'] += tile_metadata[acquisition_date]['water_pixels']
-                    else:
-                        acquisition_metadata[acquisition_date] = {'clean_pixels': tile_metadata[acquisition_date][
-                            'clean_pixels'], 'water_pixels': tile_metadata[acquisition_date]['water_pixels']}
-                xr_tiles.append(xr.open_dataset(tile[0]))
-            #combine tiles
-            full_dataset = xr.concat(reversed(xr_tiles), dim='latitude')
-            dataset = full_dataset.load()
-
-            # combine all the intermediate products for the animation creation.
-            if query.animated_product != "None":
-                  print("Num of slices in this chunk: " +
-                        str(len(time_ranges[time_range_index])))
-                  for timeslice in range(len(time_ranges[time_range_index])):
-                      result = Result.objects.get(query_id=query.query_id)
-                      if result.status == "CANCEL":
-                          print("Cancelled task.")
-                          shutil.rmtree(base_temp_path + query.query_id)
-                          query.delete()
-                          result.delete()
-                          return
-                      animation_tiles = []
-                      nc_paths = []
-                      for geoslice in range(len(lat_ranges)):
-                          nc_path = base_temp_path + query.query_id + '/' + \
-                              str(time_range_index) + '/' + \
-                              str(geoslice) + str(timeslice) + ".nc"
-                          nc_paths.append(nc_path)
-                          animation_tiles.append(xr.open_dataset(nc_path))
-
-                      animated_data = xr.concat(
-                          reversed(animation_tiles), dim='latitude').load()
-                      #combine the timeslice vals with the intermediate for the true value @ that timeslice
-                      if time_range_index > 0 and query.animated_product != "scene":
-                          animated_data = processing_options[
-                              'chunk_combination_method'](animated_data, dataset_out)
-
-
-                      tif_path = base_temp_path + query.query_id + '/' + \
-                          str(time_range_index) + '/' + \
-                          str(animation_tile_count) + '.tif'
-                      png_path = base_temp_path + query.query_id + \
-                          '/' + str(animation_tile_count) + '.png'
-                      animation_tile_count += 1
-
-                      # get metadata needed for tif creation.
-                      geotransform = [dataset.longitude.values[0], product_details.resolution.values[0][1],
-                                      0.0, dataset.latitude.values[0], 0.0, product_details.resolution.values[0][0]]
-                      crs = str("EPSG:4326")
-
-                      save_to_geotiff(tif_path, gdal.GDT_Float64, animated_data, geotransform, crs,
-                                      x_pixels=animated_data.dims['longitude'], y_pixels=animated_data.dims['latitude'], band_order=["normalized_data", "total_data", "total_clean"] if query.animated_product != "scene" else None)
-                      animated_data = None
-
-                      animated_product = AnimationType.objects.get(
-                          type_id=query.animated_product)
-                      # create pngs.
-                      cmd = "gdaldem color-relief -of PNG -b " + animated_product.band_number + " " + \
-                          tif_path + " " + \
-                              color_path[
-                                  int(animated_product.band_number) - 1] + " " + png_path
-                      os.system(cmd)
-
-                      cmd = "convert -transparent \"#FFFFFF\" " + png_path + " " + png_path
-                      os.system(cmd)
-
-                      if result_type.fill is not "transparent":
-                          cmd = "convert " + png_path + " -background " + \
-                              result_type.fill + " -alpha remove " + png_path
-                          os.system(cmd)
-                      # remove all the intermediates for this timeslice
-                      for path in nc_paths:
-                          os.remove(path)
-                      os.remove(tif_path)
-                  # remove the tiff.. some of these can be >1gb, so having one
-                  # per scene is too much.
-                  shutil.rmtree(base_temp_path + query.query_id +
-                                '/' + str(time_range_index))
-
-            #add this intermediate product to the total.
-            dataset_out = processing_options[
-                'chunk_combination_method'](dataset, dataset_out)
-            time_range_index += 1
-
-        latitude = dataset_out.latitude
-        longitude = dataset_out.longitude
-
-        geotransform = [dataset_out.longitude.values[0], product_details.resolution.values[0][1],
-                        0.0, dataset_out.latitude.values[0], 0.0, product_details.resolution.values[0][0]]
-        crs = str("EPSG:4326")
-
-        # populate metadata values.
-        dates = list(acquisition_metadata.keys())
-        dates.sort()
-
-        meta = query.generate_metadata(
-            scene_count=len(dates), pixel_count=len(latitude)*len(longitude))
-
-        for date in reversed(dates):
-            meta.acquisition_list += date.strftime("%m/%d/%Y") + ","
-            meta.clean_pixels_per_acquisition += str(
-                acquisition_metadata[date]['clean_pixels']) + ","
-            meta.clean_pixel_percentages_per_acquisition += str(
-                acquisition_metadata[date]['clean_pixels'] * 100 / meta.pixel_count) + ","
-            meta.water_pixels_per_acquisition += str(
-                acquisition_metadata[date]['water_pixels']) + ","
-        meta.save()
-
-        file_path = base_result_path + query_id
-        netcdf_path = file_path + '.nc'
-        tif_path = file_path + '.tif'
-        result_paths = [file_path + '_water_percentage.png', file_path + "_water_observation.png",
-                        file_path + '_clear_observation.png', file_path + '_water_animation.gif']
-        result_filled_paths = [file_path + '_filled_water_percentage.png', file_path +
-                               "_filled_water_observation.png", file_path + '_filled_clear_observation.png']
+
+        # combine all the intermediate products for the animation creation.
+        if query.animated_product != "None":
+            for time_range_index in range(len(time_ranges)):
+                print("Num of slices in this chunk: " +
+                      str(len(time_ranges[time_range_index])))
+                previous_frame = animation_out
+                for timeslice in range(len(time_ranges[time_range_index])):
+                    animation_tiles = []
+                    tile_directory = base_temp_path + query.query_id + '/' + str(time_range_index)
+                    tile_names = [str(geoslice) + "_" + str(timeslice) for geoslice in range(geo_chunk_count)]
+                    for tile_name in tile_names:
+                        animation_tiles.append(get_tile(tile_directory, tile_name))
+
+                    animated_data = combine_tiles(animation_tiles).load()
+                    #combine the timeslice vals with the intermediate for the true value @ that timeslice
+                    if time_range_index > 0 and query.animated_product != "scene":
+                        animated_data = processing_options[
+                            'chunk_combination_method'](animated_data, previous_frame)
+                    animation_out = animated_data
+
+
+                    tif_path = base_temp_path + query.query_id + '/' + \
+                        str(time_range_index) + '/' + \
+                        str(animation_tile_count) + '.tif'
+                    png_path = base_temp_path + query.query_id + \
+                        '/' + str(animation_tile_count) + '.png'
+                    animation_tile_count += 1
+
+                    # get metadata needed for tif creation.
+                    geotransform = [animated_data.longitude.values[0], resolution[1],
+                                    0.0, animated_data.latitude.values[0], 0.0, resolution[0]]
+                    crs = str("EPSG:4326")
+
+                    save_to_geotiff(tif_path, gdal.GDT_Float64, animated_data, geotransform, crs,
+                                    x_pixels=animated_data.dims['longitude'], y_pixels=animated_data.dims['latitude'], band_order=["normalized_data", "total_data", "total_clean"] if query.animated_product != "scene" else None)
+                    animated_data = None
+
+                    animated_product = AnimationType.objects.get(
+                        type_id=query.animated_product)
+                    # create pngs.
+                    cmd = "gdaldem color-relief -of PNG -b " + animated_product.band_number + " " + \
+                        tif_path + " " + \
+                            color_path[
+                                int(animated_product.band_number) - 1] + " " + png_path
+                    os.system(cmd)
+
+                    cmd = "convert -transparent \"#FFFFFF\" " + png_path + " " + png_path
+                    os.system(cmd)
+
+                    if result_type.fill is not "transparent":
+                        cmd = "convert " + png_path + " -background " + \
+                            result_type.fill + " -alpha remove " + png_path
+                        os.system(cmd)
+                    # remove all the intermediates for this timeslice
+                    for tile_name in tile_names:
+                        delete_tile(tile_directory, tile_name)
+                    os.remove(tif_path)
+                # remove the tiff.. some of these can be >1gb, so having one
+                # per scene is too much.
+                shutil.rmtree(base_temp_path + query.query_id +
+                              '/' + str(time_range_index))
+        animation_out = None
+
+        dataset_out = load_accumulated_product(base_temp_path + query.query_id, 'water')
 
         print("Creating query results.")
         if query.animated_product != "None":
             import imageio
-            with imageio.get_writer(file_path + '_water_animation.gif', mode='I', duration=1.0) as writer:
+            with imageio.get_writer(base_result_path + query_id + '_water_animation.gif', mode='I', duration=1.0) as writer:
                 for index in range(len(acquisitions)):
                     image = imageio.imread(
                         base_temp_path + query.query_id + '/' + str(index) + '.png')
                     writer.append_data(image)
-            result.animation_path = result_paths[3]
+            result.animation_path = base_result_path + query_id + '_water_animation.gif'
 
         # get rid of all intermediate products since there are a lot.
         shutil.rmtree(base_temp_path + query.query_id)
 
-        save_to_geotiff(tif_path, gdal.GDT_Float64, dataset_out, geotransform, get_spatial_ref(crs),
-                        x_pixels=dataset_out.dims['longitude'], y_pixels=dataset_out.dims['latitude'], band_order=['normalized_data', 'total_data', 'total_clean'])
-        dataset_out.to_netcdf(netcdf_path)
-
-        # we've got the tif, now do the png set..
-        # uses gdal dem with custom color maps..
-        for index in range(len(color_path)):
-            cmd = "gdaldem color-relief -of PNG -b " + \
-                str(index + 1) + " " + tif_path + " " + \
-                color_path[index] + " " + result_paths[index]
-            os.system(cmd)
-            cmd = "convert -transparent \"#FFFFFF\" " + \
-                result_paths[index] + " " + result_paths[index]
-            os.system(cmd)
-            if result_type.fill is not "transparent":
-                cmd = "convert " + result_paths[index] + " -background " + \
-                    result_type.fill + " -alpha remove " + result_paths[index]
-                os.system(cmd)
-
-        # update the results and finish up.
-        update_model_bounds_with_dataset([result, meta, query], dataset_out)
-        result.data_path = tif_path
-        result.data_netcdf_path = netcdf_path
-        result.result_path = result_paths[0]
-        result.water_observations_path = result_paths[1]
-        result.clear_observations_path = result_paths[2]
-        result.status = "OK"
-        result.total_scenes = len(acquisitions)
-        result.save()
+        create_water_results(query, result, dataset_out, acquisition_metadata, acquisitions, resolution)
         print("Finished processing results")
         # all data has been processed, create results and finish up.
         query.complete = True
         query.query_end = datetime.datetime.now()
         query.save()
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
 
     except:
         error_with_message(
@@ -399,15 +395,34 @@ def generate_water_chunk(time_num, chunk_num, processing_options=None, query=Non
     water_analysis = None
     acquisition_metadata = {}
     print("Starting chunk: " + str(time_num) + " " + str(chunk_num))
+    # animations need every frame so they can't be served from the chunk cache.
+    cache_key = None
+    if query.animated_product == "None" and is_cache_enabled():
+        cache_key = get_chunk_key(query.product, water_product_name, lat_range, lon_range, acquisition_list, platform=query.platform, area_id=query.area_id)
+        cached = load_chunk(cache_key)
+        if cached is not None:
+            print("Using cached chunk: " + str(time_num) + " " + str(chunk_num))
+            cached_products, acquisition_metadata = cached
+            geo_path = fold_chunk(cached_products['water'], base_temp_path + query.query_id, 'water', chunk_num, time_num, processing_options['chunk_combination_method'])
+            increment_progress(query.query_id)
+            return [geo_path, acquisition_metadata]
+    # only scenes that aren't in the stored totals for this tile and year need to be processed.
+    summary_key = None
+    summarized_times = set()
+    chunk_acquisitions = acquisition_list
+    if processing_options['incremental'] and query.animated_product == "None":
+        summary_key = get_summary_key(query.product, water_product_name, lat_range, lon_range, platform=query.platform, area_id=query.area_id, year=acquisition_list[0].year)
+        summary = load_summary(summary_key, chunk_acquisitions)
+        if summary is not None:
+            summary_products, acquisition_metadata, summarized = summary
+            water_analysis = summary_products['water']
+            acquisition_list = [acquisition for acquisition in chunk_acquisitions if acquisition not in summarized]
+            summarized_times = set(acquisition_metadata.keys())
+            print("Using stored summary, " + str(len(acquisition_list)) + " new acquisitions.")
     # holds some acquisition based metadata.
     while time_index < len(acquisition_list):
-        # check if the task has been cancelled. if the result obj doesn't exist anymore then return.
-        try:
-            result = Result.objects.get(query_id=query.query_id)
-        except:
-            print("Cancelled task as result does not exist")
-            return
-        if result.status == "CANCEL":
+        # check if the task has been cancelled or its result removed.
+        if is_cancelled(query.query_id):
             print("Cancelling...")
             return "CANCEL"
 
@@ -424,36 +439,42 @@ def generate_water_chunk(time_num, chunk_num, processing_options=None, query=Non
         if query.platform == "LANDSAT_ALL":
             datasets_in = []
             for index in range(len(products)):
-                dataset = dc.get_dataset_by_extent(products[index]+query.area_id, product_type=None, platform=platforms[index], time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
+                dataset = get_cached_dataset(dc, products[index]+query.area_id, product_type=None, platform=platforms[index], time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
                 if 'time' in dataset:
                     datasets_in.append(dataset.copy(deep=True))
                 dataset = None
             if len(datasets_in) > 0:
                 raw_data = xr.concat(datasets_in, 'time')
         else:
-            raw_data = dc.get_dataset_by_extent(query.product, product_type=None, platform=query.platform, time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
+            raw_data = get_cached_dataset(dc, query.product, product_type=None, platform=query.platform, time=(start, end), longitude=lon_range, latitude=lat_range, measurements=measurements)
 
         # get the actual data and perform analysis.
         if raw_data is None or "cf_mask" not in raw_data:
             time_index = time_index + processing_options['time_slices_per_iteration']
             continue
+        # a window between new acquisitions can take in scenes that are already in the stored summary,
+        # so those are dropped rather than counted twice.
+        if len(summarized_times) > 0:
+            times = [time if type(time) == datetime.datetime else datetime.datetime.utcfromtimestamp(time.astype(int) * 1e-9) for time in raw_data.time.values]
+            raw_data = raw_data.isel(time=[index for index in range(len(times)) if times[index] not in summarized_times])
+            if len(raw_data.time) == 0:
+                time_index = time_index + processing_options['time_slices_per_iteration']
+                continue
         clean_mask = create_cfmask_clean_mask(raw_data.cf_mask)
 
-        wofs_data = processing_options['processing_method'](raw_data, clean_mask=clean_mask, enforce_float64=True)
-        water_analysis = perform_timeseries_analysis_iterative(wofs_data, intermediate_product=water_analysis)
+        wofs_data, tsm_data, water_analysis, tsm_analysis, pixel_counts = classify_water_tsm(raw_data, clean_mask, processing_options['processing_method'],
+                                                                                              water_analysis=water_analysis, compute_tsm=False)
 
         # here the clear mask has all the clean pixels for each acquisition.
         # add to the comma seperated list of data.
         for timeslice in range(clean_mask.shape[0]):
             time = raw_data.time.values[timeslice] if type(raw_data.time.values[timeslice]) == datetime.datetime else datetime.datetime.utcfromtimestamp(raw_data.time.values[timeslice].astype(int) * 1e-9)
-            clean_pixels = np.sum(clean_mask[timeslice, :, :] == True)
-            water_pixels = np.sum(wofs_data.wofs.values[timeslice, :, :] == 1)
             if time not in acquisition_metadata:
                 acquisition_metadata[time] = {}
                 acquisition_metadata[time]['clean_pixels'] = 0
                 acquisition_metadata[time]['water_pixels'] = 0
-            acquisition_metadata[time]['clean_pixels'] += clean_pixels
-            acquisition_metadata[time]['water_pixels'] += water_pixels
+            acquisition_metadata[time]['clean_pixels'] += pixel_counts['clean_pixels'][timeslice]
+            acquisition_metadata[time]['water_pixels'] += pixel_counts['water_pixels'][timeslice]
 
             # create the files requied for animation..
             # if the dir doesn't exist, create it, then fill with a .png/.tif
@@ -466,19 +487,122 @@ def generate_water_chunk(time_num, chunk_num, processing_options=None, query=Non
                 if not os.path.exists(base_temp_path + query.query_id + '/' + str(time_num)):
                     os.mkdir(base_temp_path + query.query_id +
                              '/' + str(time_num))
-                animated_data.to_netcdf(base_temp_path + query.query_id + '/' + str(
-                    time_num) + '/' + str(chunk_num) + str(time_index + timeslice) + ".nc")
+                put_tile(animated_data, base_temp_path + query.query_id + '/' + str(time_num),
+                         str(chunk_num) + "_" + str(time_index + timeslice))
         time_index = time_index + processing_options['time_slices_per_iteration']
 
-    # Save this geographic chunk to disk.
-    geo_path = base_temp_path + query.query_id + "/geo_chunk_" + \
-        str(time_num) + "_" + str(chunk_num) + ".nc"
     if water_analysis is None:
+        increment_progress(query.query_id)
         return [None, None]
-    water_analysis.to_netcdf(geo_path)
+    # fold this geographic chunk into the accumulated product as soon as it's done.
+    geo_path = fold_chunk(water_analysis, base_temp_path + query.query_id, 'water', chunk_num, time_num, processing_options['chunk_combination_method'])
+    if cache_key is not None:
+        store_chunk(cache_key, {'water': water_analysis}, acquisition_metadata)
+    if summary_key is not None and len(acquisition_list) > 0:
+        save_summary(summary_key, {'water': water_analysis}, acquisition_metadata, chunk_acquisitions)
     print("Done with chunk: " + str(time_num) + " " + str(chunk_num))
+    increment_progress(query.query_id)
     return [geo_path, acquisition_metadata]
 
+@task(name="water_chunk_failure")
+def water_chunk_failure(task_id, query_id):
+    """
+    Error callback for the combine_water_chunks chord. Celery calls this with the id of the chord
+    callback when any of the generate_water_chunk tasks raise, as the callback will never run.
+
+    Args:
+        task_id (string): The id of the chord callback that failed.
+        query_id (string): The ID of the query being processed.
+    """
+    result = Result.objects.filter(query_id=query_id).first()
+    # revoked chunks from a cancelled query fail the chord as well, clean those up rather than erroring.
+    if is_cancelled(query_id):
+        print("Cancelled task.")
+        if os.path.exists(base_temp_path + query_id):
+            shutil.rmtree(base_temp_path + query_id)
+        Query.objects.filter(query_id=query_id).delete()
+        if result is not None:
+            result.delete()
+        clear_query(query_id)
+        clear_tiles(base_temp_path + query_id)
+    elif result is not None:
+        error_with_message(result, "There was an exception when handling this query.")
+
+def create_water_results(query, result, dataset_out, acquisition_metadata, acquisitions, resolution):
+    """
+    Creates the metadata and result files for a water analysis and fills in the result. Used for
+    water_detection queries as well as tsm queries that also produce the water detection results.
+
+    Args:
+        query (Query): The water detection query.
+        result (Result): The result for the query.
+        dataset_out (Dataset): The combined water totals.
+        acquisition_metadata (dict): acquisition date keyed clean_pixels and water_pixels.
+        acquisitions (list): All acquisition dates for the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+    """
+    result_type = ResultType.objects.get(satellite_id=query.platform, result_id=query.query_type)
+
+    latitude = dataset_out.latitude
+    longitude = dataset_out.longitude
+
+    geotransform = [dataset_out.longitude.values[0], resolution[1],
+                    0.0, dataset_out.latitude.values[0], 0.0, resolution[0]]
+    crs = str("EPSG:4326")
+
+    # populate metadata values.
+    dates = list(acquisition_metadata.keys())
+    dates.sort()
+
+    meta = query.generate_metadata(
+        scene_count=len(dates), pixel_count=len(latitude)*len(longitude))
+
+    for date in reversed(dates):
+        meta.acquisition_list += date.strftime("%m/%d/%Y") + ","
+        meta.clean_pixels_per_acquisition += str(
+            acquisition_metadata[date]['clean_pixels']) + ","
+        meta.clean_pixel_percentages_per_acquisition += str(
+            acquisition_metadata[date]['clean_pixels'] * 100 / meta.pixel_count) + ","
+        meta.water_pixels_per_acquisition += str(
+            acquisition_metadata[date]['water_pixels']) + ","
+    meta.save()
+
+    file_path = base_result_path + query.query_id
+    netcdf_path = file_path + '.nc'
+    tif_path = file_path + '.tif'
+    result_paths = [file_path + '_water_percentage.png', file_path + "_water_observation.png",
+                    file_path + '_clear_observation.png']
+
+    save_to_geotiff(tif_path, gdal.GDT_Float64, dataset_out, geotransform, get_spatial_ref(crs),
+                    x_pixels=dataset_out.dims['longitude'], y_pixels=dataset_out.dims['latitude'], band_order=['normalized_data', 'total_data', 'total_clean'])
+    dataset_out.to_netcdf(netcdf_path)
+
+    # we've got the tif, now do the png set..
+    # uses gdal dem with custom color maps..
+    for index in range(len(color_path)):
+        cmd = "gdaldem color-relief -of PNG -b " + \
+            str(index + 1) + " " + tif_path + " " + \
+            color_path[index] + " " + result_paths[index]
+        os.system(cmd)
+        cmd = "convert -transparent \"#FFFFFF\" " + \
+            result_paths[index] + " " + result_paths[index]
+        os.system(cmd)
+        if result_type.fill is not "transparent":
+            cmd = "convert " + result_paths[index] + " -background " + \
+                result_type.fill + " -alpha remove " + result_paths[index]
+            os.system(cmd)
+
+    # update the results and finish up.
+    update_model_bounds_with_dataset([result, meta, query], dataset_out)
+    result.data_path = tif_path
+    result.data_netcdf_path = netcdf_path
+    result.result_path = result_paths[0]
+    result.water_observations_path = result_paths[1]
+    result.clear_observations_path = result_paths[2]
+    result.status = "OK"
+    result.total_scenes = len(acquisitions)
+    result.save()
+
 # Errors out under specific circumstances, used to pass error msgs to user.
 # uses the result path as a message container: TODO? Change this.
 def error_with_message(result, message):
@@ -19,7 +19,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-from .models import Query, ResultType
+from .models import Query, Result, ResultType
 from data_cube_ui.models import Area, Satellite
 from datetime import datetime
 
@@ -66,3 +66,35 @@ def create_query_from_post(user_id, post):
     if not Query.objects.filter(query_id=query.query_id).exists():
         query.save()
     return query.query_id
+
+def create_query_from_tsm_query(tsm_query):
+    """
+    Creates a water detection query covering the same area and time as a tsm query, for tsm queries
+    that fill in the water detection results as well.
+
+    Args:
+        tsm_query (tsm.models.Query): The tsm query that will produce the water detection results.
+
+    Returns:
+        query_id (string): The ID of the water detection query, or None if it already has a result.
+    """
+
+    # the background colors mostly match between the apps, fall back to transparent for the others.
+    query_type = tsm_query.query_type if ResultType.objects.filter(result_id=tsm_query.query_type, satellite_id=tsm_query.platform).exists() else "transparent_background"
+    query = Query(query_start=datetime.now(), query_end=datetime.now(), user_id=tsm_query.user_id,
+                  query_type=query_type,
+                  latitude_max=tsm_query.latitude_max, latitude_min=tsm_query.latitude_min,
+                  longitude_max=tsm_query.longitude_max, longitude_min=tsm_query.longitude_min,
+                  time_start=tsm_query.time_start, time_end=tsm_query.time_end, platform=tsm_query.platform,
+                  animated_product="None", area_id=tsm_query.area_id, product=tsm_query.product)
+
+    query.title = query.get_type_name() + " Background WOfS" if tsm_query.title == '' else tsm_query.title
+    query.description = tsm_query.description
+
+    query.query_id = query.generate_query_id()
+    if Result.objects.filter(query_id=query.query_id).exists():
+        return None
+    if not Query.objects.filter(query_id=query.query_id).exists():
+        query.save()
+    query.generate_result()
+    return query.query_id
@@ -0,0 +1,244 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import json
+import shutil
+import socket
+import hashlib
+import datetime
+from collections import OrderedDict
+from django.conf import settings
+
+from data_cube_ui.utils import get_redis_connection
+from data_cube_ui.tile_transport import write_raw_dataset, read_raw_dataset
+
+"""
+Least recently used cache of raw datacube loads. Several apps load the same measurements for the
+same product, tile and time range, so back to back or concurrent analyses over an area read the
+data from storage once and serve every later identical load from the cache.
+
+Blocks are keyed on the product, the load parameters (platform, extent, time window) and the
+acquisitions the index lists for them, so newly ingested scenes are never missed. Blocks remember
+the measurements they were loaded with - a load for a subset of those measurements is served
+from the same block. By default each worker process keeps its own blocks in memory, up to
+BLOCK_CACHE_QUOTA bytes. If BLOCK_CACHE_SHARED_PATH is set the blocks are instead written there
+as raw arrays (see tile_transport) and memory mapped when read, so every worker on the node
+shares them - point it at a tmpfs like /dev/shm. Setting the quota to None disables the cache.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+measurements_name = 'measurements.json'
+
+# key -> (measurements, dataset, size) for the worker local cache, least recently used first.
+blocks = OrderedDict()
+cached_bytes = 0
+
+
+def is_cache_enabled():
+    return getattr(settings, 'BLOCK_CACHE_QUOTA', None) is not None
+
+
+def _get_shared_path():
+    return getattr(settings, 'BLOCK_CACHE_SHARED_PATH', None)
+
+
+def _format_value(value):
+    if isinstance(value, (tuple, list)):
+        return [_format_value(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, float):
+        return round(value, 10)
+    return str(value)
+
+
+def get_block_key(product, **parameters):
+    """
+    Gets the cache key for a load. The measurements aren't part of the key - see _covers.
+
+    Args:
+        product (string): The datacube product, e.g. ls7_ledaps_general.
+        parameters: the rest of the get_dataset_by_extent arguments, e.g. platform, time, latitude.
+
+    Returns:
+        string: a hex digest identifying the load.
+    """
+    content = [product, sorted((key, _format_value(value)) for key, value in parameters.items())]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def _get_size(dataset):
+    return sum(dataset[key].values.nbytes for key in dataset.variables)
+
+
+def _covers(stored_measurements, measurements):
+    # a block loaded with every measurement can serve any load.
+    if stored_measurements is None:
+        return True
+    return measurements is not None and set(measurements) <= set(stored_measurements)
+
+
+def _select(dataset, measurements):
+    if measurements is None:
+        return dataset
+    return dataset.drop([key for key in dataset.data_vars if key not in measurements])
+
+
+def get_cached_dataset(dc, product, measurements=None, **parameters):
+    """
+    Loads data with dc.get_dataset_by_extent, serving it from the block cache if the same load was
+    done before. The returned dataset can be modified without affecting the cache.
+
+    Args:
+        dc (DataAccessApi): The worker's datacube instance.
+        product (string): The datacube product, e.g. ls7_ledaps_general.
+        measurements (list): The measurements to load, None for all of them.
+        parameters: the rest of the get_dataset_by_extent arguments, e.g. platform, time, latitude.
+
+    Returns:
+        Dataset: the loaded data.
+    """
+    if not is_cache_enabled():
+        return dc.get_dataset_by_extent(product, measurements=measurements, **parameters)
+    # the acquisitions in the window are part of the key, so scenes ingested after a block was cached
+    # give the load a new key rather than serving the stale block.
+    acquisitions = dc.list_acquisition_dates(parameters.get('platform'), product, time=parameters.get('time'),
+                                             longitude=parameters.get('longitude'), latitude=parameters.get('latitude'))
+    key = get_block_key(product, acquisitions=acquisitions, **parameters)
+    dataset = load_block(key, measurements)
+    if dataset is not None:
+        return dataset
+    dataset = dc.get_dataset_by_extent(product, measurements=measurements, **parameters)
+    if dataset is not None:
+        store_block(key, measurements, dataset)
+    return dataset
+
+
+def load_block(key, measurements):
+    """
+    Gets a cached block and marks it as recently used.
+
+    Args:
+        key (string): The key from get_block_key.
+        measurements (list): The measurements needed, None for all of them.
+
+    Returns:
+        Dataset: the requested measurements of the block, or None if they aren't cached.
+    """
+    shared_path = _get_shared_path()
+    if shared_path is None:
+        if key not in blocks or not _covers(blocks[key][0], measurements):
+            return None
+        block = blocks.pop(key)
+        blocks[key] = block
+        return _select(block[1], measurements).copy(deep=True)
+    path = os.path.join(shared_path, key)
+    try:
+        with open(os.path.join(path, measurements_name)) as measurements_file:
+            stored_measurements = json.load(measurements_file)
+        if not _covers(stored_measurements, measurements):
+            return None
+        # memory mapped copy on write, so the block is shared through the page cache but can still be modified.
+        dataset = read_raw_dataset(path)
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        # not cached, or evicted while being read.
+        return None
+    return _select(dataset, measurements)
+
+
+def store_block(key, measurements, dataset):
+    """
+    Adds a block to the cache, evicting least recently used blocks if it's over quota. Blocks
+    larger than the quota aren't cached.
+
+    Args:
+        key (string): The key from get_block_key.
+        measurements (list): The measurements the block was loaded with, None for all of them.
+        dataset (Dataset): The loaded data.
+    """
+    global cached_bytes
+    size = _get_size(dataset)
+    if size > settings.BLOCK_CACHE_QUOTA:
+        return
+    shared_path = _get_shared_path()
+    if shared_path is None:
+        if key in blocks:
+            cached_bytes -= blocks.pop(key)[2]
+        # the caller gets the original, so the cache keeps its own copy.
+        blocks[key] = (measurements, dataset.copy(deep=True), size)
+        cached_bytes += size
+        while cached_bytes > settings.BLOCK_CACHE_QUOTA:
+            cached_bytes -= blocks.popitem(last=False)[1][2]
+        return
+    path = os.path.join(shared_path, key)
+    # written to a temporary directory and renamed so readers never see a partial block.
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    write_raw_dataset(temp_path, dataset)
+    with open(os.path.join(temp_path, measurements_name), 'w') as measurements_file:
+        json.dump(measurements, measurements_file)
+    # a block with fewer measurements is replaced by this one.
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # another worker cached the same block first.
+        shutil.rmtree(temp_path, ignore_errors=True)
+    evict()
+
+
+def _get_directory_size(path):
+    size = 0
+    for root, directories, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+
+def evict():
+    """
+    Removes least recently used blocks from BLOCK_CACHE_SHARED_PATH until it's within
+    BLOCK_CACHE_QUOTA. Only one worker per node evicts at a time - the others just skip it.
+    """
+    lock = get_redis_connection().lock("block_cache:evict:" + socket.gethostname(), timeout=600)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        shared_path = _get_shared_path()
+        entries = []
+        for key in os.listdir(shared_path):
+            path = os.path.join(shared_path, key)
+            if key.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), _get_directory_size(path), path))
+        total = sum(entry[1] for entry in entries)
+        for last_used, size, path in sorted(entries):
+            if total <= settings.BLOCK_CACHE_QUOTA:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+    finally:
+        lock.release()
@@ -0,0 +1,171 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import datetime
+from django.conf import settings
+
+from data_cube_ui.utils import get_redis_connection
+from data_cube_ui.tile_transport import write_raw_dataset, read_raw_dataset
+
+"""
+Content addressed cache of chunk results shared between queries. A chunk's products only depend
+on the product, the algorithm, the tile bounds and the acquisitions it loads, so they're keyed
+on exactly that rather than the query id - any later query whose tiles and time chunks line up
+with an earlier one reuses the cached chunk instead of loading and processing it again. Interior
+tiles fall on a global pixel/storage tile grid (see tiling.plan_tiles) so overlapping queries
+share them even when their bounds differ.
+
+Entries live under CHUNK_CACHE_PATH and are evicted least recently used first once the cache
+grows past CHUNK_CACHE_QUOTA bytes. Setting the quota to None disables the cache.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+metadata_name = 'metadata.pickle'
+
+
+def _get_entry_path(key):
+    return os.path.join(settings.CHUNK_CACHE_PATH, key)
+
+
+def is_cache_enabled():
+    return getattr(settings, 'CHUNK_CACHE_QUOTA', None) is not None
+
+
+def _format_date(date):
+    if isinstance(date, datetime.datetime):
+        return date.isoformat()
+    return str(date)
+
+
+def get_chunk_key(product, algorithm, lat_range, lon_range, acquisitions, **parameters):
+    """
+    Gets the cache key for a chunk.
+
+    Args:
+        product (string): The datacube product, e.g. ls7_ledaps_general.
+        algorithm (string): Name of the algorithm producing the chunk, e.g. the compositor.
+        lat_range, lon_range (tuple): The (min, max) bounds of the tile.
+        acquisitions (list): The acquisition dates the chunk loads.
+        parameters: anything else the result depends on, e.g. the measurements.
+
+    Returns:
+        string: a hex digest identifying the chunk's content.
+    """
+    content = [product, algorithm,
+               [round(float(value), 10) for value in list(lat_range) + list(lon_range)],
+               sorted(_format_date(date) for date in acquisitions),
+               sorted((key, str(value)) for key, value in parameters.items())]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def load_chunk(key):
+    """
+    Gets a cached chunk result and marks it as recently used.
+
+    Args:
+        key (string): The key from get_chunk_key.
+
+    Returns:
+        products (dict): product name -> Dataset, or None if the chunk isn't cached.
+        metadata: the acquisition metadata stored with the chunk.
+    """
+    if not is_cache_enabled():
+        return None
+    path = _get_entry_path(key)
+    try:
+        with open(os.path.join(path, metadata_name), 'rb') as metadata_file:
+            stored = pickle.load(metadata_file)
+        products = {name: read_raw_dataset(os.path.join(path, name)) for name in stored['products']}
+        os.utime(path, None)
+    except (IOError, OSError):
+        # not cached, or evicted while being read.
+        return None
+    return products, stored['metadata']
+
+
+def store_chunk(key, products, metadata):
+    """
+    Adds a chunk result to the cache, evicting least recently used entries if it's over quota.
+
+    Args:
+        key (string): The key from get_chunk_key.
+        products (dict): product name -> Dataset for every product the chunk produced.
+        metadata: the acquisition metadata for the chunk.
+    """
+    if not is_cache_enabled():
+        return
+    path = _get_entry_path(key)
+    if os.path.exists(path):
+        return
+    # written to a temporary directory and renamed so readers never see a partial entry.
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    for name in products:
+        write_raw_dataset(os.path.join(temp_path, name), products[name])
+    with open(os.path.join(temp_path, metadata_name), 'wb') as metadata_file:
+        pickle.dump({'products': list(products.keys()), 'metadata': metadata}, metadata_file)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # another worker cached the same chunk first.
+        shutil.rmtree(temp_path, ignore_errors=True)
+    evict()
+
+
+def _get_size(path):
+    size = 0
+    for root, directories, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return size
+
+
+def evict():
+    """
+    Removes least recently used entries until the cache is within CHUNK_CACHE_QUOTA. Only one
+    worker evicts at a time - the others just skip it.
+    """
+    lock = get_redis_connection().lock("chunk_cache:evict", timeout=600)
+    if not lock.acquire(blocking=False):
+        return
+    try:
+        entries = []
+        for key in os.listdir(settings.CHUNK_CACHE_PATH):
+            path = _get_entry_path(key)
+            if key.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            entries.append((os.path.getmtime(path), _get_size(path), path))
+        total = sum(entry[1] for entry in entries)
+        for last_used, size, path in sorted(entries):
+            if total <= settings.CHUNK_CACHE_QUOTA:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+    finally:
+        lock.release()
@@ -0,0 +1,142 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import math
+
+from django.conf import settings
+
+"""
+Plans chunk sizes from a per worker memory budget rather than using fixed constants. The
+geographic chunk size in square degrees is derived from the product resolution, the number of
+measurements loaded and the number of acquisitions each chunk holds in memory at once, so the
+largest chunk that fits in the budget is used and the task count is kept as low as possible.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+# bytes per value of the raw measurements - landsat surface reflectance is int16.
+bytes_per_value = 2
+# the processing methods create masks, float copies etc. of the raw data while they run.
+working_copies = 4
+# bytes per pixel per measurement held in the intermediate product between iterations.
+intermediate_bytes_per_value = 8
+# chunks smaller than this are more overhead than work, so fewer slices are loaded per iteration instead.
+min_chunk_pixels = 500 * 500
+# histogram medians keep uint16 counts for every measurement, plus cumulative counts/masks for one at a time.
+histogram_bytes_per_bin = 2
+histogram_working_bytes_per_bin = 5
+
+
+def get_histogram_bins(radix_bits):
+    """
+    Gets the largest number of bins per pixel a StreamingMedian holds for a measurement.
+
+    Args:
+        radix_bits (int): The median_radix_bits of the algorithm or None if it isn't a histogram median.
+
+    Returns:
+        int: the number of bins, 0 for algorithms without histograms.
+    """
+    if radix_bits is None:
+        return 0
+    # the first pass has 2^radix_bits bins, the second two histograms of the remaining bits.
+    return max(2 ** radix_bits, 2 * 2 ** (16 - radix_bits))
+
+
+def estimate_chunk_bytes(pixels, measurement_count, slices_in_memory, histogram_bins=0):
+    """
+    Estimates the peak memory used by a chunk.
+
+    Args:
+        pixels (int): The number of pixels in the chunk.
+        measurement_count (int): The number of measurements loaded.
+        slices_in_memory (int): The number of acquisitions loaded at once.
+        histogram_bins (int): Histogram bins per pixel per measurement, for histogram medians.
+
+    Returns:
+        int: the estimated number of bytes.
+    """
+    per_pixel = measurement_count * (slices_in_memory * bytes_per_value * working_copies + intermediate_bytes_per_value)
+    per_pixel += histogram_bins * (measurement_count * histogram_bytes_per_bin + histogram_working_bytes_per_bin)
+    return pixels * per_pixel
+
+
+def plan_chunks(algorithm, resolution, measurements, acquisition_count, memory_budget=None):
+    """
+    Computes the chunking options for a query so every chunk fits in the memory budget.
+    Algorithms that process a whole time chunk at once (time_slices_per_iteration of None,
+    e.g. median) hold every acquisition in memory so get smaller geographic chunks, while
+    iterative algorithms load fewer slices per iteration if the budget is tight. Histogram
+    medians (median_radix_bits) also account for their per pixel histograms, and fall back to
+    holding every acquisition at once when that takes less memory.
+
+    Args:
+        algorithm (dict): The algorithm profile from processing_algorithms.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+        measurements (list): The measurements that are loaded.
+        acquisition_count (int): The number of acquisitions in the query.
+        memory_budget (int): Bytes available to a single chunk. Defaults to settings.CHUNK_MEMORY_BUDGET.
+
+    Returns:
+        dict: geo_chunk_size, time_chunks and time_slices_per_iteration overrides for an ExecutionPlan,
+            plus median_radix_bits of None if a histogram median should hold every acquisition instead.
+    """
+    memory_budget = memory_budget if memory_budget is not None else settings.CHUNK_MEMORY_BUDGET
+    acquisition_count = max(acquisition_count, 1)
+    measurement_count = len(measurements)
+    histogram_bins = get_histogram_bins(algorithm.get('median_radix_bits'))
+    overrides = {}
+
+    # there is no point in having more time chunks than acquisitions.
+    time_chunks = algorithm['time_chunks']
+    if time_chunks is not None:
+        time_chunks = min(time_chunks, acquisition_count)
+
+    slices_per_iteration = algorithm['time_slices_per_iteration']
+    # the histograms cost more than holding every acquisition at once unless there are hundreds of them,
+    # so the median is only built from histograms when that takes less memory per pixel.
+    if histogram_bins > 0:
+        slices_per_time_chunk = int(math.ceil(acquisition_count / float(time_chunks))) if time_chunks is not None else acquisition_count
+        if estimate_chunk_bytes(1, measurement_count, slices_per_time_chunk) <= estimate_chunk_bytes(1, measurement_count, slices_per_iteration, histogram_bins):
+            histogram_bins = 0
+            slices_per_iteration = None
+            overrides['median_radix_bits'] = None
+
+    if slices_per_iteration is None:
+        slices_in_memory = int(math.ceil(acquisition_count / float(time_chunks))) if time_chunks is not None else acquisition_count
+    else:
+        slices_per_iteration = min(slices_per_iteration, acquisition_count)
+        # load fewer slices at a time rather than making chunks too small to be worthwhile.
+        while slices_per_iteration > 1 and estimate_chunk_bytes(min_chunk_pixels, measurement_count, slices_per_iteration, histogram_bins) > memory_budget:
+            slices_per_iteration -= 1
+        slices_in_memory = slices_per_iteration
+
+    chunk_pixels = memory_budget / float(estimate_chunk_bytes(1, measurement_count, slices_in_memory, histogram_bins))
+    pixels_per_square_degree = 1.0 / abs(resolution[0] * resolution[1])
+
+    overrides.update({'geo_chunk_size': chunk_pixels / pixels_per_square_degree,
+                      'time_chunks': time_chunks,
+                      'time_slices_per_iteration': slices_per_iteration})
+    return overrides
@@ -0,0 +1,79 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from collections.abc import Mapping
+
+"""
+Per query execution plans. The processing_algorithms dicts in each app's tasks are shared
+profiles tuned for typical queries - a plan is an immutable copy of one of those profiles with
+any query specific overrides applied, so nothing a single query does can change the chunking
+used by later queries on the same worker.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+
+class ExecutionPlan(Mapping):
+    """
+    Read only processing options for a single query. Supports the same key access as the
+    processing_algorithms dicts, e.g. plan['geo_chunk_size'], so it can be passed straight to
+    the chunk tasks.
+
+    Args:
+        algorithm (dict): The algorithm profile from processing_algorithms.
+        **overrides: Query specific values for options in the profile.
+
+    Raises:
+        KeyError: if an override isn't an option of the algorithm profile.
+    """
+
+    def __init__(self, algorithm, **overrides):
+        options = dict(algorithm)
+        for option in overrides:
+            if option not in options:
+                raise KeyError("Unknown processing option: " + option)
+        options.update(overrides)
+        self._options = options
+
+    def __getitem__(self, option):
+        return self._options[option]
+
+    def __iter__(self):
+        return iter(self._options)
+
+    def __len__(self):
+        return len(self._options)
+
+    def __repr__(self):
+        return "ExecutionPlan(" + repr(self._options) + ")"
+
+    def with_overrides(self, **overrides):
+        """
+        Creates a new plan from this one with additional overrides, leaving this plan unchanged.
+
+        Returns:
+            ExecutionPlan: the new plan.
+        """
+        return ExecutionPlan(self._options, **overrides)
@@ -0,0 +1,217 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+"""
+Exact per pixel median built from mergeable histograms rather than holding every time slice in
+memory. Values are shifted into the unsigned 16 bit range and split into a high and low part of
+radix_bits each. The first pass over the acquisitions counts the high parts per pixel, which
+gives the bucket holding the median and its rank within that bucket. The second pass counts the
+low parts of only the values in that bucket, which gives the exact value. Counts from any number
+of time slices/iterations simply add, so memory depends on the chunk size and number of bins,
+not on the number of acquisitions. The histograms take about 1kB per pixel per measurement, so
+they only pay off for chunks with many acquisitions - see chunk_planner.plan_chunks.
+
+A median of a QA band like cf_mask is meaningless, so a QA band is summarized instead - see
+create_cf_mask.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+nodata = -9999
+# shifts int16 values to 0-65535 so they can be split into buckets.
+offset = 32768
+value_bits = 16
+
+
+# cf_mask values used for the summarized QA band.
+cf_mask_clear = 0
+cf_mask_water = 1
+cf_mask_fill = 255
+
+
+def count_cf_mask(cf_mask, clean_mask):
+    """
+    Counts the clean and water observations of every pixel over time.
+
+    Args:
+        cf_mask (np.ndarray): The cf_mask values with time, latitude and longitude dimensions.
+        clean_mask (np.ndarray): Boolean mask of clean pixels, shaped like the cf_mask.
+
+    Returns:
+        clean_counts, water_counts (np.ndarray): the counts over latitude/longitude.
+    """
+    clean_mask = np.asarray(clean_mask)
+    clean_counts = np.sum(clean_mask, axis=0, dtype=np.int32)
+    water_counts = np.sum(clean_mask & (np.asarray(cf_mask) == cf_mask_water), axis=0, dtype=np.int32)
+    return clean_counts, water_counts
+
+
+def create_cf_mask(clean_counts, water_counts):
+    """
+    Creates a cf_mask for a composite from the counts of count_cf_mask - fill where a pixel had no
+    clean observations, water where most of its clean observations were water, clear otherwise.
+
+    Args:
+        clean_counts, water_counts (np.ndarray): The counts over latitude/longitude.
+
+    Returns:
+        np.ndarray: the cf_mask values.
+    """
+    cf_mask = np.where(water_counts * 2 > clean_counts, cf_mask_water, cf_mask_clear).astype(np.int16)
+    cf_mask[clean_counts == 0] = cf_mask_fill
+    return cf_mask
+
+
+def _get_cumulative(histogram):
+    return np.cumsum(histogram, axis=1, dtype=np.uint32)
+
+
+def _find_rank(histogram, rank):
+    """
+    Finds the bin holding the value of a given rank for every pixel, and the rank of that value
+    within its bin.
+    """
+    cumulative = _get_cumulative(histogram)
+    bins = np.argmax(cumulative > rank[:, np.newaxis], axis=1)
+    pixels = np.arange(histogram.shape[0])
+    remaining = rank - (cumulative[pixels, bins] - histogram[pixels, bins])
+    return bins, remaining
+
+
+class StreamingMedian(object):
+    """
+    Computes the median over time of every variable in a series of datasets, ignoring nodata
+    and values outside a clean mask. Call add for every time slice/iteration, then next_pass -
+    the acquisitions need to be added again until next_pass returns False. get_result then
+    gives the median as a dataset with the same variables. If qa_band is set that variable isn't
+    medianed but summarized with create_cf_mask.
+    """
+
+    def __init__(self, radix_bits=8, qa_band=None):
+        self.radix_bits = radix_bits
+        self.low_bits = value_bits - radix_bits
+        self.qa_band = qa_band
+        self.pass_index = 0
+        self.histograms = OrderedDict()
+        self.buckets = OrderedDict()
+        self.qa_counts = None
+        self.latitude = None
+        self.longitude = None
+
+    def _get_keys(self, values):
+        return values.astype(np.int32) + offset
+
+    def add(self, dataset, clean_mask):
+        """
+        Adds time slices to the histograms for the current pass.
+
+        Args:
+            dataset (Dataset): The raw data with time, latitude and longitude dimensions.
+            clean_mask (np.ndarray): Boolean mask of clean pixels, shaped like the data.
+        """
+        if self.latitude is None:
+            self.latitude = dataset.latitude.values
+            self.longitude = dataset.longitude.values
+        pixel_count = len(self.latitude) * len(self.longitude)
+        pixel_ids = np.arange(pixel_count)
+        if self.qa_band is not None and self.qa_band in dataset and self.pass_index == 0:
+            counts = count_cf_mask(dataset[self.qa_band].values, clean_mask)
+            self.qa_counts = counts if self.qa_counts is None else (self.qa_counts[0] + counts[0], self.qa_counts[1] + counts[1])
+        for key in dataset.data_vars:
+            if key == self.qa_band:
+                continue
+            values = dataset[key].values.reshape(len(dataset.time), pixel_count)
+            valid = (values != nodata) & np.asarray(clean_mask).reshape(values.shape)
+            keys = self._get_keys(values)
+            if self.pass_index == 0:
+                bins = 2 ** self.radix_bits
+                if key not in self.histograms:
+                    self.histograms[key] = np.zeros((pixel_count, bins), dtype=np.uint16)
+                histogram = self.histograms[key].reshape(-1)
+                for timeslice in range(values.shape[0]):
+                    # every pixel adds at most one count per slice, so the indices are unique.
+                    selected = valid[timeslice]
+                    histogram[pixel_ids[selected] * bins + (keys[timeslice][selected] >> self.low_bits)] += 1
+            else:
+                bins = 2 ** self.low_bits
+                high = keys >> self.low_bits
+                low = keys & (bins - 1)
+                # one histogram for the bucket of the lower median and one for the upper.
+                for bucket, histogram in zip(self.buckets[key][:2], self.histograms[key]):
+                    histogram = histogram.reshape(-1)
+                    for timeslice in range(values.shape[0]):
+                        selected = valid[timeslice] & (high[timeslice] == bucket)
+                        histogram[pixel_ids[selected] * bins + low[timeslice][selected]] += 1
+
+    def next_pass(self):
+        """
+        Finishes the current pass.
+
+        Returns:
+            bool: True if the acquisitions need to be added again for another pass.
+        """
+        if self.pass_index > 0:
+            self.pass_index += 1
+            return False
+        for key in list(self.histograms):
+            histogram = self.histograms[key]
+            counts = histogram.sum(axis=1, dtype=np.uint32)
+            # the lower and upper median are the same value for an odd number of observations.
+            lower_rank = (np.maximum(counts, 1) - 1) // 2
+            upper_rank = np.maximum(counts, 1) // 2
+            lower_bucket, lower_remaining = _find_rank(histogram, lower_rank)
+            upper_bucket, upper_remaining = _find_rank(histogram, upper_rank)
+            self.buckets[key] = (lower_bucket, upper_bucket, lower_remaining, upper_remaining, counts)
+            self.histograms[key] = [np.zeros((histogram.shape[0], 2 ** self.low_bits), dtype=np.uint16) for _ in range(2)]
+        self.pass_index += 1
+        return True
+
+    def get_result(self):
+        """
+        Gets the median once every pass is done.
+
+        Returns:
+            Dataset: the median of every variable over latitude/longitude or None if nothing was added.
+        """
+        if self.latitude is None:
+            return None
+        shape = (len(self.latitude), len(self.longitude))
+        data_vars = OrderedDict()
+        for key in self.histograms:
+            lower_bucket, upper_bucket, lower_remaining, upper_remaining, counts = self.buckets[key]
+            lower_low, _ = _find_rank(self.histograms[key][0], lower_remaining)
+            upper_low, _ = _find_rank(self.histograms[key][1], upper_remaining)
+            lower = ((lower_bucket.astype(np.int32) << self.low_bits) + lower_low) - offset
+            upper = ((upper_bucket.astype(np.int32) << self.low_bits) + upper_low) - offset
+            median = ((lower + upper) / 2.0).astype(np.int16)
+            median[counts == 0] = nodata
+            data_vars[key] = (('latitude', 'longitude'), median.reshape(shape))
+        if self.qa_counts is not None:
+            data_vars[self.qa_band] = (('latitude', 'longitude'), create_cf_mask(*self.qa_counts))
+        return xr.Dataset(data_vars, coords={'latitude': self.latitude, 'longitude': self.longitude})
@@ -20,9 +20,14 @@
 # under the License.
 
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.apps import apps
 
 import datetime
 
+from data_cube_ui.task_control import cancel_query
+
 """
 Holds models and base classes common to applications.
 Satellites, Areas, etc. are used in every app,
@@ -274,6 +279,20 @@ class Result(models.Model):
     class Meta:
         abstract = True
 
+# the chunks of a running query only poll redis, so removing its models - e.g. through the
+# admin - signals them to stop the same way cancelling does.
+@receiver(post_delete)
+def stop_deleted_query(sender, instance, **kwargs):
+    """
+    Stops the tasks of a running query once its Result, or the last Query sharing its id, is deleted.
+    """
+    if isinstance(instance, Result) and instance.status == "WAIT":
+        cancel_query(instance.query_id)
+    elif isinstance(instance, Query) and not sender.objects.filter(query_id=instance.query_id).exists():
+        # removing the running result cancels the query through the branch above.
+        result_model = apps.get_model(sender._meta.app_label, 'Result')
+        result_model.objects.filter(query_id=instance.query_id, status="WAIT").delete()
+
 class ResultType(models.Model):
     """
     Stores a single instance of a ResultType object that contains all the information for requests
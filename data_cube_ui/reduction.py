@@ -0,0 +1,319 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import json
+import math
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+from data_cube_ui.utils import get_redis_connection
+
+"""
+Streaming reduction of chunk results. The master preallocates an output grid for each product
+from the query bounds and product resolution, and every chunk task folds its finished tile
+directly into its own lat/lon window of that grid as soon as it's done, in whatever order the
+chunks finish. The grid is a set of memory mapped arrays on disk - one per variable - so
+neither the chunks nor the master ever hold more than a single tile/the final product in memory.
+
+Combination methods like fill_nodata depend on time chunk order, so the grid keeps a rank
+array holding the index of the time chunk that supplied each pixel. Lower time chunk
+indices have priority, exactly as if the chunks had been combined in submission order.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+# rank of pixels that no chunk has been written to yet.
+max_rank = np.iinfo(np.int16).max
+nodata = -9999
+# the filled markers only matter while a query runs.
+key_expiry = 60 * 60 * 24
+
+
+def get_grid_path(directory, product):
+    """
+    Gets the directory holding the output grid for a product.
+
+    Args:
+        directory (string): The temp directory for the query.
+        product (string): Name of the product being accumulated, e.g. 'mosaic'.
+
+    Returns:
+        string: path to the output grid directory.
+    """
+    return os.path.join(directory, product + "_grid")
+
+
+def _filled_key(path, geo_chunk):
+    return "reduction:" + path + ":" + str(geo_chunk) + ":filled"
+
+
+def get_nodata_fraction(data_array):
+    """
+    Gets the fraction of pixels in a DataArray that are nodata.
+
+    Args:
+        data_array (DataArray): The data to check, e.g. a band of a mosaic.
+
+    Returns:
+        float: the fraction of -9999 values.
+    """
+    return np.count_nonzero(data_array.values == nodata) / float(data_array.size)
+
+
+def fill_nodata(dataset, dataset_intermediate):
+    """
+    Combines two datasets by filling the nodata pixels of the intermediate product with
+    values from the new dataset. Used for recent/least recent style combinations where the
+    intermediate has priority. The nodata mask is computed once from the first variable
+    and the new dataset is updated in place, so neither dataset is copied - the intermediate
+    is never modified so it can be combined with several datasets.
+
+    Args:
+        dataset (Dataset): The new data, used wherever the intermediate is nodata.
+        dataset_intermediate (Dataset): The accumulated product or None.
+
+    Returns:
+        Dataset: the combined product - either one of the inputs or the updated dataset.
+    """
+    if dataset_intermediate is None:
+        return dataset
+    data_vars = list(dataset_intermediate.data_vars)
+    valid = dataset_intermediate[data_vars[0]].values != nodata
+    # nothing left to fill or nothing to keep, no need to touch any bands.
+    if valid.all():
+        return dataset_intermediate
+    if not valid.any():
+        return dataset
+    for key in data_vars:
+        dataset[key].values[valid] = dataset_intermediate[key].values[valid]
+    return dataset
+
+
+def is_tile_filled(directory, product, geo_chunk, time_chunk):
+    """
+    Checks if lower time chunks have already filled a tile of a product, in which case a
+    fill_nodata style combination can't use anything from this time chunk.
+
+    Args:
+        directory (string): The temp directory for the query.
+        product (string): Name of the product being accumulated, e.g. 'mosaic'.
+        geo_chunk (int): Index of the geographic chunk.
+        time_chunk (int): Index of the time chunk.
+
+    Returns:
+        bool: True if the time chunk can be skipped.
+    """
+    filled_rank = get_redis_connection().get(_filled_key(get_grid_path(directory, product), geo_chunk))
+    return filled_rank is not None and int(filled_rank) < time_chunk
+
+
+def _read_header(path):
+    with open(os.path.join(path, "grid.json")) as header_file:
+        return json.load(header_file)
+
+
+def _write_header(path, header):
+    # write to a temp file and rename so a reader never sees a partial header.
+    with open(os.path.join(path, "grid.json.tmp"), 'w') as header_file:
+        json.dump(header, header_file)
+    os.rename(os.path.join(path, "grid.json.tmp"), os.path.join(path, "grid.json"))
+
+
+def _open_array(path, name, dtype, shape, mode='r+'):
+    return np.memmap(os.path.join(path, name + ".dat"), dtype=dtype, mode=mode, shape=tuple(shape))
+
+
+def _create_array(path, name, dtype, shape, fill_value):
+    array = _open_array(path, name, dtype, shape, mode='w+')
+    array[:] = fill_value
+    array.flush()
+    return array
+
+
+def create_output_grid(directory, product, latitude, longitude, resolution):
+    """
+    Preallocates the output grid for a product covering the query bounds. Data variables
+    are allocated when the first tile is folded in, as their names and types come from the
+    processing method.
+
+    Args:
+        directory (string): The temp directory for the query.
+        product (string): Name of the product being accumulated, e.g. 'mosaic'.
+        latitude (tuple): (min, max) latitude of the query.
+        longitude (tuple): (min, max) longitude of the query.
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+
+    Returns:
+        string: path to the output grid directory.
+    """
+    path = get_grid_path(directory, product)
+    if not os.path.exists(path):
+        os.mkdir(path)
+    latitude_resolution = abs(resolution[0])
+    longitude_resolution = abs(resolution[1])
+    # pad by a pixel on each side as pixel centers don't necessarily line up with the query bounds.
+    origin = (latitude[1] + latitude_resolution, longitude[0] - longitude_resolution)
+    shape = (int(math.ceil((latitude[1] - latitude[0]) / latitude_resolution)) + 3,
+             int(math.ceil((longitude[1] - longitude[0]) / longitude_resolution)) + 3)
+
+    _create_array(path, 'chunk_rank', np.int16, shape, max_rank)
+    _create_array(path, 'latitude', np.float64, (shape[0],), origin[0] - np.arange(shape[0]) * latitude_resolution)
+    _create_array(path, 'longitude', np.float64, (shape[1],), origin[1] + np.arange(shape[1]) * longitude_resolution)
+    _write_header(path, {'origin': origin, 'resolution': (latitude_resolution, longitude_resolution), 'shape': shape, 'variables': []})
+    return path
+
+
+def _get_window(header, dataset):
+    """Gets the row/column slices covered by a tile, clipped to the grid."""
+    row = int(round((header['origin'][0] - dataset.latitude.values[0]) / header['resolution'][0]))
+    column = int(round((dataset.longitude.values[0] - header['origin'][1]) / header['resolution'][1]))
+    rows = (max(row, 0), min(row + len(dataset.latitude), header['shape'][0]))
+    columns = (max(column, 0), min(column + len(dataset.longitude), header['shape'][1]))
+    tile_window = (slice(rows[0] - row, rows[1] - row), slice(columns[0] - column, columns[1] - column))
+    return (slice(*rows), slice(*columns)), tile_window
+
+
+def fold_chunk(dataset, directory, product, geo_chunk, time_chunk, combination_method, nodata_threshold=None):
+    """
+    Folds the result of a single chunk into its window of the product's output grid. Chunks
+    can be folded in any order - a redis lock serializes the read/modify/write for each
+    window, and the rank array keeps order dependent combination methods correct.
+
+    Args:
+        dataset (Dataset): The chunk result, 2d over latitude/longitude.
+        directory (string): The temp directory for the query.
+        product (string): Name of the product being accumulated, e.g. 'mosaic'.
+        geo_chunk (int): Index of the geographic chunk.
+        time_chunk (int): Index of the time chunk - lower indices have priority.
+        combination_method (function): combines two datasets, e.g. fill_nodata.
+            Called as combination_method(dataset, dataset_intermediate) where the
+            intermediate has priority. It isn't called for a window nothing has been folded into yet.
+        nodata_threshold (float): If set, the tile is marked as filled once its nodata fraction
+            is at or below this so later time chunks can stop early - see is_tile_filled.
+
+    Returns:
+        string: path to the output grid that was updated.
+    """
+    path = get_grid_path(directory, product)
+    data_vars = list(dataset.data_vars)
+    connection = get_redis_connection()
+
+    # the first tile for a product allocates the data variables.
+    with connection.lock("reduction:" + path, timeout=600):
+        header = _read_header(path)
+        if len(header['variables']) == 0:
+            for key in data_vars:
+                _create_array(path, key, dataset[key].dtype, header['shape'], nodata)
+            header['variables'] = [(key, dataset[key].dtype.str) for key in data_vars]
+            _write_header(path, header)
+
+    window, tile_window = _get_window(header, dataset)
+    tile = dataset.isel(latitude=tile_window[0], longitude=tile_window[1])
+    shape = header['shape']
+
+    with connection.lock("reduction:" + path + ":" + str(geo_chunk), timeout=600):
+        rank = _open_array(path, 'chunk_rank', np.int16, shape)
+        accumulated_rank = np.array(rank[window])
+        # pixels no chunk has been written to yet take the tile as is.
+        empty = accumulated_rank == max_rank
+        # pixels where the new chunk comes before whatever is already accumulated.
+        priority = accumulated_rank > time_chunk
+
+        accumulated = OrderedDict((key, _open_array(path, key, dtype, shape)) for key, dtype in header['variables'])
+        if empty.all():
+            # nothing to combine with, so the tile is written as is without calling the combination method.
+            for key in data_vars:
+                accumulated[key][window] = tile[key].values
+                accumulated[key].flush()
+            rank[window] = time_chunk
+        else:
+            preferred = tile.copy(deep=True)
+            other = tile.copy(deep=True)
+            for key in data_vars:
+                accumulated_window = accumulated[key][window]
+                preferred[key].values = np.where(priority, tile[key].values, accumulated_window)
+                other[key].values = np.where(priority, accumulated_window, tile[key].values)
+
+            combined = combination_method(other, preferred)
+            for key in data_vars:
+                accumulated[key][window] = np.where(empty, tile[key].values, combined[key].values)
+                accumulated[key].flush()
+
+            valid = preferred[data_vars[0]].values != nodata
+            preferred_rank = np.where(priority, time_chunk, accumulated_rank)
+            other_rank = np.where(priority, accumulated_rank, time_chunk)
+            rank[window] = np.where(empty | valid, preferred_rank, other_rank)
+        rank.flush()
+
+        # every pixel now comes from a time chunk no later than the highest rank in the window.
+        if nodata_threshold is not None and np.mean(accumulated[data_vars[0]][window] == nodata) <= nodata_threshold:
+            filled_rank = int(rank[window].max())
+            previous_rank = connection.get(_filled_key(path, geo_chunk))
+            if previous_rank is None or filled_rank < int(previous_rank):
+                connection.setex(_filled_key(path, geo_chunk), key_expiry, filled_rank)
+
+        latitude = _open_array(path, 'latitude', np.float64, (shape[0],))
+        longitude = _open_array(path, 'longitude', np.float64, (shape[1],))
+        latitude[window[0]] = tile.latitude.values
+        longitude[window[1]] = tile.longitude.values
+        latitude.flush()
+        longitude.flush()
+    return path
+
+
+def load_accumulated_product(directory, product):
+    """
+    Loads the fully reduced product once every chunk has been folded in, trimmed to the
+    extent that was actually written. The variables are copy on write views of the grid
+    rather than copies, so the product is only paged in as it's used.
+
+    Args:
+        directory (string): The temp directory for the query.
+        product (string): Name of the product being accumulated, e.g. 'mosaic'.
+
+    Returns:
+        Dataset: the combined product or None if no chunk produced any data.
+    """
+    path = get_grid_path(directory, product)
+    if not os.path.exists(path):
+        return None
+    header = _read_header(path)
+    if len(header['variables']) == 0:
+        return None
+    shape = header['shape']
+
+    written = _open_array(path, 'chunk_rank', np.int16, shape, mode='r') != max_rank
+    rows = np.where(written.any(axis=1))[0]
+    columns = np.where(written.any(axis=0))[0]
+    window = (slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1))
+
+    data_vars = OrderedDict()
+    for key, dtype in header['variables']:
+        data_vars[key] = (('latitude', 'longitude'), _open_array(path, key, dtype, shape, mode='c')[window])
+    coords = {'latitude': np.array(_open_array(path, 'latitude', np.float64, (shape[0],), mode='r')[window[0]]),
+              'longitude': np.array(_open_array(path, 'longitude', np.float64, (shape[1],), mode='r')[window[1]])}
+    return xr.Dataset(data_vars, coords=coords)
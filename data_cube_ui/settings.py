@@ -32,6 +32,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+from celery.schedules import crontab
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -186,7 +187,8 @@ CELERY_ROUTES = {'generate_mosaic_chunk': {'queue': 'chunk_processing'},
                  'generate_tsm_chunk': {'queue': 'chunk_processing'},
                  'generate_fractional_cover_chunk': {'queue': 'chunk_processing'},
                  'generate_slip_chunk': {'queue': 'chunk_processing'},
-                 'generate_ndvi_anomaly_chunk': {'queue': 'chunk_processing'}}
+                 'generate_ndvi_anomaly_chunk': {'queue': 'chunk_processing'},
+                 'update_ndvi_climatology_chunk': {'queue': 'chunk_processing'}}
 
 BROKER_URL = 'redis://' + MASTER_NODE + ':6379'
 CELERY_RESULT_BACKEND = 'redis://' + MASTER_NODE + ':6379'
@@ -196,3 +198,36 @@ CELERY_RESULT_BACKEND = 'redis://' + MASTER_NODE + ':6379'
 CELERYD_PREFETCH_MULTIPLIER = 1
 CELERY_ACKS_LATE = True
 CELERY_TIMEZONE = 'UTC'
+
+# periodic tasks run by celery beat. The ndvi anomaly climatology is brought up to date with
+# newly ingested acquisitions every night.
+CELERYBEAT_SCHEDULE = {
+    'update_ndvi_climatology': {
+        'task': 'update_ndvi_climatology',
+        'schedule': crontab(hour=2, minute=0),
+    },
+}
+
+# memory available to a single chunk task, used to size chunks. Set this from the worker RAM
+# divided by the number of worker processes per node.
+CHUNK_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+
+# how chunk tasks hand intermediate tiles (animation frames) to the master. 'shared_memory' and
+# 'memmap' need the master and chunks on the same node or a shared filesystem, 'redis' works anywhere.
+TILE_TRANSPORT = 'memmap'
+TILE_SHARED_MEMORY_PATH = '/dev/shm/data_cube_ui/'
+
+# chunk results are cached here and shared between queries. The least recently used are removed
+# once the cache grows past the quota in bytes - set it to None to disable the cache.
+CHUNK_CACHE_PATH = '/datacube/chunk_cache/'
+CHUNK_CACHE_QUOTA = 50 * 1024 * 1024 * 1024
+
+# materialized per tile totals for incremental algorithms like water detection.
+SUMMARY_STORE_PATH = '/datacube/summaries/'
+
+# raw datacube loads are cached on each worker and shared between apps, least recently used are
+# removed once past the quota in bytes - set it to None to disable the cache. The cache is per worker
+# process and comes on top of CHUNK_MEMORY_BUDGET unless BLOCK_CACHE_SHARED_PATH is set, in which case
+# one memory mapped cache there (e.g. on /dev/shm) is shared by every worker on the node.
+BLOCK_CACHE_QUOTA = 512 * 1024 * 1024
+BLOCK_CACHE_SHARED_PATH = None
@@ -0,0 +1,122 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+"""
+Mergeable streaming mean/variance accumulators (Welford, with Chan et al.'s pairwise merge). The
+running state is a dataset of per pixel count, mean and m2 (sum of squared differences from the
+mean), so it can be built up a few time slices at a time, computed separately for every time
+chunk, folded into an output grid like any other product and merged in any order with exactly
+the same result as computing the statistics over every slice at once.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+
+def get_moments(data_array, dim='time'):
+    """
+    Computes the moments of a DataArray over a dimension, ignoring NaN values.
+
+    Args:
+        data_array (DataArray): The data, e.g. ndvi with time, latitude and longitude dimensions.
+        dim (string): The dimension to reduce over.
+
+    Returns:
+        Dataset: count, mean and m2 over the remaining dimensions.
+    """
+    values = data_array.values
+    axis = data_array.get_axis_num(dim)
+    valid = np.isfinite(values)
+    count = valid.sum(axis=axis).astype(np.float64)
+    total = np.where(valid, values, 0).sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, 0)
+    deviation = np.where(valid, values - np.expand_dims(mean, axis), 0)
+    m2 = (deviation ** 2).sum(axis=axis)
+
+    dims = [dimension for dimension in data_array.dims if dimension != dim]
+    coords = OrderedDict((dimension, data_array[dimension].values) for dimension in dims)
+    return xr.Dataset(OrderedDict([('count', (dims, count)), ('mean', (dims, mean)), ('m2', (dims, m2))]), coords=coords)
+
+
+def merge_moments(moments, moments_intermediate):
+    """
+    Merges two sets of moments. Follows the combination method signature so it can be used to
+    fold moments - the new moments are updated in place.
+
+    Args:
+        moments (Dataset): Moments from get_moments.
+        moments_intermediate (Dataset): Moments accumulated so far or None.
+
+    Returns:
+        Dataset: the merged moments.
+    """
+    if moments_intermediate is None:
+        return moments
+    # output grids fill pixels nothing has been written to with nodata.
+    count_a = np.maximum(moments_intermediate['count'].values, 0)
+    count_b = np.maximum(moments['count'].values, 0)
+    count = count_a + count_b
+    delta = moments['mean'].values - moments_intermediate['mean'].values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(count > 0, count_b / count, 0)
+        mean = moments_intermediate['mean'].values + delta * weight
+        m2 = moments_intermediate['m2'].values + moments['m2'].values + delta ** 2 * count_a * weight
+    has_a = count_a > 0
+    has_b = count_b > 0
+    moments['mean'].values = np.where(has_a & has_b, mean, np.where(has_a, moments_intermediate['mean'].values, moments['mean'].values))
+    moments['m2'].values = np.where(has_a & has_b, m2, np.where(has_a, moments_intermediate['m2'].values, moments['m2'].values))
+    moments['count'].values = count
+    return moments
+
+
+def get_mean(moments):
+    """
+    Gets the mean from a set of moments.
+
+    Args:
+        moments (Dataset): Moments from get_moments/merge_moments.
+
+    Returns:
+        DataArray: the mean, NaN where there were no observations.
+    """
+    return moments['mean'].where(moments['count'] > 0)
+
+
+def get_variance(moments, ddof=0):
+    """
+    Gets the variance from a set of moments.
+
+    Args:
+        moments (Dataset): Moments from get_moments/merge_moments.
+        ddof (int): Delta degrees of freedom, 1 for the sample variance.
+
+    Returns:
+        DataArray: the variance, NaN where there weren't enough observations.
+    """
+    return (moments['m2'] / (moments['count'] - ddof)).where(moments['count'] > ddof)
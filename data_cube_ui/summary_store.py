@@ -0,0 +1,132 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import json
+import pickle
+import shutil
+import hashlib
+from django.conf import settings
+
+from data_cube_ui.utils import get_redis_connection
+from data_cube_ui.tile_transport import write_raw_dataset, read_raw_dataset
+
+"""
+Materialized per tile summaries for associative reductions like the water/tsm addition, kept
+under SUMMARY_STORE_PATH. A summary holds the accumulated totals for a tile and period along
+with the acquisitions that went into it. A later chunk covering a superset of those acquisitions
+starts from the summary and only processes the acquisitions that aren't in it yet, then replaces
+the summary with its own result - so the summaries grow as new scenes are ingested rather than
+being recomputed from scratch for every query.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+metadata_name = 'metadata.pickle'
+
+
+def _get_summary_path(key):
+    return os.path.join(settings.SUMMARY_STORE_PATH, key)
+
+
+def _read_metadata(path):
+    with open(os.path.join(path, metadata_name), 'rb') as metadata_file:
+        return pickle.load(metadata_file)
+
+
+def get_summary_key(product, algorithm, lat_range, lon_range, **parameters):
+    """
+    Gets the key for the summary of a tile.
+
+    Args:
+        product (string): The datacube product, e.g. ls7_ledaps_general.
+        algorithm (string): Name of the algorithm producing the summary.
+        lat_range, lon_range (tuple): The (min, max) bounds of the tile.
+        parameters: anything else the summary depends on, e.g. the period it covers.
+
+    Returns:
+        string: a hex digest identifying the summary.
+    """
+    content = [product, algorithm,
+               [round(float(value), 10) for value in list(lat_range) + list(lon_range)],
+               sorted((key, str(value)) for key, value in parameters.items())]
+    return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+def load_summary(key, acquisitions):
+    """
+    Gets the summary for a tile if it can be used for a chunk covering acquisitions.
+
+    Args:
+        key (string): The key from get_summary_key.
+        acquisitions (list): The acquisitions the chunk covers.
+
+    Returns:
+        products (dict): product name -> Dataset holding the summarized totals.
+        metadata: the acquisition metadata stored with the summary.
+        summarized (set): the acquisitions already in the summary.
+        None is returned if there is no summary or it includes acquisitions the chunk doesn't cover.
+    """
+    path = _get_summary_path(key)
+    try:
+        stored = _read_metadata(path)
+        summarized = set(stored['acquisitions'])
+        if not summarized.issubset(set(acquisitions)):
+            return None
+        products = {name: read_raw_dataset(os.path.join(path, name)) for name in stored['products']}
+    except (IOError, OSError):
+        # no summary yet, or it was replaced while being read.
+        return None
+    return products, stored['metadata'], summarized
+
+
+def save_summary(key, products, metadata, acquisitions):
+    """
+    Replaces the summary for a tile, as long as the new one covers everything the stored one does.
+
+    Args:
+        key (string): The key from get_summary_key.
+        products (dict): product name -> Dataset holding the accumulated totals.
+        metadata: the acquisition metadata for the summary.
+        acquisitions (list): Every acquisition that went into the totals.
+    """
+    path = _get_summary_path(key)
+    with get_redis_connection().lock("summary:" + key, timeout=600):
+        try:
+            if not set(_read_metadata(path)['acquisitions']).issubset(set(acquisitions)):
+                return
+        except (IOError, OSError):
+            pass
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        for name in products:
+            write_raw_dataset(os.path.join(temp_path, name), products[name])
+        with open(os.path.join(temp_path, metadata_name), 'wb') as metadata_file:
+            pickle.dump({'products': list(products.keys()), 'metadata': metadata, 'acquisitions': list(acquisitions)}, metadata_file)
+        # a chunk reading during the swap just doesn't find a summary and processes everything.
+        old_path = path + '.' + str(os.getpid()) + '.old'
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(temp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
@@ -0,0 +1,135 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from __future__ import absolute_import
+
+from data_cube_ui.celery import app
+from data_cube_ui.utils import get_redis_connection
+
+"""
+Per query task control shared through redis on the celery broker. Chunk tasks check for
+cancellation here, and cancelling a query revokes any of its chunk tasks that haven't started yet.
+Deleting a running Result or Query, e.g. through the admin, cancels it too - see
+data_cube_ui.models.stop_deleted_query - so chunks only ever check redis. Chunk progress is kept in an
+atomic counter so finished chunks don't each need to update the Result row.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+# keys are only needed while a query runs - expire them so nothing is left behind if a task dies.
+key_expiry = 60 * 60 * 24
+
+
+def _cancel_key(query_id):
+    return "query:" + query_id + ":cancel"
+
+
+def _tasks_key(query_id):
+    return "query:" + query_id + ":tasks"
+
+
+def _progress_key(query_id):
+    return "query:" + query_id + ":progress"
+
+
+def register_chunk_tasks(query_id, task_ids):
+    """
+    Records the ids of the chunk tasks dispatched for a query so they can be revoked.
+
+    Args:
+        query_id (string): The ID of the query being processed.
+        task_ids (list): The ids of the chunk tasks.
+    """
+    connection = get_redis_connection()
+    pipeline = connection.pipeline()
+    pipeline.sadd(_tasks_key(query_id), *task_ids)
+    pipeline.expire(_tasks_key(query_id), key_expiry)
+    pipeline.execute()
+
+
+def cancel_query(query_id):
+    """
+    Signals all tasks for a query to stop and revokes the chunk tasks that are still queued.
+    Chunks that are already running stop at their next iteration.
+
+    Args:
+        query_id (string): The ID of the query to cancel.
+    """
+    connection = get_redis_connection()
+    connection.setex(_cancel_key(query_id), key_expiry, 1)
+    task_ids = [task_id.decode() if isinstance(task_id, bytes) else task_id for task_id in connection.smembers(_tasks_key(query_id))]
+    if len(task_ids) > 0:
+        app.control.revoke(task_ids)
+
+
+def is_cancelled(query_id):
+    """
+    Checks if a query has been cancelled.
+
+    Args:
+        query_id (string): The ID of the query being processed.
+
+    Returns:
+        bool: True if the query has been cancelled.
+    """
+    return get_redis_connection().exists(_cancel_key(query_id))
+
+
+def increment_progress(query_id):
+    """
+    Atomically counts a finished chunk for a query.
+
+    Args:
+        query_id (string): The ID of the query being processed.
+    """
+    connection = get_redis_connection()
+    pipeline = connection.pipeline()
+    pipeline.incr(_progress_key(query_id))
+    pipeline.expire(_progress_key(query_id), key_expiry)
+    pipeline.execute()
+
+
+def get_progress(query_id):
+    """
+    Gets the number of chunks that have finished for a query.
+
+    Args:
+        query_id (string): The ID of the query being processed.
+
+    Returns:
+        int: The number of finished chunks.
+    """
+    progress = get_redis_connection().get(_progress_key(query_id))
+    return int(progress) if progress is not None else 0
+
+
+def clear_query(query_id):
+    """
+    Removes all task control state for a query once it has finished or been cleaned up.
+
+    Args:
+        query_id (string): The ID of the query.
+    """
+    get_redis_connection().delete(_cancel_key(query_id), _tasks_key(query_id), _progress_key(query_id))
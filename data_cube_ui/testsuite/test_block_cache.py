@@ -0,0 +1,133 @@
+# Unit test dependencies
+from django.test import SimpleTestCase, override_settings
+from unittest import mock
+
+# Other dependencies.
+from .. import block_cache
+from .test_reduction import FakeRedis
+import numpy as np
+import xarray as xr
+import datetime
+import tempfile
+import shutil
+import os
+
+
+class FakeDataAccessApi(object):
+    """Counts the loads so cache hits can be told apart from datacube reads."""
+
+    def __init__(self):
+        self.loads = 0
+        self.acquisitions = [datetime.datetime(2005, 1, 1)]
+
+    def list_acquisition_dates(self, platform, product, time=None, longitude=None, latitude=None):
+        return list(self.acquisitions)
+
+    def get_dataset_by_extent(self, product, measurements=None, **parameters):
+        self.loads += 1
+        latitude = np.arange(10, dtype=np.float64)
+        data_vars = {key: (('latitude', 'longitude'), np.full((10, 10), self.loads, dtype=np.int16)) for key in measurements or ['red', 'nir']}
+        return xr.Dataset(data_vars, coords={'latitude': latitude, 'longitude': latitude.copy()})
+
+
+def load(dc, longitude, measurements=['red']):
+    return block_cache.get_cached_dataset(dc, 'ls7_ledaps_kenya', measurements=measurements, platform='LANDSAT_7',
+                                          time=(datetime.datetime(2005, 1, 1), datetime.datetime(2005, 2, 1)),
+                                          latitude=(0.0, 1.0), longitude=longitude)
+
+
+# a block with one measurement takes 360 bytes - 200 for the data and 160 for the coordinates.
+@override_settings(BLOCK_CACHE_QUOTA=800, BLOCK_CACHE_SHARED_PATH=None)
+class TestBlockCache(SimpleTestCase):
+
+    def setUp(self):
+        block_cache.blocks.clear()
+        block_cache.cached_bytes = 0
+        self.dc = FakeDataAccessApi()
+
+    def tearDown(self):
+        block_cache.blocks.clear()
+        block_cache.cached_bytes = 0
+
+    def test_cache_hit(self):
+        first = load(self.dc, (35.0, 36.0))
+        # modifying a loaded dataset doesn't change the cached block.
+        first.red.values[:] = 0
+        second = load(self.dc, (35.0, 36.0))
+        self.assertEqual(self.dc.loads, 1)
+        np.testing.assert_array_equal(second.red.values, 1)
+
+    def test_lru_eviction(self):
+        load(self.dc, (35.0, 36.0))
+        load(self.dc, (36.0, 37.0))
+        # the first block is used again, so the second is the least recently used.
+        load(self.dc, (35.0, 36.0))
+        load(self.dc, (37.0, 38.0))
+        self.assertEqual(self.dc.loads, 3)
+        self.assertLessEqual(block_cache.cached_bytes, 800)
+        self.assertEqual(len(block_cache.blocks), 2)
+        load(self.dc, (35.0, 36.0))
+        self.assertEqual(self.dc.loads, 3)
+        load(self.dc, (36.0, 37.0))
+        self.assertEqual(self.dc.loads, 4)
+
+    def test_measurement_subset(self):
+        load(self.dc, (35.0, 36.0), measurements=None)
+        subset = load(self.dc, (35.0, 36.0), measurements=['nir'])
+        self.assertEqual(self.dc.loads, 1)
+        self.assertEqual(list(subset.data_vars), ['nir'])
+        load(self.dc, (36.0, 37.0), measurements=['red'])
+        load(self.dc, (36.0, 37.0), measurements=['red', 'nir'])
+        self.assertEqual(self.dc.loads, 3)
+
+    def test_new_acquisitions(self):
+        load(self.dc, (35.0, 36.0))
+        self.dc.acquisitions.append(datetime.datetime(2005, 1, 17))
+        load(self.dc, (35.0, 36.0))
+        self.assertEqual(self.dc.loads, 2)
+
+    @override_settings(BLOCK_CACHE_QUOTA=300)
+    def test_block_over_quota(self):
+        load(self.dc, (35.0, 36.0))
+        load(self.dc, (35.0, 36.0))
+        self.assertEqual(self.dc.loads, 2)
+        self.assertEqual(len(block_cache.blocks), 0)
+
+    @override_settings(BLOCK_CACHE_QUOTA=None)
+    def test_disabled(self):
+        load(self.dc, (35.0, 36.0))
+        load(self.dc, (35.0, 36.0))
+        self.assertEqual(self.dc.loads, 2)
+
+
+class TestSharedBlockCache(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch('data_cube_ui.block_cache.get_redis_connection', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dc = FakeDataAccessApi()
+
+    def test_lru_eviction(self):
+        with override_settings(BLOCK_CACHE_SHARED_PATH=self.directory, BLOCK_CACHE_QUOTA=10 * 1024 * 1024):
+            load(self.dc, (35.0, 36.0))
+            load(self.dc, (36.0, 37.0))
+            self.assertEqual(self.dc.loads, 2)
+            blocks = sorted(os.listdir(self.directory))
+            block_size = block_cache._get_directory_size(os.path.join(self.directory, blocks[0]))
+            # the first block is used last, so the second is evicted.
+            paths = [os.path.join(self.directory, block) for block in blocks]
+            for path in paths:
+                os.utime(path, (1000, 1000))
+            load(self.dc, (35.0, 36.0))
+            self.assertEqual(self.dc.loads, 2)
+        with override_settings(BLOCK_CACHE_SHARED_PATH=self.directory, BLOCK_CACHE_QUOTA=int(block_size * 2.5)):
+            load(self.dc, (37.0, 38.0))
+            self.assertEqual(self.dc.loads, 3)
+            self.assertEqual(len(os.listdir(self.directory)), 2)
+            load(self.dc, (35.0, 36.0))
+            self.assertEqual(self.dc.loads, 3)
+            load(self.dc, (36.0, 37.0))
+            self.assertEqual(self.dc.loads, 4)
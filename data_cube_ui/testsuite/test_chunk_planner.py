@@ -0,0 +1,46 @@
+# Unit test dependencies
+from django.test import SimpleTestCase
+
+# Other dependencies.
+from ..chunk_planner import plan_chunks, estimate_chunk_bytes, min_chunk_pixels
+
+resolution = (-0.00027, 0.00027)
+measurements = ['red', 'green', 'blue', 'nir', 'swir1', 'swir2', 'cf_mask']
+memory_budget = 1024 * 1024 * 1024
+
+
+def create_algorithm(time_chunks=None, time_slices_per_iteration=None, median_radix_bits=None):
+    return {'geo_chunk_size': 0.05, 'time_chunks': time_chunks, 'time_slices_per_iteration': time_slices_per_iteration, 'median_radix_bits': median_radix_bits}
+
+
+def get_chunk_pixels(overrides):
+    return overrides['geo_chunk_size'] / abs(resolution[0] * resolution[1])
+
+
+class TestPlanChunks(SimpleTestCase):
+
+    def test_fits_budget(self):
+        for algorithm in [create_algorithm(), create_algorithm(time_chunks=5), create_algorithm(time_slices_per_iteration=10)]:
+            overrides = plan_chunks(algorithm, resolution, measurements, 200, memory_budget=memory_budget)
+            slices = overrides['time_slices_per_iteration'] or (200 // (overrides['time_chunks'] or 1))
+            self.assertLessEqual(estimate_chunk_bytes(get_chunk_pixels(overrides), len(measurements), slices), memory_budget * 1.001)
+
+    def test_time_chunks_limited_by_acquisitions(self):
+        overrides = plan_chunks(create_algorithm(time_chunks=10, time_slices_per_iteration=5), resolution, measurements, 3, memory_budget=memory_budget)
+        self.assertEqual(overrides['time_chunks'], 3)
+        self.assertEqual(overrides['time_slices_per_iteration'], 3)
+
+    def test_fewer_slices_for_small_budget(self):
+        budget = estimate_chunk_bytes(min_chunk_pixels, len(measurements), 4)
+        overrides = plan_chunks(create_algorithm(time_slices_per_iteration=10), resolution, measurements, 100, memory_budget=budget)
+        self.assertEqual(overrides['time_slices_per_iteration'], 4)
+
+    def test_histogram_median_fallback(self):
+        # a few acquisitions take less memory than the histograms, so they're all held at once.
+        overrides = plan_chunks(create_algorithm(time_slices_per_iteration=5, median_radix_bits=8), resolution, measurements, 20, memory_budget=memory_budget)
+        self.assertIsNone(overrides['median_radix_bits'])
+        self.assertIsNone(overrides['time_slices_per_iteration'])
+        # the histograms are around 10kB per pixel, so they need a larger budget to keep chunks worthwhile.
+        overrides = plan_chunks(create_algorithm(time_slices_per_iteration=5, median_radix_bits=8), resolution, measurements, 2000, memory_budget=8 * memory_budget)
+        self.assertNotIn('median_radix_bits', overrides)
+        self.assertEqual(overrides['time_slices_per_iteration'], 5)
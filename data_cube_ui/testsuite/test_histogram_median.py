@@ -0,0 +1,76 @@
+# Unit test dependencies
+from django.test import SimpleTestCase
+
+# Other dependencies.
+from ..histogram_median import StreamingMedian, count_cf_mask, create_cf_mask, nodata, cf_mask_clear, cf_mask_water, cf_mask_fill
+import numpy as np
+import xarray as xr
+
+
+def create_stack(**bands):
+    time_count, latitude_count, longitude_count = list(bands.values())[0].shape
+    data_vars = {key: (('time', 'latitude', 'longitude'), value.astype(np.int16)) for key, value in bands.items()}
+    return xr.Dataset(data_vars, coords={'time': np.arange(time_count), 'latitude': np.arange(latitude_count, dtype=np.float64),
+                                         'longitude': np.arange(longitude_count, dtype=np.float64)})
+
+
+def get_median(values, clean_mask):
+    # the expected result - np.median of the clean, valid values truncated to int16 like the mosaics.
+    values = np.where((values != nodata) & clean_mask, values, np.nan).astype(np.float64)
+    expected = np.full(values.shape[1:], nodata, dtype=np.int16)
+    valid = np.any(np.isfinite(values), axis=0)
+    expected[valid] = np.nanmedian(values[:, valid], axis=0).astype(np.int16)
+    return expected
+
+
+class TestStreamingMedian(SimpleTestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.red = random.randint(-2000, 16000, size=(9, 6, 5))
+        self.red[random.rand(*self.red.shape) < 0.2] = nodata
+        # a pixel without any data.
+        self.red[:, 0, 0] = nodata
+        self.clean_mask = random.rand(*self.red.shape) > 0.2
+        self.cf_mask = np.where(random.rand(*self.red.shape) > 0.5, cf_mask_water, cf_mask_clear)
+
+    def run_median(self, median, dataset, slices_per_iteration):
+        while True:
+            for index in range(0, len(dataset.time), slices_per_iteration):
+                timeslices = slice(index, index + slices_per_iteration)
+                median.add(dataset.isel(time=timeslices), self.clean_mask[timeslices])
+            if not median.next_pass():
+                break
+        return median.get_result()
+
+    def test_matches_numpy_median(self):
+        dataset = create_stack(red=self.red)
+        expected = get_median(self.red, self.clean_mask)
+        for slices_per_iteration in [1, 4, 9]:
+            result = self.run_median(StreamingMedian(), dataset, slices_per_iteration)
+            np.testing.assert_array_equal(result.red.values, expected)
+
+    def test_radix_bits(self):
+        dataset = create_stack(red=self.red)
+        result = self.run_median(StreamingMedian(radix_bits=6), dataset, 3)
+        np.testing.assert_array_equal(result.red.values, get_median(self.red, self.clean_mask))
+
+    def test_qa_band_summarized(self):
+        dataset = create_stack(red=self.red, cf_mask=self.cf_mask)
+        result = self.run_median(StreamingMedian(qa_band='cf_mask'), dataset, 4)
+        np.testing.assert_array_equal(result.red.values, get_median(self.red, self.clean_mask))
+        np.testing.assert_array_equal(result.cf_mask.values, create_cf_mask(*count_cf_mask(self.cf_mask, self.clean_mask)))
+
+    def test_nothing_added(self):
+        self.assertIsNone(StreamingMedian().get_result())
+
+
+class TestCfMask(SimpleTestCase):
+
+    def test_create_cf_mask(self):
+        cf_mask = np.array([[cf_mask_water, cf_mask_water, cf_mask_clear, cf_mask_water]] * 2)
+        clean_mask = np.array([[True, True, True, False], [True, False, True, False]])
+        clean_counts, water_counts = count_cf_mask(cf_mask, clean_mask)
+        np.testing.assert_array_equal(clean_counts, [2, 1, 2, 0])
+        np.testing.assert_array_equal(water_counts, [2, 1, 0, 0])
+        np.testing.assert_array_equal(create_cf_mask(clean_counts, water_counts), [cf_mask_water, cf_mask_water, cf_mask_clear, cf_mask_fill])
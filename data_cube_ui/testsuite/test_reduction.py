@@ -0,0 +1,116 @@
+# Unit test dependencies
+from django.test import SimpleTestCase
+from unittest import mock
+
+# Other dependencies.
+from ..reduction import create_output_grid, fold_chunk, fill_nodata, load_accumulated_product, nodata
+import numpy as np
+import xarray as xr
+import tempfile
+import shutil
+import threading
+import time
+
+
+class FakeRedis(object):
+    """Just enough of a redis connection for the reduction locks and filled markers."""
+
+    def __init__(self):
+        self.values = {}
+        self.locks = {}
+
+    def lock(self, name, timeout=None):
+        # like redis, every lock with the same name is the same lock.
+        return self.locks.setdefault(name, threading.Lock())
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def setex(self, key, expiry, value):
+        self.values[key] = value
+
+
+def create_tile(latitude, longitude, **bands):
+    data_vars = {key: (('latitude', 'longitude'), np.array(value, dtype=np.int16)) for key, value in bands.items()}
+    return xr.Dataset(data_vars, coords={'latitude': latitude, 'longitude': longitude})
+
+
+def max_ndvi(dataset, dataset_intermediate):
+    # reads the ndvi like the max_ndvi combination methods do.
+    keep = ~(dataset.ndvi.values > dataset_intermediate.ndvi.values)
+    for key in list(dataset.data_vars):
+        dataset[key].values[keep] = dataset_intermediate[key].values[keep]
+    return dataset
+
+
+def slow_addition(dataset, dataset_intermediate):
+    # sleeps between reading the accumulated window and writing it back so unserialized folds overlap.
+    time.sleep(0.05)
+    for key in list(dataset.data_vars):
+        dataset[key].values = dataset[key].values + dataset_intermediate[key].values
+    return dataset
+
+
+class TestReduction(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch('data_cube_ui.reduction.get_redis_connection', return_value=FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # a 2x2 pixel query, padded by the grid to 5x5.
+        create_output_grid(self.directory, 'product', latitude=(0.0, 2.0), longitude=(0.0, 2.0), resolution=(-1.0, 1.0))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fold_empty_window_without_combining(self):
+        tile = create_tile([2.0, 1.0], [0.0, 1.0], bs=[[1, 2], [3, 4]])
+        # the tile has no ndvi, so this would raise if it were called on an empty window.
+        fold_chunk(tile, self.directory, 'product', 0, 0, max_ndvi)
+        product = load_accumulated_product(self.directory, 'product')
+        np.testing.assert_array_equal(product.bs.values, [[1, 2], [3, 4]])
+
+    def test_fold_partly_filled_window(self):
+        # the first tile only covers the first column of the second one's window.
+        first = create_tile([2.0, 1.0], [0.0], bs=[[1], [nodata]])
+        second = create_tile([2.0, 1.0], [0.0, 1.0], bs=[[nodata, 6], [7, 8]])
+        fold_chunk(first, self.directory, 'product', 0, 1, fill_nodata)
+        fold_chunk(second, self.directory, 'product', 0, 0, fill_nodata)
+        product = load_accumulated_product(self.directory, 'product')
+        # the earlier time chunk has priority, its nodata is filled from the later one.
+        np.testing.assert_array_equal(product.bs.values, [[1, 6], [7, 8]])
+
+    def test_fold_order_independent(self):
+        tiles = [create_tile([2.0, 1.0], [0.0, 1.0], bs=[[1, nodata], [nodata, nodata]]),
+                 create_tile([2.0, 1.0], [0.0, 1.0], bs=[[2, 3], [nodata, nodata]]),
+                 create_tile([2.0, 1.0], [0.0, 1.0], bs=[[4, 5], [6, nodata]])]
+        expected = [[1, 3], [6, nodata]]
+        for order in [[0, 1, 2], [2, 1, 0], [1, 2, 0]]:
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            create_output_grid(directory, 'product', latitude=(0.0, 2.0), longitude=(0.0, 2.0), resolution=(-1.0, 1.0))
+            for time_chunk in order:
+                fold_chunk(tiles[time_chunk].copy(deep=True), directory, 'product', 0, time_chunk, fill_nodata)
+            product = load_accumulated_product(directory, 'product')
+            np.testing.assert_array_equal(product.bs.values, expected)
+
+    def test_fold_same_tile_concurrently(self):
+        tiles = [create_tile([2.0, 1.0], [0.0, 1.0], bs=[[1, 2], [3, 4]]) for time_chunk in range(4)]
+        barrier = threading.Barrier(len(tiles))
+
+        def fold(time_chunk):
+            barrier.wait()
+            fold_chunk(tiles[time_chunk], self.directory, 'product', 0, time_chunk, slow_addition)
+
+        threads = [threading.Thread(target=fold, args=(time_chunk,)) for time_chunk in range(len(tiles))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        product = load_accumulated_product(self.directory, 'product')
+        # every chunk is added exactly once.
+        np.testing.assert_array_equal(product.bs.values, [[4, 8], [12, 16]])
+
+    def test_load_without_chunks(self):
+        self.assertIsNone(load_accumulated_product(self.directory, 'product'))
@@ -0,0 +1,57 @@
+# Unit test dependencies
+from django.test import SimpleTestCase
+
+# Other dependencies.
+from ..streaming_stats import get_moments, merge_moments, get_mean, get_variance
+import numpy as np
+import xarray as xr
+import warnings
+
+
+class TestStreamingStats(SimpleTestCase):
+
+    def setUp(self):
+        random = np.random.RandomState(0)
+        values = random.normal(0.4, 0.2, size=(12, 4, 3))
+        values[random.rand(*values.shape) < 0.3] = np.nan
+        # a pixel without any observations and one with a single observation.
+        values[:, 0, 0] = np.nan
+        values[1:, 0, 1] = np.nan
+        self.values = values
+        self.data_array = xr.DataArray(values, dims=('time', 'latitude', 'longitude'),
+                                       coords={'time': np.arange(12), 'latitude': np.arange(4), 'longitude': np.arange(3)})
+
+    def assert_moments(self, moments):
+        # numpy warns about the pixels without enough observations.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected_mean = np.nanmean(self.values, axis=0)
+            expected_variance = np.nanvar(self.values, axis=0)
+            expected_sample_variance = np.nanvar(self.values, axis=0, ddof=1)
+        np.testing.assert_allclose(get_mean(moments).values, expected_mean)
+        np.testing.assert_allclose(get_variance(moments).values, expected_variance)
+        np.testing.assert_allclose(get_variance(moments, ddof=1).values, expected_sample_variance)
+        np.testing.assert_array_equal(moments['count'].values, np.sum(np.isfinite(self.values), axis=0))
+
+    def test_moments(self):
+        self.assert_moments(get_moments(self.data_array))
+
+    def test_merge_moments(self):
+        for splits in [[6], [1, 5, 9], list(range(1, 12))]:
+            moments = None
+            for timeslices in np.split(np.arange(12), splits):
+                moments = merge_moments(get_moments(self.data_array.isel(time=timeslices)), moments)
+            self.assert_moments(moments)
+
+    def test_merge_order(self):
+        first = get_moments(self.data_array.isel(time=slice(0, 5)))
+        second = get_moments(self.data_array.isel(time=slice(5, 12)))
+        self.assert_moments(merge_moments(first.copy(deep=True), second.copy(deep=True)))
+        self.assert_moments(merge_moments(second, first))
+
+    def test_merge_into_nodata(self):
+        # output grids fill pixels nothing has been folded into with nodata.
+        empty = get_moments(self.data_array).copy(deep=True)
+        for key in empty.data_vars:
+            empty[key].values[:] = -9999
+        self.assert_moments(merge_moments(get_moments(self.data_array), empty))
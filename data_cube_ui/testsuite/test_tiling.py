@@ -0,0 +1,75 @@
+# Unit test dependencies
+from django.test import SimpleTestCase
+
+# Other dependencies.
+from ..tiling import plan_tiles, combine_tiles
+import numpy as np
+import xarray as xr
+import datetime
+
+
+class TestPlanTiles(SimpleTestCase):
+
+    resolution = (-0.00025, 0.00025)
+
+    def assert_covers(self, lat_ranges, lon_ranges, latitude, longitude):
+        # the tiles are the product of the latitude and longitude ranges.
+        for ranges, bounds in [(sorted(set(lat_ranges)), latitude), (sorted(set(lon_ranges)), longitude)]:
+            self.assertEqual(ranges[0][0], bounds[0])
+            self.assertEqual(ranges[-1][1], bounds[1])
+            for index in range(len(ranges) - 1):
+                # no gaps or overlaps, and the inner edges are on the pixel grid.
+                self.assertEqual(ranges[index][1], ranges[index + 1][0])
+                self.assertAlmostEqual(ranges[index][1] / self.resolution[1], round(ranges[index][1] / self.resolution[1]))
+        self.assertEqual(len(set(zip(lat_ranges, lon_ranges))), len(set(lat_ranges)) * len(set(lon_ranges)))
+
+    def test_covers_edges(self):
+        latitude = (0.1234, 0.5678)
+        longitude = (35.0101, 35.3)
+        for geo_chunk_size in [0.001, 0.01, 0.05, 1.0]:
+            lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=self.resolution, latitude=latitude, longitude=longitude,
+                                                             acquisitions=[], geo_chunk_size=geo_chunk_size)
+            self.assert_covers(lat_ranges, lon_ranges, latitude, longitude)
+
+    def test_storage_tiles(self):
+        latitude = (-0.3, 0.45)
+        longitude = (35.1, 35.9)
+        tile_size = (-0.25, 0.25)
+        for geo_chunk_size in [0.005, 0.0625, 0.2]:
+            lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=self.resolution, latitude=latitude, longitude=longitude,
+                                                             acquisitions=[], geo_chunk_size=geo_chunk_size, tile_size=tile_size)
+            self.assert_covers(lat_ranges, lon_ranges, latitude, longitude)
+            # no chunk crosses a storage tile boundary.
+            for lat_range, lon_range in zip(lat_ranges, lon_ranges):
+                self.assertEqual(np.floor(lat_range[0] / 0.25 + 1e-9), np.floor(lat_range[1] / 0.25 - 1e-9))
+                self.assertEqual(np.floor(lon_range[0] / 0.25 + 1e-9), np.floor(lon_range[1] / 0.25 - 1e-9))
+
+    def test_tile_order(self):
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=self.resolution, latitude=(0.0, 0.1), longitude=(0.0, 0.1),
+                                                         acquisitions=[], geo_chunk_size=0.0025)
+        # north to south, then west to east.
+        self.assertEqual(lat_ranges, sorted(lat_ranges, key=lambda lat_range: -lat_range[0]))
+        self.assertEqual(lon_ranges[:2], sorted(lon_ranges[:2]))
+
+    def test_time_chunks(self):
+        acquisitions = [datetime.datetime(2005 + index // 4, 1 + index % 4 * 3, 1) for index in range(10)]
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=self.resolution, latitude=(0.0, 0.1), longitude=(0.0, 0.1),
+                                                         acquisitions=acquisitions, geo_chunk_size=1.0, time_chunks=3, reverse_time=True)
+        self.assertEqual(sum(time_ranges, []), list(reversed(acquisitions)))
+        self.assertEqual(len(time_ranges), 3)
+        lat_ranges, lon_ranges, time_ranges = plan_tiles(resolution=self.resolution, latitude=(0.0, 0.1), longitude=(0.0, 0.1),
+                                                         acquisitions=acquisitions, geo_chunk_size=1.0, group_by_year=True)
+        self.assertEqual([[acquisition.year for acquisition in time_range] for time_range in time_ranges], [[2005] * 4, [2006] * 4, [2007] * 2])
+
+
+class TestCombineTiles(SimpleTestCase):
+
+    def test_combine_tiles(self):
+        latitude = np.arange(4, 0, -1, dtype=np.float64)
+        longitude = np.arange(6, dtype=np.float64)
+        values = np.arange(24).reshape(4, 6)
+        dataset = xr.Dataset({'red': (('latitude', 'longitude'), values)}, coords={'latitude': latitude, 'longitude': longitude})
+        tiles = [dataset.isel(latitude=lat_slice, longitude=lon_slice) for lat_slice in [slice(0, 3), slice(3, 4)] for lon_slice in [slice(0, 2), slice(2, 6)]]
+        combined = combine_tiles(list(reversed(tiles)))
+        np.testing.assert_array_equal(combined.red.values, values)
+        np.testing.assert_array_equal(combined.latitude.values, latitude)
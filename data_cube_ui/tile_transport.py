@@ -0,0 +1,196 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import io
+import json
+import shutil
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+from django.conf import settings
+
+from data_cube_ui.utils import get_redis_connection
+
+"""
+Transport for intermediate tiles handed from chunk tasks to the master, e.g. animation frames.
+Tiles are stored as raw arrays rather than NetCDF so there is no encode/decode on the critical
+path. The transport is picked with the TILE_TRANSPORT setting:
+    'shared_memory': raw .npy arrays under TILE_SHARED_MEMORY_PATH (tmpfs) - same node only.
+    'memmap': raw .npy arrays in the query's temp directory, memory mapped when read back.
+    'redis': a compressed blob on the celery broker so chunks can run on any node.
+Tiles are addressed by the query temp directory and a name, so the master can find a chunk's
+tile without it being returned through the result backend. Only coordinates and variables are
+kept - attributes are dropped.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+# tiles are only needed while a query runs - expire them so nothing is left behind if a task dies.
+key_expiry = 60 * 60 * 24
+header_name = '__header__'
+
+
+def _get_transport():
+    transport = getattr(settings, 'TILE_TRANSPORT', 'memmap')
+    if transport not in ('shared_memory', 'memmap', 'redis'):
+        raise ValueError("Unknown tile transport: " + str(transport))
+    return transport
+
+
+def _get_tile_path(directory, name):
+    if _get_transport() == 'shared_memory':
+        return os.path.join(settings.TILE_SHARED_MEMORY_PATH, directory.strip('/'), name + '.tile')
+    return os.path.join(directory, name + '.tile')
+
+
+def _get_tile_key(directory, name):
+    return "tile:" + os.path.join(directory, name)
+
+
+def _split_dataset(dataset):
+    header = {'coords': [], 'data_vars': []}
+    arrays = {}
+    for kind, variables in (('coords', dataset.coords), ('data_vars', dataset.data_vars)):
+        for key in variables:
+            header[kind].append([key, list(dataset[key].dims)])
+            arrays[key] = np.ascontiguousarray(dataset[key].values)
+    return header, arrays
+
+
+def _build_dataset(header, arrays):
+    coords = OrderedDict((key, (dims, arrays[key])) for key, dims in header['coords'])
+    data_vars = OrderedDict((key, (dims, arrays[key])) for key, dims in header['data_vars'])
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def write_raw_dataset(path, dataset):
+    """
+    Writes a dataset to a directory as one raw .npy array per variable.
+
+    Args:
+        path (string): The directory to write to - created if it doesn't exist.
+        dataset (Dataset): The dataset to write.
+    """
+    header, arrays = _split_dataset(dataset)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for key in arrays:
+        np.save(os.path.join(path, key + '.npy'), arrays[key])
+    # the header is written last so a partially written dataset is never read.
+    with open(os.path.join(path, header_name + '.json'), 'w') as header_file:
+        json.dump(header, header_file)
+
+
+def read_raw_dataset(path):
+    """
+    Reads a dataset written by write_raw_dataset as copy on write views of the arrays, so it
+    can be modified without touching what's on disk.
+
+    Args:
+        path (string): The directory the dataset was written to.
+
+    Returns:
+        Dataset: the dataset.
+    """
+    with open(os.path.join(path, header_name + '.json')) as header_file:
+        header = json.load(header_file)
+    arrays = {}
+    for key, dims in header['coords'] + header['data_vars']:
+        arrays[key] = np.load(os.path.join(path, key + '.npy'), mmap_mode='c')
+    return _build_dataset(header, arrays)
+
+
+def put_tile(dataset, directory, name):
+    """
+    Stores a tile so the master can pick it up with get_tile.
+
+    Args:
+        dataset (Dataset): The tile to store.
+        directory (string): The temp directory for the query.
+        name (string): Name of the tile, unique within the query.
+    """
+    if _get_transport() == 'redis':
+        header, arrays = _split_dataset(dataset)
+        arrays[header_name] = np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8)
+        blob = io.BytesIO()
+        np.savez_compressed(blob, **arrays)
+        get_redis_connection().setex(_get_tile_key(directory, name), key_expiry, blob.getvalue())
+        return
+    write_raw_dataset(_get_tile_path(directory, name), dataset)
+
+
+def get_tile(directory, name):
+    """
+    Gets a tile stored with put_tile. Tiles from the memmap/shared memory transports are
+    read with read_raw_dataset.
+
+    Args:
+        directory (string): The temp directory for the query.
+        name (string): Name of the tile.
+
+    Returns:
+        Dataset: the tile.
+    """
+    if _get_transport() == 'redis':
+        blob = get_redis_connection().get(_get_tile_key(directory, name))
+        if blob is None:
+            raise IOError("Tile not found: " + name)
+        stored = np.load(io.BytesIO(blob))
+        header = json.loads(stored[header_name].tobytes().decode('utf-8'))
+        arrays = {key: stored[key] for key in stored.files if key != header_name}
+        return _build_dataset(header, arrays)
+    return read_raw_dataset(_get_tile_path(directory, name))
+
+
+def delete_tile(directory, name):
+    """
+    Removes a tile once it's been used.
+
+    Args:
+        directory (string): The temp directory for the query.
+        name (string): Name of the tile.
+    """
+    if _get_transport() == 'redis':
+        get_redis_connection().delete(_get_tile_key(directory, name))
+        return
+    shutil.rmtree(_get_tile_path(directory, name), ignore_errors=True)
+
+
+def clear_tiles(directory):
+    """
+    Removes any tiles left for a query, e.g. after it was cancelled. Tiles in the query's
+    temp directory are removed along with it so there's nothing to do for the memmap transport.
+
+    Args:
+        directory (string): The temp directory for the query.
+    """
+    transport = _get_transport()
+    if transport == 'redis':
+        connection = get_redis_connection()
+        for key in connection.scan_iter(match=_get_tile_key(directory, '*')):
+            connection.delete(key)
+    elif transport == 'shared_memory':
+        shutil.rmtree(os.path.join(settings.TILE_SHARED_MEMORY_PATH, directory.strip('/')), ignore_errors=True)
@@ -0,0 +1,154 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import math
+import numpy as np
+import xarray as xr
+from collections import OrderedDict
+
+"""
+Splits queries into 2d tiles with a target pixel count rather than latitude strips of a fixed
+area in degrees. Tiles are square-ish in pixels, their edges fall on the product's pixel grid
+and, for ingested products, on the storage tile boundaries so each chunk reads whole storage
+tiles (or an even fraction of one) and chunks take roughly the same time to run.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+
+def get_tile_size(product_details):
+    """
+    Gets the ingestion tile size of a product from the list_products() row for it.
+
+    Args:
+        product_details (DataFrame): The row from list_products() for the product.
+
+    Returns:
+        tuple: (latitude, longitude) tile size in degrees or None if the product isn't tiled.
+    """
+    if 'tile_size' not in product_details:
+        return None
+    tile_size = product_details.tile_size.values[0]
+    if tile_size is None or not np.all(np.isfinite(np.array(tile_size, dtype=np.float64))):
+        return None
+    return tile_size
+
+
+def _get_ranges(bounds, resolution, side, storage_tile_size=None):
+    """
+    Splits a (min, max) range into ranges of roughly side pixels with edges on the pixel grid
+    and storage tile boundaries.
+    """
+    start = int(math.floor(bounds[0] / resolution))
+    end = int(math.ceil(bounds[1] / resolution))
+
+    offsets = [0]
+    if storage_tile_size is None:
+        block = side
+    else:
+        storage_pixels = max(int(round(abs(storage_tile_size) / resolution)), 1)
+        if side >= storage_pixels:
+            # a whole number of storage tiles per chunk.
+            block = (side // storage_pixels) * storage_pixels
+        else:
+            # an even split of each storage tile.
+            block = storage_pixels
+            parts = int(math.ceil(storage_pixels / float(side)))
+            offsets = [int(round(part * storage_pixels / float(parts))) for part in range(parts)]
+
+    edges = set()
+    for block_start in range((start // block) * block, end, block):
+        for offset in offsets:
+            if start < block_start + offset < end:
+                edges.add(block_start + offset)
+    edges = [start] + sorted(edges) + [end]
+    return [(max(edges[index] * resolution, bounds[0]), min(edges[index + 1] * resolution, bounds[1])) for index in range(len(edges) - 1)]
+
+
+def plan_tiles(resolution=None, latitude=None, longitude=None, acquisitions=None, geo_chunk_size=None, time_chunks=None, reverse_time=False, tile_size=None, group_by_year=False):
+    """
+    Splits a query into geographic tiles and time chunks. Replaces split_task - the
+    geographic chunk size is converted to a pixel count and tiled in 2d.
+
+    Args:
+        resolution (tuple): The (latitude, longitude) resolution of the product.
+        latitude (tuple): (min, max) latitude of the query.
+        longitude (tuple): (min, max) longitude of the query.
+        acquisitions (list): The acquisition dates for the query, oldest first.
+        geo_chunk_size (float): Area of each chunk in square degrees.
+        time_chunks (int): The number of time chunks, or None for a single one.
+        reverse_time (bool): Puts the most recent acquisitions first.
+        tile_size (tuple): (latitude, longitude) ingestion tile size in degrees, if any.
+        group_by_year (bool): Makes one time chunk per calendar year instead of time_chunks, so
+            time chunks don't shift as new acquisitions are added.
+
+    Returns:
+        lat_ranges, lon_ranges (list): The (min, max) ranges of each tile - tile i covers
+            lat_ranges[i] and lon_ranges[i]. Tiles go north to south, then west to east.
+        time_ranges (list): The acquisition lists for each time chunk.
+    """
+    latitude_resolution = abs(resolution[0])
+    longitude_resolution = abs(resolution[1])
+    chunk_pixels = geo_chunk_size / (latitude_resolution * longitude_resolution)
+    side = max(int(math.sqrt(chunk_pixels)), 1)
+
+    latitude_tiles = _get_ranges(latitude, latitude_resolution, side, tile_size[0] if tile_size is not None else None)
+    longitude_tiles = _get_ranges(longitude, longitude_resolution, side, tile_size[1] if tile_size is not None else None)
+
+    lat_ranges = []
+    lon_ranges = []
+    for lat_range in reversed(latitude_tiles):
+        for lon_range in longitude_tiles:
+            lat_ranges.append(lat_range)
+            lon_ranges.append(lon_range)
+
+    acquisitions = list(reversed(acquisitions)) if reverse_time else list(acquisitions)
+    if group_by_year:
+        years = OrderedDict()
+        for acquisition in acquisitions:
+            years.setdefault(acquisition.year, []).append(acquisition)
+        time_ranges = list(years.values())
+    elif time_chunks is None:
+        time_ranges = [acquisitions]
+    else:
+        time_chunk_size = int(math.ceil(len(acquisitions) / float(time_chunks)))
+        time_ranges = [acquisitions[index:index + time_chunk_size] for index in range(0, len(acquisitions), time_chunk_size)]
+    return lat_ranges, lon_ranges, time_ranges
+
+
+def combine_tiles(tiles):
+    """
+    Combines datasets for the 2d tiles from plan_tiles back into a single dataset.
+
+    Args:
+        tiles (list): Datasets for any number of tiles, in any order.
+
+    Returns:
+        Dataset: the combined dataset, north to south and west to east.
+    """
+    rows = OrderedDict()
+    for tile in sorted(tiles, key=lambda tile: (-tile.latitude.values[0], tile.longitude.values[0])):
+        rows.setdefault(tile.latitude.values[0], []).append(tile)
+    return xr.concat([xr.concat(row, dim='longitude') for row in rows.values()], dim='latitude')
@@ -19,6 +19,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from django.conf import settings
+import redis
+
 # pulled from peterbe.com since there were benchmarks listed.
 # removes duplicates from python lists.
 def uniquify_list(seq):
@@ -43,3 +46,13 @@ def map_ranges(value, leftMin, leftMax, rightMin, rightMax):
 
     # Convert the 0-1 range into a value in the right range.
     return rightMin + (valueScaled * rightSpan)
+
+def get_redis_connection():
+    """
+    Gets a connection to the redis instance used as the celery broker. This is used for
+    coordination between tasks that doesn't belong in the database, e.g. locks.
+
+    Returns:
+        StrictRedis: A redis client connected to BROKER_URL.
+    """
+    return redis.StrictRedis.from_url(settings.BROKER_URL)
@@ -0,0 +1,112 @@
+# Copyright 2016 United States Government as represented by the Administrator
+# of the National Aeronautics and Space Administration. All Rights Reserved.
+#
+# Portion of this code is Copyright Geoscience Australia, Licensed under the
+# Apache License, Version 2.0 (the "License"); you may not use this file
+# except in compliance with the License. You may obtain a copy of the License
+# at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# The CEOS 2 platform is licensed under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from utils.dc_utilities import perform_timeseries_analysis_iterative
+from utils.dc_tsm import tsm
+
+"""
+Water classification and total suspended matter over a single load of data. water_detection and
+tsm both classify water with WOfS, and tsm needs the classification to mask its own results, so
+they share this instead of each running the same classification on a separate read. Water and
+clean pixel counts for every acquisition are computed alongside the totals so the metadata for
+both apps comes from the same pass.
+"""
+
+# Author: AHDS
+# Creation date: 2016-06-23
+# Modified by:
+# Last modified date:
+
+# chunk cache and summary store names for the totals, shared by both apps so a water classification
+# computed for one is picked up by the other.
+water_product_name = "water_tsm.water"
+tsm_product_name = "water_tsm.tsm"
+
+
+def classify_water_tsm(raw_data, clean_mask, classifier, water_analysis=None, tsm_analysis=None, compute_tsm=True):
+    """
+    Classifies water in a set of time slices and adds the results to the running water and tsm totals.
+
+    Args:
+        raw_data (Dataset): The data, with swir2 as well if tsm is computed.
+        clean_mask (ndarray): The clean pixels in raw_data, e.g. from create_cfmask_clean_mask.
+        classifier (function): The water classifier, e.g. wofs_classify.
+        water_analysis (Dataset): The water totals so far or None.
+        tsm_analysis (Dataset): The tsm totals so far or None.
+        compute_tsm (bool): Computes tsm over the water pixels as well as classifying water.
+
+    Returns:
+        wofs_data (Dataset): the water classification of every time slice.
+        tsm_data (Dataset): the tsm of every time slice or None.
+        water_analysis, tsm_analysis (Dataset): the updated totals - tsm_analysis is None without tsm.
+        pixel_counts (dict): clean_pixels, water_pixels and tsm_pixels arrays with a count per time slice.
+    """
+    wofs_data = classifier(raw_data, clean_mask=clean_mask, enforce_float64=True)
+    water_analysis = perform_timeseries_analysis_iterative(wofs_data, intermediate_product=water_analysis)
+    is_water = wofs_data.wofs.values == 1
+    pixel_counts = {'clean_pixels': clean_mask.sum(axis=(1, 2)),
+                    'water_pixels': is_water.sum(axis=(1, 2))}
+
+    tsm_data = None
+    if compute_tsm:
+        #filter for swir2<1%, where valid range=[0,10000] so 1%=100.* scale of 0.0001
+        #and set all non-water pixels to nodata.
+        tsm_mask = clean_mask & (raw_data.swir2.values <= 100) & (wofs_data.wofs.values != 0)
+        tsm_data = tsm(raw_data, clean_mask=tsm_mask, no_data=-1)
+        tsm_analysis = perform_timeseries_analysis_iterative(tsm_data, intermediate_product=tsm_analysis, no_data=-1)
+        pixel_counts['tsm_pixels'] = tsm_mask.sum(axis=(1, 2))
+    return wofs_data, tsm_data, water_analysis, tsm_analysis, pixel_counts
+
+
+def split_tsm_metadata(acquisition_metadata):
+    """
+    Splits tsm acquisition metadata into the water_detection metadata and the tsm only metadata
+    so each can be stored under its own name.
+
+    Args:
+        acquisition_metadata (dict): acquisition date keyed clean_pixels, water_clean_pixels and water_pixels.
+
+    Returns:
+        water_metadata (dict): acquisition date keyed clean_pixels and water_pixels.
+        tsm_metadata (dict): acquisition date keyed clean_pixels.
+    """
+    water_metadata = {time: {'clean_pixels': values['water_clean_pixels'], 'water_pixels': values['water_pixels']}
+                      for time, values in acquisition_metadata.items()}
+    tsm_metadata = {time: {'clean_pixels': values['clean_pixels']} for time, values in acquisition_metadata.items()}
+    return water_metadata, tsm_metadata
+
+
+def combine_tsm_metadata(water_metadata, tsm_metadata):
+    """
+    Combines stored water_detection and tsm only metadata back into tsm acquisition metadata.
+
+    Args:
+        water_metadata (dict): acquisition date keyed clean_pixels and water_pixels.
+        tsm_metadata (dict): acquisition date keyed clean_pixels, with the same dates as water_metadata.
+
+    Returns:
+        acquisition_metadata (dict): acquisition date keyed clean_pixels, water_clean_pixels and water_pixels.
+    """
+    return {time: {'clean_pixels': tsm_metadata[time]['clean_pixels'],
+                   'water_clean_pixels': values['clean_pixels'],
+                   'water_pixels': values['water_pixels']}
+            for time, values in water_metadata.items()}